@@ -0,0 +1,116 @@
+"""Admission control for incoming updates, checked before any handler runs.
+
+Каждое обновление сначала проходит через Admission.check:
+
+    shed           — бот перегружен (в очереди больше max_pending обновлений),
+                     и это запрос только на чтение (/who_are_we, /my_mission...)
+    coalesced      — та же команда от того же пользователя только что была принята
+    throttled_user — пользователь исчерпал свою корзину токенов
+    throttled_chat — групповой чат исчерпал свою корзину (ответы видят все);
+                     считаются только команды и кнопки: ответы в диалоге
+                     регистрации тратят лишь корзину пользователя
+
+Отказ — это причина, иначе None. Повтор текста, который не команда, не
+склеивается: в диалоге регистрации то же имя второй раз подряд — это
+подтверждение. Корзины простаивающих пользователей и чатов удаляет prune.
+"""
+import time
+from typing import Dict, Optional
+
+from delivery import TokenBucket
+
+# Пользователь: в среднем сообщение в секунду, но регистрацию взрослого и ребенка можно пройти залпом
+USER_RATE = 1.0
+USER_BURST = 10.0
+# Групповой чат: Telegram разрешает боту около 20 сообщений в минуту в группе
+CHAT_RATE = 20 / 60
+CHAT_BURST = 10.0
+# Одинаковые команды подряд в пределах этого окна, в секундах, выполняются один раз
+DUPLICATE_WINDOW = 2.0
+MAX_PENDING = 1000
+
+
+class _Client:
+    __slots__ = ("bucket", "last_key", "last_at", "warned")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.last_key: Optional[str] = None
+        self.last_at = 0.0
+        self.warned = False
+
+
+class Admission:
+    """Per-user and per-chat token buckets, duplicate coalescing and load shedding"""
+
+    def __init__(
+        self,
+        user_rate: float = USER_RATE,
+        user_burst: float = USER_BURST,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+        duplicate_window: float = DUPLICATE_WINDOW,
+        max_pending: int = MAX_PENDING,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.duplicate_window = duplicate_window
+        self.max_pending = max_pending
+        self.users: Dict[int, _Client] = {}
+        self.chats: Dict[int, TokenBucket] = {}
+
+    def check(
+        self,
+        user_id: int,
+        chat_id: Optional[int],
+        key: Optional[str],
+        read_only: bool = False,
+        pending: int = 0,
+    ) -> Optional[str]:
+        """Reason to drop this update, or None to let it through
+
+        ``chat_id`` is set for group chats only, ``key`` for commands and button presses
+        (identical keys in a row are coalesced; only keyed updates spend the chat's bucket),
+        ``pending`` is how many updates wait in line.
+        """
+        client = self.users.get(user_id)
+        if client is None:
+            client = self.users[user_id] = _Client(TokenBucket(self.user_rate, self.user_burst))
+        # Под нагрузкой сначала жертвуем тем, что можно просто запросить еще раз
+        if read_only and pending > self.max_pending:
+            return "shed"
+        now = time.monotonic()
+        if key is not None and key == client.last_key and now - client.last_at < self.duplicate_window:
+            return "coalesced"
+        if not client.bucket.try_acquire():
+            return "throttled_user"
+        if chat_id is not None and key is not None:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if not bucket.try_acquire():
+                return "throttled_chat"
+        client.last_key = key
+        client.last_at = now
+        client.warned = False
+        return None
+
+    def warn_once(self, user_id: int) -> bool:
+        """True the first time a user is throttled or shed since their last admitted update"""
+        client = self.users.get(user_id)
+        if client is None or client.warned:
+            return False
+        client.warned = True
+        return True
+
+    def prune(self) -> int:
+        """Forget users and chats whose buckets have refilled; return how many were dropped"""
+        idle_users = [user_id for user_id, client in self.users.items() if client.bucket.full()]
+        for user_id in idle_users:
+            del self.users[user_id]
+        idle_chats = [chat_id for chat_id, bucket in self.chats.items() if bucket.full()]
+        for chat_id in idle_chats:
+            del self.chats[chat_id]
+        return len(idle_users) + len(idle_chats)
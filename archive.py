@@ -0,0 +1,149 @@
+"""Append-only archive of finished seasons.
+
+/reset больше не стирает сыгранный сезон бесследно: перед сбросом он
+целиком (участники, пожелания, цикл назначений, даты) сжимается zlib и
+дописывается в seasons.bin. Файл только растет, записи не меняются.
+
+Рядом лежит индекс seasons.idx — по строке JSON на сезон: смещение и
+длина сжатой записи, даты и пары "кто кому дарил" по именам. Индекс
+читается в память при первом обращении, поэтому вопросы "кому Аня
+дарила в 2024" и "какие пары были в прошлом сезоне" не распаковывают ни
+одного сезона; распаковывается только сезон, который админ открыл
+целиком. Несколько реплик могут писать в один каталог: запись идет под
+исключающим flock, чтение индекса — под разделяемым, а индекс
+дочитывается с того места, где остановился. Все методы блокируют на
+файловом вводе-выводе, их вызывают через asyncio.to_thread.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone, tzinfo
+from typing import Dict, List, Optional, Tuple
+
+from name_index import normalize
+
+DATA_FILE = "seasons.bin"
+INDEX_FILE = "seasons.idx"
+LOCK_FILE = "seasons.lock"
+
+
+@dataclass
+class Season:
+    number: int  # номер сезона внутри игры, с 1
+    game: str
+    offset: int
+    length: int
+    archived_at: float
+    assigned_at: Optional[float]
+    exchange_at: Optional[float]
+    participants: int
+    pairs: List[Tuple[str, str]]  # (кто дарит, кому) по именам
+
+    def year(self, tz: tzinfo = timezone.utc) -> int:
+        """Year of the season in the game's time zone: a draw late on Dec 31 belongs to that year"""
+        return datetime.fromtimestamp(self.exchange_at or self.assigned_at or self.archived_at, tz).year
+
+
+class SeasonArchive:
+    """Compressed season records plus an in-memory index over who gave to whom"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        self.seasons: Dict[str, List[Season]] = {}  # игра -> сезоны по порядку
+        self.gifts: Dict[Tuple[str, str], List[Tuple[Season, str]]] = {}  # (игра, имя) -> (сезон, кому дарил)
+        self._read = 0  # сколько байт индекса уже прочитано
+        # flock разводит процессы; потоки этого процесса делят индекс в памяти и идут по очереди
+        self._mutex = threading.Lock()
+
+    def refresh(self):
+        """Read index lines appended since the last call (by this or another process)"""
+        try:
+            lock = open(self.lock_path, "a")
+        except FileNotFoundError:
+            # Каталога еще нет — в архиве ничего нет
+            return
+        with self._mutex, lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            self._refresh()
+
+    def _refresh(self):
+        """refresh() for a caller that already holds the lock"""
+        try:
+            with open(self.index_path, "rb") as f:
+                f.seek(self._read)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Строку еще дописывают — дочитаем в следующий раз
+                        break
+                    self._read += len(line)
+                    self._index(Season(**json.loads(line)))
+        except FileNotFoundError:
+            pass
+
+    def _index(self, season: Season):
+        season.pairs = [tuple(pair) for pair in season.pairs]
+        self.seasons.setdefault(season.game, []).append(season)
+        for giver, receiver in season.pairs:
+            self.gifts.setdefault((season.game, normalize(giver)), []).append((season, receiver))
+
+    def append(self, game: str, record: Dict) -> Season:
+        """Archive a finished season; archiving the same draw twice returns the existing entry
+
+        ``record`` must hold "pairs", "participants", "assigned_at" and "exchange_at"; it is stored whole.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        blob = zlib.compress(json.dumps(record, ensure_ascii=False).encode(), 9)
+        with self._mutex, open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            for season in self.seasons.get(game, ()):
+                # Повтор /reset после сбоя не должен завести второй такой же сезон
+                if season.assigned_at is not None and season.assigned_at == record["assigned_at"]:
+                    return season
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            season = Season(
+                number=len(self.seasons.get(game, ())) + 1,
+                game=game,
+                offset=offset,
+                length=len(blob),
+                archived_at=time.time(),
+                assigned_at=record["assigned_at"],
+                exchange_at=record["exchange_at"],
+                participants=len(record["participants"]),
+                pairs=[tuple(pair) for pair in record["pairs"]],
+            )
+            line = json.dumps(season.__dict__, ensure_ascii=False) + "\n"
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._read += len(line.encode())
+            self._index(season)
+        return season
+
+    def history(self, game: str) -> List[Season]:
+        """Seasons of a game, oldest first"""
+        self.refresh()
+        return self.seasons.get(game, [])
+
+    def gave_to(self, game: str, name: str) -> List[Tuple[Season, str]]:
+        """Whom this participant drew in each archived season of the game, oldest first"""
+        self.refresh()
+        return self.gifts.get((game, normalize(name)), [])
+
+    def load(self, season: Season) -> Dict:
+        """Decompress one season's full record"""
+        with open(self.data_path, "rb") as f:
+            f.seek(season.offset)
+            return json.loads(zlib.decompress(f.read(season.length)))
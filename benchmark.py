@@ -0,0 +1,138 @@
+"""Benchmarks for SecretSantaData hot paths.
+
+Запуск: python benchmark.py [participants]
+"""
+import asyncio
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Бенчмарку не нужен настоящий токен
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "")
+
+from matching import solve
+from persistence import Journal
+from secret_santa_bot import SecretSantaData
+
+
+def build_roster(adults: int, children_per_guardian: int = 0) -> SecretSantaData:
+    """Build a roster of adults, optionally with children attached to every guardian"""
+    roster = SecretSantaData()
+    for user_id in range(1, adults + 1):
+        roster.add_adult(user_id, f"Adult {user_id}", "surprise me!")
+        for k in range(children_per_guardian):
+            roster.add_child(f"Kid {user_id}.{k}", user_id, "lego")
+    return roster
+
+
+def bench_make_assignments(participants: int = 100_000):
+    """Time make_assignments for a roster of the given size (80% adults, 20% kids)"""
+    guardians = participants // 5
+    roster = build_roster(participants - guardians)
+    for user_id in range(1, guardians + 1):
+        roster.add_child(f"Kid {user_id}", user_id)
+
+    started = time.perf_counter()
+    assert roster.make_assignments()
+    elapsed = time.perf_counter() - started
+
+    given = sum(1 for _ in roster.assignment_pairs())
+    assert given == participants
+    print(f"make_assignments: {participants} participants in {elapsed * 1000:.1f} ms")
+    return elapsed
+
+
+def bench_solver(participants: int = 10_000, densities=(0.0, 0.001, 0.01, 0.05, 0.2)):
+    """Time the constrained solver as the share of excluded receivers grows"""
+    rng = random.Random(2024)
+    ids = list(range(participants))
+    results = []
+    for density in densities:
+        per_giver = int(participants * density)
+        blocked = {giver: set(rng.sample(ids, per_giver)) for giver in ids} if per_giver else {}
+
+        started = time.perf_counter()
+        receiver_of = solve(ids, blocked, rng=rng)
+        elapsed = time.perf_counter() - started
+
+        assert sorted(receiver_of.values()) == ids
+        assert all(receiver not in blocked.get(giver, ()) and receiver != giver for giver, receiver in receiver_of.items())
+        print(f"solve: {participants} participants, {per_giver} exclusions each ({density:.1%}) in {elapsed * 1000:.1f} ms")
+        results.append((density, elapsed))
+    return results
+
+
+def bench_recovery(participants: int = 100_000):
+    """Time cold-start recovery from a snapshot and from a bare journal"""
+    with tempfile.TemporaryDirectory() as directory:
+        async def write(snapshot: bool):
+            journal = Journal(directory)
+            roster = SecretSantaData()
+            journal.load(roster)
+            for user_id in range(1, participants + 1):
+                roster.add_adult(user_id, f"Adult {user_id}", "surprise me!")
+            roster.make_assignments()
+            if snapshot:
+                await journal.close()
+            else:
+                await journal.flush()
+
+        for label, snapshot in (("journal", False), ("snapshot", True)):
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            asyncio.run(write(snapshot))
+
+            started = time.perf_counter()
+            recovered = SecretSantaData()
+            Journal(directory).load(recovered)
+            elapsed = time.perf_counter() - started
+
+            assert len(recovered.adults) == participants and recovered.assigned
+            print(f"recovery from {label}: {participants} participants in {elapsed * 1000:.1f} ms")
+
+
+def bench_memory(participants: int = 1_000_000):
+    """Bytes per participant held by the roster, the assignments and the rendered mission cache"""
+    guardians = participants // 5
+    gc.collect()
+    tracemalloc.start()
+    # Исходные строки создаем под tracemalloc: после вставки ими владеют записи
+    adults = [(user_id, f"Adult {user_id}", "surprise me!") for user_id in range(1, participants - guardians + 1)]
+    children = [(f"Kid {user_id}", user_id, "lego") for user_id in range(1, guardians + 1)]
+    roster = SecretSantaData()
+    roster.bulk_add(adults, children)
+    del adults, children
+    gc.collect()
+    after_roster = tracemalloc.get_traced_memory()[0]
+    roster.make_assignments()
+    gc.collect()
+    after_assignments = tracemalloc.get_traced_memory()[0]
+    # Задания рендерятся лениво — заполняем кэш так, как его заполнила бы рассылка всем
+    for user_id in roster.mission_recipients():
+        roster.get_mission(user_id)
+    after_missions = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(
+        f"memory: {participants} participants — roster {after_roster / participants:.0f} B, "
+        f"assignments {(after_assignments - after_roster) / participants:.0f} B, "
+        f"mission cache {(after_missions - after_assignments) / participants:.0f} B per participant; "
+        f"{after_missions / 2 ** 20:.0f} MiB in total"
+    )
+    return after_roster, after_assignments - after_roster, after_missions - after_assignments
+
+
+def main():
+    participants = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    bench_make_assignments(participants)
+    bench_solver(min(participants, 10_000))
+    bench_recovery(participants)
+    bench_memory(max(participants, 1_000_000))
+
+
+if __name__ == "__main__":
+    main()
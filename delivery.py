@@ -0,0 +1,265 @@
+"""Rate-limited concurrent delivery of bot messages.
+
+Telegram allows about 30 messages per second per bot and roughly one
+message per second per chat. Broadcasts go through a global token bucket
+plus a bucket per chat, honour RetryAfter and retry transient errors with
+bounded exponential backoff. Any object with an async ``send_message``
+(and ``send_photo``, for messages with photos) works as the bot, so a
+fake one can simulate flood control.
+
+Отчет о рассылке заполняется по ходу дела, так что вызывающий код может
+показывать прогресс, а рассылку можно остановить событием cancel: уже
+начатые отправки завершаются, новые не начинаются. Перед остановкой
+процесса Deliverer.drain делает то же со всеми рассылками сразу, а
+отправки, не успевшие за отведенное время, прерывает. Сообщения, о
+которых on_sent так и не сообщил, остались неотправленными.
+"""
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram с небольшим запасом
+GLOBAL_RATE = 25.0
+PER_CHAT_RATE = 1.0
+CONCURRENCY = 8
+MAX_ATTEMPTS = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+# Причина неудачи для отправки, брошенной из-за остановки процесса; такое сообщение не считается ни доставленным, ни проваленным
+HALTED = "halted"
+
+
+class TokenBucket:
+    """Classic token bucket; ``reserve`` never blocks, ``acquire`` sleeps until a token is ours"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        """Take a token now, possibly going into debt; return how long to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right now"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1 or now < self.paused_until:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self) -> bool:
+        """Nothing taken lately: the bucket is back at capacity"""
+        now = time.monotonic()
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while (flood control)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    # (file_id, подпись): фото уже лежат у Telegram, отправка по file_id ничего не загружает
+    photos: Tuple[Tuple[str, str], ...] = ()
+    # Метка вызывающего кода, например номер в outbox; возвращается в on_sent вместе с сообщением
+    tag: Any = None
+
+
+@dataclass
+class DeliveryReport:
+    delivered: List[int] = field(default_factory=list)
+    failed: Dict[int, str] = field(default_factory=dict)
+    cancelled: bool = False
+    halted: bool = False  # процесс останавливается — неотправленное досылает следующий
+
+    @property
+    def total(self) -> int:
+        return len(self.delivered) + len(self.failed)
+
+
+class Deliverer:
+    """Sends messages under global and per-chat rate limits"""
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        per_chat_rate: float = PER_CHAT_RATE,
+        concurrency: int = CONCURRENCY,
+        max_attempts: int = MAX_ATTEMPTS,
+        base_delay: float = BASE_DELAY,
+        max_delay: float = MAX_DELAY,
+    ):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.halted = False
+        self._workers: Set[asyncio.Task] = set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 1.0)
+        return bucket
+
+    def try_spare(self, chat_id: int) -> bool:
+        """Allow a rare low-priority call (like a progress edit) without taking from the broadcast budget
+
+        GLOBAL_RATE stays below Telegram's limit, and such calls use that headroom: they only
+        back off during flood control and take the chat's own token.
+        """
+        if time.monotonic() < self.global_bucket.paused_until:
+            return False
+        return self._chat_bucket(chat_id).try_acquire()
+
+    async def send(self, bot: Any, message: OutgoingMessage) -> Optional[str]:
+        """Deliver one message and its photos; return None on success or the reason it failed"""
+        error = await self._send_part(bot, message.chat_id, message.text)
+        for photo, caption in message.photos:
+            if error is not None:
+                break
+            error = await self._send_part(bot, message.chat_id, caption, photo)
+        return error
+
+    async def _send_part(self, bot: Any, chat_id: int, text: str, photo: Optional[str] = None) -> Optional[str]:
+        error = "not sent"
+        for attempt in range(self.max_attempts):
+            if attempt and self.halted:
+                # Повторы после остановки не ждем — сообщение дошлет следующий процесс
+                return HALTED
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                if photo is None:
+                    await bot.send_message(chat_id=chat_id, text=text)
+                else:
+                    await bot.send_photo(chat_id=chat_id, photo=photo, caption=text)
+                return None
+            except RetryAfter as e:
+                # Флуд-контроль касается всего бота, поэтому ставим на паузу общую корзину
+                retry_after = float(e.retry_after)
+                logger.warning(f"Flood control, retrying in {retry_after}s (chat {chat_id})")
+                self.global_bucket.pause(retry_after)
+                error = f"flood control: {e}"
+                continue
+            except (BadRequest, Forbidden) as e:
+                # Пользователь заблокировал бота или чат не найден — повторять бесполезно
+                return str(e)
+            except NetworkError as e:
+                error = str(e)
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        return error
+
+    async def broadcast(
+        self,
+        bot: Any,
+        messages: Iterable[OutgoingMessage],
+        report: Optional[DeliveryReport] = None,
+        cancel: Optional[asyncio.Event] = None,
+        on_sent: Optional[Callable[[OutgoingMessage, Optional[str]], Any]] = None,
+    ) -> DeliveryReport:
+        """Deliver messages concurrently and report who got theirs
+
+        Pass ``report`` to watch progress while the broadcast runs; setting ``cancel`` stops it early.
+        ``on_sent(message, error)`` is called for every message that was delivered or has failed for good.
+        If ``messages`` raises, no new sends start and the error is raised once the ones in flight finish.
+        """
+        report = report if report is not None else DeliveryReport()
+        pending = iter(messages)
+
+        async def worker():
+            for message in pending:
+                if self.halted:
+                    report.halted = True
+                    return
+                if cancel is not None and cancel.is_set():
+                    report.cancelled = True
+                    return
+                try:
+                    error = await self.send(bot, message)
+                    if error not in (None, HALTED):
+                        logger.error(f"Error sending message to user {message.chat_id}: {error}")
+                except Exception as e:
+                    logger.error(f"Error sending message to user {message.chat_id}: {e}", exc_info=True)
+                    error = str(e)
+                if error == HALTED:
+                    report.halted = True
+                    return
+                if error is None:
+                    report.delivered.append(message.chat_id)
+                else:
+                    report.failed[message.chat_id] = error
+                if on_sent is not None:
+                    try:
+                        on_sent(message, error)
+                    except Exception as e:
+                        # Сбой учета не останавливает рассылку: остальные сообщения все равно уходят
+                        logger.error(f"Error recording message to user {message.chat_id}: {e}", exc_info=True)
+
+        workers = {asyncio.create_task(worker()) for _ in range(self.concurrency)}
+        self._workers |= workers
+        try:
+            # Воркеры, прерванные в drain, отменены — это не ошибка рассылки
+            await asyncio.wait(workers)
+        finally:
+            self._workers -= workers
+        if any(worker.cancelled() for worker in workers):
+            report.halted = True
+        self._prune()
+        for worker in workers:
+            # Упал сам источник сообщений: остальные так и не отправлены, отчет неполон
+            if not worker.cancelled() and worker.exception() is not None:
+                raise worker.exception()
+        return report
+
+    async def drain(self, timeout: float):
+        """Start no new sends; give the ones in flight ``timeout`` seconds, then abandon them"""
+        self.halted = True
+        workers = set(self._workers)
+        if not workers:
+            return
+        _, stuck = await asyncio.wait(workers, timeout=timeout)
+        for worker in stuck:
+            worker.cancel()
+        if stuck:
+            logger.warning(f"Abandoned {len(stuck)} sends still in flight after {timeout}s")
+            await asyncio.wait(stuck)
+
+    def _prune(self):
+        """Forget per-chat buckets that have refilled, so they don't pile up between broadcasts"""
+        now = time.monotonic()
+        idle = [
+            chat_id for chat_id, bucket in self.chat_buckets.items()
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity
+        ]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
@@ -0,0 +1,333 @@
+"""Offline load test: the real bot against a local fake Telegram Bot API.
+
+Поднимает локальный HTTP-сервер, который притворяется Bot API
+(getUpdates, sendMessage и т.д.) и умеет отвечать 429 Too Many Requests.
+Бот собирается тем же build_application, что и в main(), и работает
+через long polling против этого сервера. Виртуальные пользователи
+проходят /im_in, /add_small_human (часть — с фото пожеланий), затем
+админ запускает /make_it_random,
+и все спрашивают /my_mission. В конце печатается пропускная способность
+и p50/p95/p99 задержки по каждому обработчику.
+
+Запуск: python load_test.py --users 500 --flood-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+# Настройки бота читаются при импорте, поэтому задаем их заранее
+os.environ.setdefault("DATA_DIR", "")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "")
+
+FAKE_TOKEN = "123456:LOAD-TEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Fake Santa", "username": "fake_santa_bot"}
+REPLY_TIMEOUT = 30.0
+
+
+class FakeBotAPI:
+    """Minimal stand-in for the Telegram Bot API over plain HTTP/1.1"""
+
+    def __init__(self, flood_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.updates: List[Dict] = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.new_update = asyncio.Condition()
+        self.waiters: Dict[int, List[Tuple[Callable[[str], bool], asyncio.Future]]] = defaultdict(list)
+        self.sent = 0
+        self.photos = 0
+        self.flooded = 0
+        self.inbox: Dict[int, int] = defaultdict(int)
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.port = 0
+
+    async def start(self, port: int = 0):
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    # --- сторона пользователей ---
+
+    async def push_message(self, user_id: int, text: str, photo: Optional[str] = None):
+        """Queue an incoming private message as if a user sent it; ``photo`` makes it a photo with that file_id"""
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"User {user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "language_code": "en"},
+        }
+        if photo is not None:
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1280, "height": 960}]
+        else:
+            message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.next_message_id += 1
+        async with self.new_update:
+            self.updates.append({"update_id": self.next_update_id, "message": message})
+            self.next_update_id += 1
+            self.new_update.notify_all()
+
+    def expect_reply(self, chat_id: int, match: Callable[[str], bool] = lambda text: True) -> asyncio.Future:
+        """Future resolved with the next bot message to ``chat_id`` that satisfies ``match``"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id].append((match, future))
+        return future
+
+    # --- сторона бота ---
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self._dispatch(path.rsplit("/", 1)[-1], headers, body)
+                raw = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(raw)}\r\n\r\n".encode() + raw
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError — сервер останавливается посреди long polling
+            pass
+        finally:
+            writer.close()
+
+    def _params(self, headers: Dict[str, str], body: bytes) -> Dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            return dict(parse_qsl(body.decode()))
+        if content_type.startswith("application/json") and body:
+            return json.loads(body)
+        # multipart (sendDocument) — содержимое нам не нужно
+        return {}
+
+    async def _dispatch(self, method: str, headers: Dict[str, str], body: bytes) -> Tuple[int, Dict]:
+        params = self._params(headers, body)
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+        if method in ("sendMessage", "sendDocument", "sendPhoto", "editMessageText"):
+            if self.flood_rate and self.rng.random() < self.flood_rate:
+                self.flooded += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            return 200, {"ok": True, "result": self._message_sent(method, params)}
+        # deleteWebhook, answerCallbackQuery, setMyCommands и прочее
+        return 200, {"ok": True, "result": True}
+
+    async def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        async with self.new_update:
+            # Подтвержденные обновления больше не нужны
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self.new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:limit]
+
+    def _message_sent(self, method: str, params: Dict) -> Dict:
+        chat_id = int(params.get("chat_id", 0))
+        text = params.get("text") or params.get("caption") or ""
+        self.sent += 1
+        if method == "sendPhoto":
+            self.photos += 1
+        waiters = self.waiters.get(chat_id, [])
+        for i, (match, future) in enumerate(waiters):
+            if not future.done() and match(text):
+                future.set_result(text)
+                del waiters[i]
+                break
+        else:
+            self.inbox[chat_id] += 1
+        message_id = int(params.get("message_id") or 0) or self.next_message_id
+        self.next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+
+class LoadTest:
+    def __init__(self, api: FakeBotAPI, users: int, kids_ratio: float, concurrency: int, photo_ratio: float = 0.0):
+        self.api = api
+        self.users = users
+        self.kids_ratio = kids_ratio
+        self.photo_ratio = photo_ratio
+        self.concurrency = concurrency
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.steps = 0
+
+    async def step(
+        self,
+        user_id: int,
+        label: str,
+        text: str,
+        match: Callable[[str], bool] = lambda text: True,
+        photo: Optional[str] = None,
+    ) -> Optional[str]:
+        """Send one message and wait for the bot's answer, recording the latency; return the answer"""
+        reply = self.api.expect_reply(user_id, match)
+        started = time.perf_counter()
+        await self.api.push_message(user_id, text, photo)
+        self.steps += 1
+        try:
+            await asyncio.wait_for(reply, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.errors[label] += 1
+            return None
+        self.latencies[label].append(time.perf_counter() - started)
+        return reply.result()
+
+    async def name_step(self, user_id: int, label: str, name: str) -> Optional[str]:
+        """Send a name; "Santa Fan 1001" looks like "Santa Fan 1002", so confirm it when the bot asks"""
+        reply = await self.step(user_id, label, name)
+        if reply and "We already have" in reply:
+            reply = await self.step(user_id, label, name)
+        return reply
+
+    async def photo_step(self, user_id: int, label: str) -> Optional[str]:
+        """Attach a wishlist photo (an invented file_id — the fake API never checks it) or /skip"""
+        if random.random() < self.photo_ratio:
+            return await self.step(user_id, f"{label}: photo", "", photo=f"wish-{label}-{user_id}")
+        return await self.step(user_id, f"{label}: skip photo", "/skip")
+
+    async def register(self, user_id: int):
+        if not (
+            await self.step(user_id, "im_in", "/im_in")
+            and await self.name_step(user_id, "im_in: name", f"Santa Fan {user_id}")
+            and await self.step(user_id, "im_in: recommendations", "socks, but fancy")
+            and await self.photo_step(user_id, "im_in")
+        ):
+            await self.api.push_message(user_id, "/cancel")
+            return
+        if random.random() < self.kids_ratio:
+            if not (
+                await self.step(user_id, "add_small_human", "/add_small_human")
+                and await self.name_step(user_id, "add_small_human: name", f"Kid of {user_id}")
+                and await self.step(user_id, "add_small_human: recommendations", "lego")
+                and await self.photo_step(user_id, "add_small_human")
+            ):
+                await self.api.push_message(user_id, "/cancel")
+
+    async def run_phase(self, coroutines):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(coroutine):
+            async with semaphore:
+                await coroutine
+
+        await asyncio.gather(*(limited(coroutine) for coroutine in coroutines))
+
+    async def run(self, admin_id: int) -> float:
+        user_ids = [1000 + i for i in range(self.users)]
+        started = time.perf_counter()
+        await self.run_phase(self.register(user_id) for user_id in user_ids)
+        await self.step(admin_id, "make_it_random", "/make_it_random", lambda text: "Assignments sent out" in text)
+        await self.run_phase(self.step(user_id, "my_mission", "/my_mission") for user_id in user_ids)
+        await self.step(admin_id, "who_are_we", "/who_are_we")
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float):
+        print(f"\n{self.steps} updates in {elapsed:.2f} s — {self.steps / elapsed:.1f} updates/s")
+        print(f"bot messages: {self.api.sent} (photos by file_id: {self.api.photos}), injected 429s: {self.api.flooded}\n")
+        print(f"{'handler':<36}{'calls':>7}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for label in sorted(set(self.latencies) | set(self.errors)):
+            samples = sorted(self.latencies[label])
+            print(
+                f"{label:<36}{len(samples):>7}{self.errors[label]:>8}"
+                f"{percentile(samples, 50):>9.1f}{percentile(samples, 95):>9.1f}{percentile(samples, 99):>9.1f}"
+            )
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return float("nan")
+    if len(samples) == 1:
+        return samples[0] * 1000
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(pct) - 1] * 1000
+
+
+async def run(args):
+    import secret_santa_bot
+
+    # Логи каждого HTTP-запроса и каждой регистрации заглушили бы отчет
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("secret_santa_bot").setLevel(logging.WARNING)
+
+    api = FakeBotAPI(flood_rate=args.flood_rate, retry_after=args.retry_after, seed=args.seed)
+    await api.start(args.port)
+
+    admin_id = secret_santa_bot.ADMIN_ID or 1
+    application = secret_santa_bot.build_application(FAKE_TOKEN, api.base_url)
+    test = LoadTest(api, args.users, args.kids_ratio, args.concurrency, args.photo_ratio)
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+        try:
+            elapsed = await test.run(admin_id)
+        finally:
+            await application.updater.stop()
+            await application.stop()
+    await api.stop()
+    test.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="simulated adults")
+    parser.add_argument("--kids-ratio", type=float, default=0.3, help="share of adults who also add a kid")
+    parser.add_argument("--photo-ratio", type=float, default=0.3, help="share of registrations with a wishlist photo")
+    parser.add_argument("--concurrency", type=int, default=50, help="users active at the same time")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after in injected 429s")
+    parser.add_argument("--port", type=int, default=0, help="port for the fake Bot API (0 = any free)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
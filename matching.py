@@ -0,0 +1,173 @@
+"""Constrained Secret Santa matching.
+
+Участники задаются целочисленными id, ограничения — словарем
+giver_id -> множество id, которых этот участник вытянуть не может.
+"""
+import random
+from collections import Counter
+from itertools import chain
+from typing import Dict, List, Mapping, Optional, Sequence, Set
+
+_EMPTY: Set[int] = frozenset()
+
+# Сколько раз пробуем собрать один общий цикл, прежде чем перейти к паросочетанию
+RING_RESTARTS = 20
+# Сколько случайных обменов пробуем для починки одного запрещенного ребра
+RING_SWAP_ATTEMPTS = 64
+
+
+class AssignmentError(Exception):
+    """Raised when the constraints leave no valid assignment"""
+
+
+def solve(
+    ids: Sequence[int],
+    blocked: Mapping[int, Set[int]],
+    names: Optional[Mapping[int, str]] = None,
+    rng: Optional[random.Random] = None,
+    restarts: int = RING_RESTARTS,
+) -> Dict[int, int]:
+    """Return a giver_id -> receiver_id mapping that respects ``blocked``.
+
+    First tries to build a single random cycle, repairing forbidden edges
+    with local swaps. If that keeps failing, falls back to bipartite
+    matching, which either finds a valid assignment or proves there is none.
+    """
+    rng = rng or random.Random()
+    names = names or {}
+    if len(ids) < 2:
+        raise AssignmentError("Need at least 2 participants")
+
+    _check_degrees(ids, blocked, names)
+
+    for _ in range(restarts):
+        ring = _repair_ring(ids, blocked, rng)
+        if ring is not None:
+            return {giver: ring[(i + 1) % len(ring)] for i, giver in enumerate(ring)}
+
+    return _match(ids, blocked, names, rng)
+
+
+def _allowed(giver: int, receiver: int, blocked: Mapping[int, Set[int]]) -> bool:
+    return giver != receiver and receiver not in blocked.get(giver, _EMPTY)
+
+
+def _check_degrees(ids: Sequence[int], blocked: Mapping[int, Set[int]], names: Mapping[int, str]):
+    """Fail fast on participants nobody can draw or who can draw nobody"""
+    limit = len(ids) - 1
+    for giver in ids:
+        excluded = blocked.get(giver, _EMPTY)
+        if len(excluded) >= limit and len(set(ids) - excluded - {giver}) == 0:
+            raise AssignmentError(f"{names.get(giver, giver)} is excluded from drawing anyone")
+    incoming = Counter(chain.from_iterable(blocked.values()))
+    for receiver in ids:
+        count = incoming.get(receiver, 0) - (receiver in blocked.get(receiver, _EMPTY))
+        if count >= limit:
+            raise AssignmentError(f"Nobody is allowed to draw {names.get(receiver, receiver)}")
+
+
+def _repair_ring(ids: Sequence[int], blocked: Mapping[int, Set[int]], rng: random.Random) -> Optional[List[int]]:
+    """Shuffle into a cycle and fix forbidden edges by swapping, or give up"""
+    ring = list(ids)
+    rng.shuffle(ring)
+    n = len(ring)
+
+    def edge_ok(pos: int) -> bool:
+        return _allowed(ring[pos % n], ring[(pos + 1) % n], blocked)
+
+    for i in range(n):
+        if edge_ok(i):
+            continue
+        k = (i + 1) % n
+        for _ in range(RING_SWAP_ATTEMPTS):
+            j = rng.randrange(n)
+            if j == k:
+                continue
+            ring[k], ring[j] = ring[j], ring[k]
+            # Обмен затрагивает только четыре ребра вокруг позиций k и j
+            if edge_ok(k - 1) and edge_ok(k) and edge_ok(j - 1) and edge_ok(j):
+                break
+            ring[k], ring[j] = ring[j], ring[k]
+        else:
+            return None
+    return ring
+
+
+def _match(
+    ids: Sequence[int],
+    blocked: Mapping[int, Set[int]],
+    names: Mapping[int, str],
+    rng: random.Random,
+) -> Dict[int, int]:
+    """Perfect matching between givers and receivers on the allowed graph.
+
+    Разрешенных пар почти n^2, поэтому граф не строится: поиск
+    увеличивающего пути обходит дополнение к списку исключений, и
+    каждый шаг BFS стоит O(n + число исключений).
+    """
+    givers = list(ids)
+    rng.shuffle(givers)
+    pool = list(ids)
+    rng.shuffle(pool)
+    position = {receiver: i for i, receiver in enumerate(pool)}
+    receiver_of: Dict[int, int] = {}
+    giver_of: Dict[int, int] = {}
+
+    def take(receiver: int):
+        i = position.pop(receiver)
+        last = pool.pop()
+        if last != receiver:
+            pool[i] = last
+            position[last] = i
+
+    # Жадно раздаем случайных свободных получателей
+    unmatched = []
+    for giver in givers:
+        for _ in range(8):
+            if not pool:
+                break
+            receiver = pool[rng.randrange(len(pool))]
+            if _allowed(giver, receiver, blocked):
+                receiver_of[giver] = receiver
+                giver_of[receiver] = giver
+                take(receiver)
+                break
+        if giver not in receiver_of:
+            unmatched.append(giver)
+
+    # Остальных доводим увеличивающими путями
+    for start in unmatched:
+        unvisited = set(ids)
+        parent: Dict[int, int] = {}
+        queue = [start]
+        end = None
+        while queue and end is None:
+            next_queue = []
+            for giver in queue:
+                excluded = blocked.get(giver, _EMPTY)
+                for receiver in list(unvisited):
+                    if receiver == giver or receiver in excluded:
+                        continue
+                    unvisited.discard(receiver)
+                    parent[receiver] = giver
+                    if receiver not in giver_of:
+                        end = receiver
+                        break
+                    next_queue.append(giver_of[receiver])
+                if end is not None:
+                    break
+            queue = next_queue
+        if end is None:
+            raise AssignmentError(
+                f"No valid match for {names.get(start, start)} — the exclusions are too tight"
+            )
+        receiver = end
+        while True:
+            giver = parent[receiver]
+            previous = receiver_of.get(giver)
+            receiver_of[giver] = receiver
+            giver_of[receiver] = giver
+            if giver == start:
+                break
+            receiver = previous
+    return receiver_of
@@ -0,0 +1,97 @@
+"""Catalog of user-facing message templates in several languages.
+
+Тексты лежат в locales/<язык>.json: ключ -> шаблон в синтаксисе str.format.
+Английский компилируется при старте и служит запасным вариантом, остальные
+языки загружаются при первом обращении. Шаблон компилируется один раз:
+разбираем поля, проверяем, что перевод не требует полей, которых нет в
+английском, и сохраняем готовый вызов — без полей это просто строка, а
+с простыми полями {name} — склейка заранее разобранных кусков без
+повторного разбора формата на каждом рендере.
+Язык выбирается по language_code пользователя из Telegram.
+"""
+import json
+import logging
+import os
+from string import Formatter
+from typing import Callable, Dict, FrozenSet, Optional
+
+logger = logging.getLogger(__name__)
+
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+DEFAULT_LANGUAGE = "en"
+# Старые клиенты присылают для иврита устаревший код iw
+ALIASES = {"iw": "he"}
+
+Template = Callable[..., str]
+
+
+def _fields(text: str) -> FrozenSet[str]:
+    return frozenset(name for _, name, _, _ in Formatter().parse(text) if name)
+
+
+def _compile(text: str) -> Template:
+    parsed = list(Formatter().parse(text))
+    if not any(name for _, name, _, _ in parsed):
+        return lambda **fields: text
+    if any(spec or conversion or (name is not None and not name.isidentifier()) for _, name, spec, conversion in parsed):
+        # Спецификации формата и поля вроде {0} или {user.name} оставляем str.format
+        return text.format
+    pieces = tuple((literal, name) for literal, name, _, _ in parsed)
+
+    def template(**fields) -> str:
+        out = []
+        for literal, name in pieces:
+            out.append(literal)
+            if name is not None:
+                out.append(str(fields[name]))
+        return "".join(out)
+
+    return template
+
+
+class Catalog:
+    def __init__(self, directory: str = LOCALES_DIR, default: str = DEFAULT_LANGUAGE):
+        self.directory = directory
+        self.default = default
+        self.available = frozenset(name[:-5] for name in os.listdir(directory) if name.endswith(".json"))
+        self._locales: Dict[str, Dict[str, Template]] = {}
+        self._resolved: Dict[Optional[str], str] = {}
+        self._fields: Dict[str, FrozenSet[str]] = {}
+        # Английский нужен всем как запасной вариант — компилируем сразу
+        self._fallback = self._load(default)
+
+    def language(self, code: Optional[str]) -> str:
+        """Supported language for a Telegram language_code like 'ru' or 'pt-br'"""
+        language = self._resolved.get(code)
+        if language is None:
+            base = (code or "").split("-")[0].lower()
+            base = ALIASES.get(base, base)
+            language = self._resolved[code] = base if base in self.available else self.default
+        return language
+
+    def _load(self, language: str) -> Dict[str, Template]:
+        with open(os.path.join(self.directory, f"{language}.json"), encoding="utf-8") as f:
+            raw: Dict[str, str] = json.load(f)
+        templates = {}
+        for key, text in raw.items():
+            fields = _fields(text)
+            if language == self.default:
+                self._fields[key] = fields
+            elif key not in self._fields or not fields <= self._fields[key]:
+                # Перевод с чужими полями упал бы при рендере — берем английский
+                logger.warning(f"Skipping {language} template {key!r}: unknown key or fields")
+                continue
+            templates[key] = _compile(text)
+        self._locales[language] = templates
+        logger.info(f"Loaded {len(templates)} {language} message templates")
+        return templates
+
+    def render(self, language: str, key: str, **fields) -> str:
+        templates = self._locales.get(language)
+        if templates is None:
+            templates = self._load(language)
+        template = templates.get(key) or self._fallback[key]
+        return template(**fields)
+
+
+catalog = Catalog()
@@ -0,0 +1,221 @@
+"""Lightweight in-process metrics for handlers and outbound Bot API calls.
+
+Каждый зарегистрированный обработчик оборачивается: считаем вызовы,
+гистограмму задержек и исключения. Исходящие запросы к Bot API
+считаются по методу и исходу (HTTP-код или ошибка сети). Данные
+доступны в /stats и, по желанию, в формате Prometheus на отдельном порту.
+"""
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from telegram.ext import Application, ApplicationHandlerStop, BaseHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы задержек, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.api_calls: Dict[Tuple[str, str], int] = defaultdict(int)  # (метод, исход) -> сколько
+        self.counters: Dict[str, int] = defaultdict(int)  # прочие счетчики, например удаленные сессии
+        self.gauges: Dict[str, float] = {}  # разовые замеры, например время от старта до первого ответа
+
+    def wrap(self, name: str, callback: Callable) -> Callable:
+        """Wrap a handler callback to record calls, latency and escaped exceptions"""
+        calls, errors, latency = self.calls, self.errors, self.latency
+
+        @functools.wraps(callback)
+        async def instrumented(update, context):
+            started = time.perf_counter()
+            calls[name] += 1
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                # Штатный способ остановить обработку, а не ошибка
+                raise
+            except Exception:
+                errors[name] += 1
+                raise
+            finally:
+                latency[name].observe(time.perf_counter() - started)
+
+        instrumented.__wrapped_handler_name__ = name
+        return instrumented
+
+    def instrument_application(self, application: Application):
+        """Wrap every handler registered on the application, including conversation steps"""
+        for handler in iter_handlers(application):
+            if not hasattr(handler.callback, "__wrapped_handler_name__"):
+                handler.callback = self.wrap(handler.callback.__name__, handler.callback)
+
+    def record_api_call(self, method: str, outcome: str):
+        self.api_calls[(method, outcome)] += 1
+
+    def increment(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def render_text(self) -> str:
+        """Human-readable summary for /stats"""
+        uptime = int(time.time() - self.started)
+        lines = [f"📊 Uptime: {uptime // 3600}h {uptime % 3600 // 60}m", "", "Handlers (calls / errors / p50 / p99):"]
+        for name in sorted(self.calls, key=self.calls.get, reverse=True):
+            histogram = self.latency[name]
+            lines.append(
+                f"• {name}: {self.calls[name]} / {self.errors.get(name, 0)} / "
+                f"≤{histogram.quantile(0.5) * 1000:.0f} ms / ≤{histogram.quantile(0.99) * 1000:.0f} ms"
+            )
+        if self.api_calls:
+            lines += ["", "Bot API calls:"]
+            for (method, outcome), count in sorted(self.api_calls.items()):
+                lines.append(f"• {method} → {outcome}: {count}")
+        if self.counters:
+            lines += ["", "Other:"]
+            lines += [f"• {name}: {count}" for name, count in sorted(self.counters.items())]
+        if self.gauges:
+            lines += ["", "Measured:"]
+            lines += [f"• {name}: {value:.2f}" for name, value in sorted(self.gauges.items())]
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        lines = [
+            "# TYPE santa_handler_calls_total counter",
+            *(f'santa_handler_calls_total{{handler="{name}"}} {count}' for name, count in self.calls.items()),
+            "# TYPE santa_handler_errors_total counter",
+            *(f'santa_handler_errors_total{{handler="{name}"}} {count}' for name, count in self.errors.items()),
+            "# TYPE santa_handler_latency_seconds histogram",
+        ]
+        for name, histogram in self.latency.items():
+            cumulative = 0
+            for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f'santa_handler_latency_seconds_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'santa_handler_latency_seconds_sum{{handler="{name}"}} {histogram.total}')
+            lines.append(f'santa_handler_latency_seconds_count{{handler="{name}"}} {histogram.count}')
+        lines.append("# TYPE santa_api_calls_total counter")
+        for (method, outcome), count in self.api_calls.items():
+            lines.append(f'santa_api_calls_total{{method="{method}",outcome="{outcome}"}} {count}')
+        for name, count in self.counters.items():
+            lines.append(f"# TYPE santa_{name}_total counter")
+            lines.append(f"santa_{name}_total {count}")
+        for name, value in self.gauges.items():
+            lines.append(f"# TYPE santa_{name} gauge")
+            lines.append(f"santa_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def iter_handlers(application: Application) -> List[BaseHandler]:
+    """Every handler of the application, conversation steps included"""
+    return [handler for handlers in application.handlers.values() for handler in _walk(handlers)]
+
+
+def _walk(handlers: Iterable[BaseHandler]) -> List[BaseHandler]:
+    """Flatten conversation handlers into the handlers they contain"""
+    found = []
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            found.extend(_walk(nested))
+        else:
+            found.append(handler)
+    return found
+
+
+class ErrorLogCounter(logging.Handler):
+    """Counts ERROR records per function — handlers catch and log their own exceptions"""
+
+    def __init__(self, metrics: Metrics):
+        super().__init__(logging.ERROR)
+        self.metrics = metrics
+
+    def emit(self, record: logging.LogRecord):
+        self.metrics.errors[record.funcName] += 1
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the outcome of every Bot API call"""
+
+    def __init__(self, metrics: Metrics, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = metrics
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            self._metrics.record_api_call(api_method, type(e).__name__)
+            raise
+        self._metrics.record_api_call(api_method, str(code))
+        return code, payload
+
+
+async def serve_prometheus(metrics: Metrics, port: int) -> asyncio.AbstractServer:
+    """Serve GET /metrics on the given port"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            path = request_line.decode(errors="replace").split(" ")[1] if request_line else ""
+            if path.split("?")[0] == "/metrics":
+                body, status = metrics.render_prometheus().encode(), "200 OK"
+            else:
+                body, status = b"not found\n", "404 Not Found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "0.0.0.0", port)
+    logger.info(f"Prometheus metrics on :{port}/metrics")
+    return server
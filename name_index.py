@@ -0,0 +1,111 @@
+"""Index over participant names for duplicate and look-alike detection.
+
+Имя нормализуется (регистр, диакритика, пробелы и знаки препинания),
+так что "Ánna  K." и "anna k" — одно и то же имя; точные совпадения
+ищутся по словарю нормализованных имен. Для похожих имен ("Ana" и
+"Anna") имя режется на триграммы с отступами по краям, и для каждой
+триграммы хранится список слотов участников — array('i'), по 4 байта
+на запись. При переименовании старые записи не удаляются: каждый
+кандидат все равно проверяется по своему текущему имени, которое
+индекс хранит по слоту.
+
+Поиск похожих читает списки самых редких триграмм запроса (префиксная
+фильтрация): имя, похожее на запрос не меньше порога, обязано содержать
+хотя бы одну из них. Число проверяемых кандидатов ограничено, так что
+даже в огромном списке с одинаковыми именами запрос укладывается в
+доли миллисекунды — ценой того, что в таком вырожденном случае найдутся
+не все похожие имена, а только часть.
+"""
+import math
+import re
+import unicodedata
+from array import array
+from itertools import chain
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+# Порог схожести по коэффициенту Дайса: "Ana" и "Anna" — 0.67, "Anna" и "Hanna" — 0.55
+SIMILARITY = 0.6
+# Сколько кандидатов проверяем на один запрос
+CANDIDATE_BUDGET = 200
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(name: str) -> str:
+    """Comparable form of a name: 'Ánna  K.' and 'anna k' are the same key"""
+    key = name.casefold()
+    if not key.isascii():
+        key = "".join(ch for ch in unicodedata.normalize("NFKD", key) if not unicodedata.combining(ch))
+    return _SEPARATORS.sub(" ", key).strip()
+
+
+def trigrams(key: str) -> FrozenSet[str]:
+    padded = f"  {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NameIndex:
+    __slots__ = ("keys", "names", "postings")
+
+    def __init__(self):
+        self.keys: Dict[str, int] = {}  # нормализованное имя -> слот
+        self.names: List[Optional[str]] = []  # слот -> текущее нормализованное имя
+        self.postings: Dict[str, array] = {}  # триграмма -> слоты участников
+
+    def add(self, slot: int, name: str):
+        """Index ``name`` under ``slot``; adding a slot again renames it"""
+        key = normalize(name)
+        names = self.names
+        if slot >= len(names):
+            names.extend([None] * (slot + 1 - len(names)))
+        names[slot] = key
+        self.keys[key] = slot
+        postings = self.postings
+        for gram in trigrams(key):
+            posting = postings.get(gram)
+            if posting is None:
+                posting = postings[gram] = array("i")
+            posting.append(slot)
+
+    def find(self, name: str) -> Optional[int]:
+        """Slot of a participant with the same normalized name"""
+        key = normalize(name)
+        slot = self.keys.get(key)
+        # Запись могла остаться от старого имени переименованного участника
+        return slot if slot is not None and self.names[slot] == key else None
+
+    def similar(self, name: str, threshold: float = SIMILARITY, limit: int = 3) -> List[Tuple[float, int]]:
+        """(similarity, slot) of other names at least ``threshold`` alike, best first"""
+        key = normalize(name)
+        grams = trigrams(key)
+        size = len(grams)
+        # Общих триграмм не меньше t*|G|/(2-t), иначе Дайс не дотянет до порога при любой длине кандидата
+        needed = max(1, math.ceil(threshold * size / (2 - threshold) - 1e-9))
+        # И длина кандидата не может отличаться от запроса сколь угодно
+        shortest = threshold * size / (2 - threshold)
+        longest = (2 - threshold) * size / threshold
+        postings = [self.postings[gram] for gram in grams if gram in self.postings]
+        postings.sort(key=len)
+
+        names = self.names
+        seen = set()
+        found = []
+        for slot in chain.from_iterable(postings[:size - needed + 1]):
+            if slot in seen:
+                continue
+            if len(seen) >= CANDIDATE_BUDGET:
+                break
+            seen.add(slot)
+            other = names[slot]
+            # Триграмм у имени столько же, сколько символов плюс один (повторы редки)
+            other_size = len(other) + 1
+            if other == key or not shortest <= other_size <= longest:
+                continue
+            # Триграмма запроса есть у кандидата, если она встречается в его дополненной строке
+            padded = f"  {other} "
+            shared = sum(gram in padded for gram in grams)
+            score = 2 * shared / (size + other_size)
+            if score >= threshold:
+                found.append((score, slot))
+        found.sort(reverse=True)
+        return found[:limit]
@@ -0,0 +1,152 @@
+"""Polled updates that survive a restart: Telegram forgets an update only once it is processed.
+
+Telegram держит обновление, пока getUpdates не вызван со смещением
+больше его номера. PTB сдвигает смещение сразу, как только положил
+пачку в очередь, и если процесс убить в этот момент, обновления из
+очереди пропадут. ResumableBot подставляет в getUpdates смещение
+UpdateTracker — номер самого раннего обновления, которое еще не
+обработано до конца. Обновления, которые Telegram из-за этого пришлет
+повторно, отбрасываются: они уже в работе или уже обработаны.
+
+Трекер сохраняется в маленький файл: смещение и обработанные номера
+выше него. Новый процесс начинает с этого смещения и не повторяет
+обработанное, а то, что старый процесс не успел, получает заново.
+Между сохранениями (раз в секунду) обработанное может повториться,
+после штатной остановки — нет.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+from telegram import Update
+from telegram.error import Conflict
+from telegram.ext import ExtBot
+
+logger = logging.getLogger(__name__)
+
+# Если необработанное отстало от полученного сильнее, Telegram держит его без нас:
+# ответ getUpdates (до 100 штук) иначе целиком состоял бы из уже полученных обновлений
+MAX_UNCONFIRMED = 50
+# Пока старый процесс еще опрашивает Telegram, getUpdates отвечает Conflict; проверяем так часто
+CONFLICT_RETRY = 1.0
+# Пока ответ getUpdates состоит из обновлений в работе, ждем их окончания не дольше этого — за это время могли прийти новые
+BUSY_WAIT = 0.5
+
+
+class UpdateTracker:
+    """Which polled updates are fully processed"""
+
+    def __init__(self):
+        self.next_id = 0  # номер после последнего полученного обновления
+        self.in_flight: Set[int] = set()
+        self.done: Set[int] = set()  # обработанные выше еще не обработанного: Telegram пришлет их снова
+        self.stopped_at: Optional[float] = None  # когда остановился прошлый процесс
+        self.conflicted = False  # Telegram отвечает, что обновления забирает другой процесс
+        self.changed = False
+        self._moved: Optional[asyncio.Event] = None
+
+    @property
+    def offset(self) -> int:
+        """Lowest update id Telegram must keep for us"""
+        return min(self.in_flight) if self.in_flight else self.next_id
+
+    def request_offset(self) -> int:
+        offset = self.offset
+        if self.next_id - offset > MAX_UNCONFIRMED:
+            return self.next_id
+        return offset
+
+    def received(self, updates: List[Update]) -> List[Update]:
+        """Drop updates that are already being processed or done; track the rest"""
+        fresh = []
+        for update in updates:
+            update_id = update.update_id
+            if update_id in self.in_flight or update_id in self.done or update_id < self.offset:
+                continue
+            self.in_flight.add(update_id)
+            self.next_id = max(self.next_id, update_id + 1)
+            fresh.append(update)
+        return fresh
+
+    def finished(self, update_id: int):
+        if update_id not in self.in_flight:
+            # Обновление пришло не через getUpdates (вебхук) — следить не за чем
+            return
+        self.in_flight.discard(update_id)
+        self.done.add(update_id)
+        offset = self.offset
+        self.done = {done for done in self.done if done >= offset}
+        self.changed = True
+        if self._moved is not None:
+            self._moved.set()
+
+    async def wait(self, timeout: float):
+        """Sleep until some update finishes, at most ``timeout`` seconds"""
+        if self._moved is None:
+            self._moved = asyncio.Event()
+        self._moved.clear()
+        try:
+            await asyncio.wait_for(self._moved.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def checkpoint(self, stopped: bool = False) -> Dict:
+        """What save_checkpoint writes: the offset and processed ids above it; ``stopped`` marks a clean shutdown"""
+        self.changed = False
+        return {
+            "offset": self.offset,
+            "done": sorted(self.done),
+            "stopped_at": time.time() if stopped else None,
+        }
+
+    def load(self, path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        self.next_id = state["offset"]
+        self.done = set(state["done"])
+        self.stopped_at = state.get("stopped_at")
+        logger.info(f"Resuming updates from {self.next_id} ({len(self.done)} above it already processed)")
+
+
+class ResumableBot(ExtBot):
+    """ExtBot whose getUpdates confirms only updates the tracker has seen processed"""
+
+    def __init__(self, tracker: UpdateTracker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Bot запрещает новые атрибуты после конструктора
+        with self._unfrozen():
+            self.tracker = tracker
+
+    async def get_updates(self, offset: Optional[int] = None, limit: Optional[int] = None, timeout: Optional[int] = None, *args, **kwargs):
+        # Смещение PTB (после последнего полученного) заменяем своим (после последнего обработанного)
+        try:
+            updates = await super().get_updates(self.tracker.request_offset(), limit, timeout, *args, **kwargs)
+        except Conflict:
+            # PTB на ошибке растит паузу до 30 секунд — слишком долгая пересменка процессов
+            if not self.tracker.conflicted:
+                logger.info("Another process is still polling; waiting for it to stop")
+                self.tracker.conflicted = True
+            await asyncio.sleep(CONFLICT_RETRY)
+            return []
+        self.tracker.conflicted = False
+        fresh = self.tracker.received(updates)
+        if updates and not fresh and self.tracker.in_flight:
+            # Пришли только те, что еще в работе: без паузы опрос крутился бы вхолостую
+            await self.tracker.wait(BUSY_WAIT)
+        return fresh
+
+
+def save_checkpoint(path: str, state: Dict):
+    """Replace the checkpoint file atomically (safe to run in a thread: ``state`` is a plain copy)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
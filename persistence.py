@@ -0,0 +1,185 @@
+"""Write-ahead journal and snapshots for the bot's in-memory state.
+
+Каждое изменение SecretSantaData дописывается в journal.jsonl строкой
+[seq, op, args]. Записи копятся в памяти и сбрасываются на диск пачками
+с fsync в отдельном потоке, чтобы обработчики не ждали диск. Время от
+времени состояние целиком пишется в snapshot.json, а журнал обрезается.
+При старте читается снапшот, затем хвост журнала.
+
+Каталог принадлежит одному процессу: lock() ждет, пока предыдущий
+процесс (например, при выкатке новой версии) не завершится.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, List, Optional
+
+from storage import StorageBackend
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = "journal.jsonl"
+SNAPSHOT_FILE = "snapshot.json"
+LOCK_FILE = "journal.lock"
+
+
+class Journal(StorageBackend):
+    """Durable in-memory state: batched journal plus periodic snapshots in one directory"""
+
+    def __init__(self, directory: str, flush_interval: float = 0.05, snapshot_every: int = 5000):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.since_snapshot = 0
+        self._buffer: List[str] = []
+        self._dirty = asyncio.Event()
+        self._file_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._state = None
+        self._lock_file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def lock(self):
+        """Wait until no other process uses this directory, then hold it until this one exits"""
+        self._lock_file = open(os.path.join(self.directory, LOCK_FILE), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            started = time.perf_counter()
+            logger.info(f"{self.directory} is still used by the previous process; waiting for it to stop")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            logger.info(f"Got {self.directory} after {time.perf_counter() - started:.1f}s")
+
+    def load(self, state: Any):
+        """Restore ``state`` from the latest snapshot plus the journal tail"""
+        started = time.perf_counter()
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            snapshot_seq = snapshot["seq"]
+            state.load_dict(snapshot["state"])
+        self.seq = snapshot_seq
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        seq, op, args = json.loads(line)
+                    except ValueError:
+                        # Оборванная последняя строка после падения — дальше ничего нет
+                        logger.warning(f"Skipping torn journal record: {line[:80]!r}")
+                        break
+                    if seq <= snapshot_seq:
+                        continue
+                    state.replay(op, args)
+                    self.seq = seq
+                    replayed += 1
+        self.since_snapshot = replayed
+        self._state = state
+        state.journal = self
+        logger.info(
+            f"Recovered state at seq {self.seq} ({replayed} journal records) "
+            f"in {(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+
+    def append(self, op: str, args: Any):
+        """Queue a mutation; it reaches the disk on the next batched flush"""
+        self.seq += 1
+        self.since_snapshot += 1
+        self._buffer.append(json.dumps([self.seq, op, args], ensure_ascii=False))
+        self._dirty.set()
+
+    def _write(self, lines: List[str]):
+        with self._file_lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write_snapshot(self, payload: str, seq: int):
+        with self._file_lock:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            # Оставляем в журнале только записи новее снапшота
+            kept = []
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            if json.loads(line)[0] > seq:
+                                kept.append(line)
+                        except ValueError:
+                            break
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.journal_path)
+
+    async def flush(self):
+        """Write buffered records to disk off the event loop"""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except Exception:
+            # Возвращаем записи в очередь, чтобы попробовать еще раз
+            self._buffer[:0] = lines
+            raise
+
+    async def snapshot(self):
+        """Write a full snapshot and trim the journal"""
+        if self._state is None:
+            return
+        await self.flush()
+        # Состояние сериализуем в цикле событий, чтобы оно не менялось на ходу
+        seq = self.seq
+        payload = json.dumps({"seq": seq, "state": self._state.to_dict()}, ensure_ascii=False)
+        self.since_snapshot = 0
+        await asyncio.to_thread(self._write_snapshot, payload, seq)
+        logger.info(f"Snapshot written at seq {seq}")
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            # Небольшая пауза собирает соседние изменения в одну запись на диск
+            await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
+            try:
+                await self.flush()
+                if self.since_snapshot >= self.snapshot_every:
+                    await self.snapshot()
+            except Exception as e:
+                logger.error(f"Error writing journal: {e}", exc_info=True)
+
+    def start(self):
+        """Start the background flusher (call from inside the running event loop)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the flusher and leave a fresh snapshot behind"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.snapshot()
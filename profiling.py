@@ -0,0 +1,213 @@
+"""Opt-in profiling of handlers, switched on at runtime by the admin.
+
+Пока профилирование выключено, обработчики те же, что и всегда, —
+никаких проверок на каждом вызове. Profiler.start подменяет callback
+выбранных обработчиков на обертку, которая снимает cProfile (cpu) или
+разницу снимков tracemalloc (memory) для следующих N вызовов, а потом
+возвращает исходные callback на место и пишет отчет.
+
+Отчеты лежат в каталоге профилей, хранятся только последние ``keep``:
+текстовая сводка (самые горячие функции или места выделения памяти) и,
+для cpu, сырой .prof для snakeviz / pstats.
+
+cProfile включается на весь поток, поэтому пока профилируемый обработчик
+ждет сеть, в профиль попадает и все остальное, что крутит цикл событий.
+Одновременно снимается только один вызов, остальные идут как обычно.
+"""
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram.ext import Application, BaseHandler
+
+from metrics import iter_handlers
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cpu", "memory")
+# Сколько отчетов храним в каталоге; старые удаляются
+KEEP_REPORTS = 20
+# Сколько строк в сводке
+TOP = 25
+# Глубина стека у мест выделения памяти
+TRACE_FRAMES = 5
+# Снимки самого tracemalloc в отчете не нужны
+_NOT_TRACEMALLOC = (tracemalloc.Filter(False, tracemalloc.__file__),)
+
+
+def handler_name(handler: BaseHandler) -> str:
+    """Name a handler goes by in /stats"""
+    callback = handler.callback
+    return getattr(callback, "__wrapped_handler_name__", callback.__name__)
+
+
+class _Session:
+    __slots__ = (
+        "mode", "names", "remaining", "calls", "busy", "durations", "stats",
+        "allocations", "peak", "tracing", "originals",
+    )
+
+    def __init__(self, mode: str, names: List[str], calls: int):
+        self.mode = mode
+        self.names = names
+        self.remaining = calls
+        self.calls = 0
+        self.busy = False
+        self.durations: List[float] = []
+        self.stats: Optional[pstats.Stats] = None
+        self.allocations: Dict[str, List[int]] = defaultdict(lambda: [0, 0])  # место -> [байты, блоки]
+        self.peak = 0
+        self.tracing = False  # tracemalloc запустили мы, нам и останавливать
+        self.originals: List[Tuple[BaseHandler, Callable]] = []
+
+
+class Profiler:
+    """Profiles the next N calls of chosen handlers and writes a report"""
+
+    def __init__(self, directory: str, keep: int = KEEP_REPORTS):
+        self.directory = directory
+        self.keep = keep
+        self.session: Optional[_Session] = None
+
+    @property
+    def active(self) -> bool:
+        return self.session is not None
+
+    def start(
+        self,
+        application: Application,
+        names: List[str],
+        calls: int,
+        mode: str,
+        on_done: Callable[[Optional[str]], Awaitable[Any]],
+    ) -> List[str]:
+        """Swap in profiling wrappers; return the requested names that match no handler
+
+        ``on_done(path)`` runs as a task once the last call is measured.
+        """
+        handlers = [handler for handler in iter_handlers(application) if handler_name(handler) in names]
+        found = {handler_name(handler) for handler in handlers}
+        missing = [name for name in names if name not in found]
+        if missing:
+            return missing
+        session = self.session = _Session(mode, names, calls)
+        for handler in handlers:
+            session.originals.append((handler, handler.callback))
+            handler.callback = self._wrap(session, handler.callback, application, on_done)
+        logger.info(f"Profiling ({mode}) the next {calls} calls of {', '.join(names)}")
+        return []
+
+    def _wrap(self, session: _Session, callback: Callable, application: Application, on_done) -> Callable:
+        @functools.wraps(callback)
+        async def profiled(update, context):
+            if session.busy or session.remaining <= 0:
+                return await callback(update, context)
+            session.busy = True
+            session.remaining -= 1
+            try:
+                if session.mode == "cpu":
+                    return await self._measure_cpu(session, callback, update, context)
+                return await self._measure_memory(session, callback, update, context)
+            finally:
+                session.busy = False
+                session.calls += 1
+                if session.remaining <= 0 and self.session is session:
+                    application.create_task(on_done(self.stop()))
+
+        return profiled
+
+    async def _measure_cpu(self, session: _Session, callback, update, context):
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            return await callback(update, context)
+        finally:
+            profile.disable()
+            session.durations.append(time.perf_counter() - started)
+            if session.stats is None:
+                session.stats = pstats.Stats(profile)
+            else:
+                session.stats.add(profile)
+
+    async def _measure_memory(self, session: _Session, callback, update, context):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            session.tracing = True
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot().filter_traces(_NOT_TRACEMALLOC)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            session.durations.append(time.perf_counter() - started)
+            # Профилирование могли выключить, пока обработчик работал
+            if tracemalloc.is_tracing():
+                session.peak = max(session.peak, tracemalloc.get_traced_memory()[1])
+                after = tracemalloc.take_snapshot().filter_traces(_NOT_TRACEMALLOC)
+                for diff in after.compare_to(before, "traceback"):
+                    if diff.size_diff > 0:
+                        frame = diff.traceback[-1]
+                        totals = session.allocations[f"{frame.filename}:{frame.lineno}"]
+                        totals[0] += diff.size_diff
+                        totals[1] += diff.count_diff
+
+    def stop(self) -> Optional[str]:
+        """Put the original callbacks back; return the report path, or None if nothing was measured"""
+        session, self.session = self.session, None
+        if session is None:
+            return None
+        for handler, callback in session.originals:
+            handler.callback = callback
+        if session.tracing:
+            tracemalloc.stop()
+        if not session.calls:
+            return None
+        return self._write_report(session)
+
+    def _write_report(self, session: _Session) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.directory, f"{stamp}-{session.mode}-{'+'.join(session.names)}")
+        durations = sorted(session.durations)
+        out = io.StringIO()
+        out.write(
+            f"{session.mode} profile of {', '.join(session.names)}: {session.calls} calls, "
+            f"median {durations[len(durations) // 2] * 1000:.1f} ms, max {durations[-1] * 1000:.1f} ms\n\n"
+        )
+        if session.stats is not None:
+            session.stats.dump_stats(base + ".prof")
+            session.stats.stream = out
+            out.write("Top functions by cumulative time:\n")
+            session.stats.sort_stats("cumulative").print_stats(TOP)
+            out.write("Top functions by own time:\n")
+            session.stats.sort_stats("tottime").print_stats(TOP)
+        else:
+            out.write(f"Peak traced memory: {session.peak / 1024:.1f} KiB\n")
+            out.write("Top allocation sites still held after the calls (KiB / blocks):\n")
+            top = sorted(session.allocations.items(), key=lambda item: item[1][0], reverse=True)[:TOP]
+            for site, (size, count) in top:
+                out.write(f"{size / 1024:10.1f} {count:8d}  {site}\n")
+        path = base + ".txt"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        self._rotate()
+        logger.info(f"Profile written to {path}")
+        return path
+
+    def _rotate(self):
+        """Keep only the newest reports (a report is its .txt plus an optional .prof)"""
+        reports = sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith(".txt"))
+        for base in reports[:-self.keep]:
+            for ext in (".txt", ".prof"):
+                try:
+                    os.remove(os.path.join(self.directory, base + ext))
+                except FileNotFoundError:
+                    pass
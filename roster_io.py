@@ -0,0 +1,228 @@
+"""Bulk roster import and export as CSV / JSON.
+
+Файл читается потоково, строка за строкой: CSV с заголовком, JSON Lines
+(один объект на строку) или JSON-массив объектов — его элементы
+разбираются по одному, весь массив в памяти не собирается. Экспорт
+пишет те же поля (плюс gives_to) строка за строкой, так что выгрузку
+можно загрузить обратно. Поля строки:
+
+    type             adult | child (по умолчанию adult)
+    name             имя участника
+    recommendations  пожелания (необязательно)
+    user_id          Telegram ID взрослого
+    guardian_id      Telegram ID опекуна ребенка, или
+    guardian         имя опекуна (взрослого из файла или уже зарегистрированного)
+    gives_to         только в экспорте: кому дарит участник (или печать HMAC)
+
+Имена сравниваются так же, как при регистрации (name_index.normalize):
+"Anna" и "anna " или "Ánna" — одно имя.
+"""
+import csv
+import hashlib
+import hmac
+import json
+import re
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, TextIO, Tuple
+
+from name_index import normalize
+
+MIN_NAME_LENGTH = 2
+# Сколько символов читать за раз при разборе JSON-массива
+READ_CHUNK = 64 * 1024
+NOT_SPACE = re.compile(r"\S")
+EXPORT_FIELDS = ("type", "name", "recommendations", "user_id", "guardian_id", "guardian", "gives_to")
+
+
+@dataclass
+class ImportResult:
+    adults: List[Tuple[int, str, str]] = field(default_factory=list)  # (user_id, name, recommendations)
+    children: List[Tuple[str, int, str]] = field(default_factory=list)  # (name, guardian_id, recommendations)
+    # (номер строки, причина, ее поля): причина — ключ import.reason.* в каталоге текстов
+    rejected: List[Tuple[int, str, Dict[str, Any]]] = field(default_factory=list)
+
+
+def _array_items(text: TextIO) -> Iterator[Any]:
+    """Decode the elements of a JSON array (its "[" already read) one at a time"""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def more() -> bool:
+        # Дочитываем блок; разобранное начало буфера отбрасываем
+        nonlocal buffer, pos, eof
+        chunk = text.read(READ_CHUNK)
+        eof = not chunk
+        buffer, pos = buffer[pos:] + chunk, 0
+        return not eof
+
+    def next_char() -> str:
+        nonlocal pos
+        while True:
+            match = NOT_SPACE.search(buffer, pos)
+            if match:
+                pos = match.start()
+                return buffer[pos]
+            pos = len(buffer)
+            if not more():
+                raise ValueError("Unterminated JSON array")
+
+    if next_char() == "]":
+        return
+    while True:
+        next_char()
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Элемент еще не дочитан; в конце файла — битый JSON
+            if not more():
+                raise
+            continue
+        if end == len(buffer) and more():
+            # Число или литерал мог оборваться на границе блока — дочитываем и разбираем заново
+            continue
+        pos = end
+        yield item
+        separator = next_char()
+        pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or ']' in JSON array, got {separator!r}")
+
+
+def _rows(path: str, filename: str) -> Iterator[Tuple[int, Dict]]:
+    """Yield (row number, row dict) without materialising the whole file"""
+    with open(path, encoding="utf-8-sig", newline="") as text:
+        if filename.lower().endswith(".csv"):
+            # Номер строки в файле, считая заголовок первой
+            for number, row in enumerate(csv.DictReader(text), 2):
+                yield number, row
+            return
+
+        head = text.read(1)
+        while head.isspace():
+            head = text.read(1)
+        if head == "[":
+            # Массив разбираем поэлементно, в памяти только текущий блок файла
+            for number, row in enumerate(_array_items(text), 1):
+                yield number, row
+            return
+        for number, line in enumerate(chain([head + text.readline()], text), 1):
+            if line.strip():
+                yield number, json.loads(line)
+
+
+def parse_roster(
+    path: str,
+    filename: str,
+    registered_names: Set[str],
+    adult_ids_by_name: Mapping[str, int],
+) -> ImportResult:
+    """Validate an uploaded roster file against itself and a snapshot of the current game
+
+    ``filename`` is the name it was uploaded under; its extension picks the format. The caller must check the names again under the game lock: people may register meanwhile.
+    """
+    result = ImportResult()
+    names = {normalize(name) for name in registered_names}
+    user_ids = set(adult_ids_by_name.values())
+    guardians: Dict[str, int] = {normalize(name): user_id for name, user_id in adult_ids_by_name.items()}
+    pending_children = []
+
+    try:
+        for number, row in _rows(path, filename):
+            if not isinstance(row, dict):
+                result.rejected.append((number, "not_object", {}))
+                continue
+            kind = str(row.get("type") or "adult").strip().lower()
+            name = str(row.get("name") or "").strip()
+            recommendations = str(row.get("recommendations") or "").strip()
+            if len(name) < MIN_NAME_LENGTH:
+                result.rejected.append((number, "short_name", {}))
+                continue
+            key = normalize(name)
+            if key in names:
+                result.rejected.append((number, "name_taken", {"name": name}))
+                continue
+
+            if kind == "adult":
+                try:
+                    user_id = int(row.get("user_id"))
+                except (TypeError, ValueError):
+                    result.rejected.append((number, "bad_user_id", {"name": name}))
+                    continue
+                if user_id in user_ids:
+                    result.rejected.append((number, "user_taken", {"name": name, "user_id": user_id}))
+                    continue
+                names.add(key)
+                user_ids.add(user_id)
+                guardians[key] = user_id
+                result.adults.append((user_id, name, recommendations))
+            elif kind == "child":
+                # Опекун может идти ниже по файлу, поэтому разбираем детей в конце
+                names.add(key)
+                pending_children.append((number, name, row, recommendations))
+            else:
+                result.rejected.append((number, "unknown_type", {"name": name, "kind": kind}))
+    except (ValueError, csv.Error) as e:
+        # Битый JSON или CSV — все, что прочитали до ошибки, остается в силе
+        result.rejected.append((0, "malformed", {"error": str(e)}))
+
+    for number, name, row, recommendations in pending_children:
+        guardian_id = row.get("guardian_id")
+        try:
+            guardian_id = int(guardian_id) if guardian_id not in (None, "") else guardians[normalize(str(row.get("guardian", "")))]
+        except (KeyError, TypeError, ValueError):
+            guardian_id = None
+        if guardian_id not in user_ids:
+            names.discard(normalize(name))
+            result.rejected.append((number, "no_guardian", {"name": name}))
+            continue
+        result.children.append((name, guardian_id, recommendations))
+    return result
+
+
+def derive_seal_key(token: str) -> bytes:
+    """Default seal key when EXPORT_SECRET is unset, derived from the bot token under its own label"""
+    # Голый sha256(токена) — это секрет вебхука по умолчанию, он ходит в заголовках запросов
+    return hmac.new(token.encode(), b"roster-seal", hashlib.sha256).digest()
+
+
+def make_seal(secret: bytes) -> Callable[[str, str], str]:
+    """Seal for a (giver, receiver) pair: hides the pair but lets whoever holds the secret check a claim"""
+
+    def seal(giver: str, receiver: str) -> str:
+        return hmac.new(secret, f"{giver}\n{receiver}".encode(), hashlib.sha256).hexdigest()[:16]
+
+    return seal
+
+
+# Участник в выгрузке — снимок полей, а не живая запись игры:
+# (name, recommendations, user_id, guardian_id, guardian, gives_to); у взрослых guardian_id — None
+ExportRecord = Tuple[str, str, Optional[int], Optional[int], Optional[str], Optional[str]]
+
+
+def export_rows(records: Iterable[ExportRecord], seal: Optional[Callable[[str, str], str]] = None) -> Iterator[Dict]:
+    """Yield one export row per participant snapshot"""
+    for name, recommendations, user_id, guardian_id, guardian, receiver in records:
+        row = {"type": "adult" if guardian_id is None else "child", "name": name, "recommendations": recommendations}
+        if guardian_id is not None:
+            row["guardian_id"] = guardian_id
+            row["guardian"] = guardian
+        else:
+            row["user_id"] = user_id
+        if receiver is not None:
+            row["gives_to"] = seal(name, receiver) if seal else receiver
+        yield row
+
+
+def write_export(path: str, rows: Iterable[Dict], fmt: str):
+    """Write rows to ``path`` one at a time as CSV or JSON Lines"""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, EXPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
@@ -1,17 +1,48 @@
 import os
-import random
+import asyncio
+import contextlib
+import functools
+import hashlib
 import logging
-from typing import Dict, List, Set
+import random
+import secrets
+import tempfile
+import time
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AbstractSet, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Chat, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
+    TypeHandler,
     filters,
     ContextTypes,
 )
+from telegram.request import HTTPXRequest
+from admission import Admission
+from archive import Season, SeasonArchive
+from delivery import Deliverer, DeliveryReport, OutgoingMessage
+from matching import AssignmentError, solve
+from metrics import ErrorLogCounter, InstrumentedRequest, Metrics, iter_handlers, serve_prometheus
+from messages import DEFAULT_LANGUAGE, catalog
+from name_index import NameIndex
+from offsets import ResumableBot, UpdateTracker, save_checkpoint
+from persistence import Journal
+from profiling import MODES, Profiler, handler_name
+from storage import Conflict, MemoryBackend, SQLiteBackend
+from roster_io import ExportRecord, derive_seal_key, export_rows, make_seal, parse_roster, write_export
 
 # Загружаем переменные окружения из .env (для локального запуска)
 # На Railway переменные окружения доступны напрямую через os.getenv()
@@ -25,147 +56,1354 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Состояния для ConversationHandler
-REGISTERING_ADULT, ASKING_RECOMMENDATIONS, REGISTERING_CHILD, ASKING_CHILD_RECOMMENDATIONS, WAITING_FOR_CHILD_GUARDIAN = range(5)
+(
+    REGISTERING_ADULT, ASKING_RECOMMENDATIONS, REGISTERING_CHILD, ASKING_CHILD_RECOMMENDATIONS, WAITING_FOR_CHILD_GUARDIAN,
+    ASKING_PHOTO, ASKING_CHILD_PHOTO,
+) = range(7)
+
+# Лимит Telegram — 4096 символов; запас оставляем под номер страницы
+ROSTER_PAGE_BYTES = 3900
+
+# Бот может скачать файл не больше 20 МБ; в отчете об импорте показываем первые ошибки
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+IMPORT_REJECTS_SHOWN = 20
+
+# Сколько раз повторяем изменение, если другая реплика успела изменить игру раньше
+COMMIT_ATTEMPTS = 5
+
+T = TypeVar("T")
+
+# Как часто обновляем сообщение о ходе рассылки, в секундах
+PROGRESS_INTERVAL = 3.0
+
+# Один общий тик расписания на все игры, в секундах: никаких таймеров на каждую игру
+SCHEDULE_TICK = 60
+DAY = 24 * 3600
+# Волны напоминаний перед обменом подарками: (за сколько секунд, ключ текста в каталоге)
+REMINDER_WAVES = ((7 * DAY, "reminder.upcoming"), (DAY, "reminder.final"))
+
+# Виды сообщений в outbox: задание (возможно, обернутое в текст каталога) и просто текст каталога
+OUTGOING_MISSION = "mission"
+OUTGOING_TEXT = "text"
+# По столько адресатов в одной записи журнала: большая рассылка не пишет одну огромную строку
+OUTBOX_CHUNK = 5000
+# Рассылка отчитывается в outbox о доставленном так часто, в секундах; при сбое повторится не больше этого
+CHECKPOINT_INTERVAL = 1.0
+# Файлы в DATA_DIR, по которым новый процесс продолжает с того места, где остановился старый
+UPDATES_FILE = "updates.json"
+CONVERSATIONS_FILE = "conversations.pickle"
+# Как часто диалоги регистрации сбрасываются в CONVERSATIONS_FILE, в секундах
+CONVERSATIONS_FLUSH = 10
+
+# Сколько случайных мест в цикле пробуем для опоздавшего, прежде чем перебрать всех
+SPLICE_ATTEMPTS = 32
+
+@dataclass(slots=True)
+class Participant:
+    """One player: an adult with Telegram, or a kid registered by a guardian"""
+    id: int  # user_id у взрослых, -1, -2, ... у детей
+    name: str
+    recommendations: str
+    guardian_id: Optional[int] = None  # только у детей
+    slot: int = -1  # плотный номер: индекс в roster и в массиве назначений
+    photo: str = ""  # file_id фото к пожеланиям: сами байты лежат у Telegram, не у нас
+    lang: str = DEFAULT_LANGUAGE  # язык каталога, на котором взрослому уходят рассылки без входящего сообщения
+    
+    @property
+    def type(self) -> str:
+        return "adult" if self.guardian_id is None else "child"
+    
+    @property
+    def user_id(self) -> int:
+        """Telegram user who gets this participant's mission: the adult, or the kid's guardian"""
+        return self.id if self.guardian_id is None else self.guardian_id
+
 
 # Хранилище данных
 class SecretSantaData:
+    __slots__ = (
+        "adults", "children", "roster", "assigned", "by_name", "children_by_guardian",
+        "exclusions", "previous_pairings", "receiver", "late_join", "deadline", "exchange_at", "reminded", "assigned_at",
+        "outbox", "outbox_next", "outbox_seen", "missions", "roster_pages", "name_index", "journal",
+    )
+    
     def __init__(self):
-        self.adults: Dict[int, Dict] = {}  # user_id -> {"name": str, "recommendations": str}
-        self.children: List[Dict] = []  # [{"name": str, "guardian_id": int}]
-        self.assignments: Dict[int, List[Dict]] = {}  # user_id -> [{"gives_to": str, "type": "adult"/"child", "giver_name": str}]
+        self.adults: Dict[int, Participant] = {}  # user_id -> взрослый
+        self.children: List[Participant] = []  # дети в порядке регистрации, id ребенка = -(индекс + 1)
+        # Все участники по плотному номеру slot; записи никогда не удаляются, кроме /reset
+        self.roster: List[Participant] = []
         self.assigned = False
+        # Индексы: имя -> запись, опекун -> дети
+        self.by_name: Dict[str, Participant] = {}
+        self.children_by_guardian: Dict[int, List[Participant]] = {}
+        # Ограничения: participant_id -> кого он не может вытянуть
+        self.exclusions: Dict[int, Set[int]] = {}
+        # Пары прошлого года (giver_name, receiver_name) — переживают /reset
+        self.previous_pairings: AbstractSet[Tuple[str, str]] = frozenset()
+        # Назначения: receiver[slot дарящего] = slot получателя, -1 — нет назначения
+        self.receiver = array("i")
+        # Админ разрешил регистрацию после жеребьевки: новички встраиваются в готовый цикл
+        self.late_join = False
+        # Расписание (Unix time): когда жеребьевка пройдет сама и когда обмен подарками
+        self.deadline: Optional[float] = None
+        self.exchange_at: Optional[float] = None
+        self.reminded = 0  # сколько волн напоминаний из REMINDER_WAVES уже позади
+        self.assigned_at: Optional[float] = None  # когда прошла жеребьевка; в старых журналах неизвестно
+        # Исходящие, которые еще не доставлены: номер пачки -> [процесс-отправитель, вид, параметры, chat_id].
+        # Хранится не текст, а что отправить — текст рендерится при отправке (см. render_outgoing).
+        # Переживают рестарт: что не успел отправить старый процесс, досылает новый
+        self.outbox: Dict[int, List] = {}
+        self.outbox_next = 1  # номера пачек не переиспользуются, даже после /reset
+        self.outbox_seen: Dict[str, float] = {}  # процесс -> когда он последний раз отчитывался о рассылке
+        # язык -> user_id -> готовый текст задания в UTF-8: с эмодзи str хранит 4 байта на символ, bytes — втрое меньше
+        self.missions: Dict[str, Dict[int, bytes]] = {}
+        self.roster_pages: Dict[str, List[str]] = {}  # язык -> отрендеренные страницы /who_are_we
+        # Триграммный индекс имен для предупреждений о дублях; строится при первом запросе, не при загрузке
+        self.name_index: Optional[NameIndex] = None
+        # Журнал изменений (persistence.Journal), если включено сохранение на диск
+        self.journal = None
     
-    def add_adult(self, user_id: int, name: str, recommendations: str = ""):
-        self.adults[user_id] = {"name": name, "recommendations": recommendations}
+    def _record(self, op: str, *args):
+        if self.journal is not None:
+            self.journal.append(op, args)
+    
+    # Операции, которые пишутся в журнал и воспроизводятся при старте
+    JOURNALED_OPS = (
+        "add_adult", "add_child", "bulk_add", "add_exclusion", "set_previous_pairings", "reset",
+        "apply_assignments", "set_late_join", "splice", "set_deadline", "set_exchange", "mark_reminded", "set_language",
+        "queue_outgoing", "settle_outgoing", "release_outgoing", "claim_outgoing",
+    )
+    
+    def replay(self, op: str, args: List):
+        """Apply one journal record"""
+        if op not in self.JOURNALED_OPS:
+            raise ValueError(f"Unknown journal operation: {op}")
+        getattr(self, op)(*args)
+    
+    def to_dict(self) -> Dict:
+        """Compact snapshot of the whole state"""
+        return {
+            "adults": [[a.id, a.name, a.recommendations, a.photo, a.lang] for a in self.adults.values()],
+            "children": [[c.id, c.name, c.guardian_id, c.recommendations, c.photo] for c in self.children],
+            "next_child_id": -len(self.children) - 1,
+            "exclusions": [[giver_id, sorted(receivers)] for giver_id, receivers in self.exclusions.items()],
+            "previous_pairings": sorted(self.previous_pairings),
+            "receiver_of": list(self.assignment_pairs()) if self.assigned else None,
+            "late_join": self.late_join,
+            "deadline": self.deadline,
+            "exchange_at": self.exchange_at,
+            "reminded": self.reminded,
+            "assigned_at": self.assigned_at,
+            "outbox": [[batch, owner, kind, extra, sorted(chat_ids)] for batch, (owner, kind, extra, chat_ids) in self.outbox.items()],
+            "outbox_next": self.outbox_next,
+            "outbox_seen": list(self.outbox_seen.items()),
+        }
+    
+    def load_dict(self, state: Dict):
+        """Restore state written by to_dict"""
+        self.reset()
+        # id детей восстанавливаются сами: они идут подряд в порядке регистрации; в старых снапшотах нет фото и языка
+        self.bulk_add(
+            [tuple(adult) for adult in state["adults"]],
+            [(name, guardian_id, recommendations, *photo) for _, name, guardian_id, recommendations, *photo in state["children"]],
+        )
+        for giver_id, receivers in state["exclusions"]:
+            self.exclusions[giver_id] = set(receivers)
+        self.previous_pairings = frozenset(tuple(pair) for pair in state["previous_pairings"])
+        if state["receiver_of"] is not None:
+            self.apply_assignments(state["receiver_of"], state.get("assigned_at"))
+        self.late_join = state.get("late_join", False)
+        self.deadline = state.get("deadline")
+        self.exchange_at = state.get("exchange_at")
+        self.reminded = state.get("reminded", 0)
+        self.outbox = {
+            batch: [owner, kind, extra, set(chat_ids)] for batch, owner, kind, extra, chat_ids in state.get("outbox", [])
+        }
+        self.outbox_next = state.get("outbox_next", 1)
+        self.outbox_seen = dict(state.get("outbox_seen", []))
+    
+    def add_adult(self, user_id: int, name: str, recommendations: str = "", photo: str = "", lang: str = DEFAULT_LANGUAGE):
+        self._record("add_adult", user_id, name, recommendations, photo, lang)
+        self._roster_changed()
+        self._insert_adult(user_id, name, recommendations, photo, lang)
+    
+    def _insert_adult(self, user_id: int, name: str, recommendations: str, photo: str = "", lang: str = DEFAULT_LANGUAGE):
+        adult = self.adults.get(user_id)
+        if adult is None:
+            adult = Participant(user_id, name, recommendations, slot=len(self.roster), photo=photo, lang=lang)
+            self.adults[user_id] = adult
+            self.roster.append(adult)
+        else:
+            # Повторная регистрация обновляет запись на месте, slot не меняется
+            if self.by_name.get(adult.name) is adult:
+                del self.by_name[adult.name]
+            adult.name = name
+            adult.recommendations = recommendations
+            adult.photo = photo
+            adult.lang = lang
+            # Имя и пожелания есть в задании того, кто дарит этому взрослому
+            self.missions.clear()
+        self.by_name[name] = adult
+        if self.name_index is not None:
+            self.name_index.add(adult.slot, name)
+    
+    def set_language(self, user_id: int, lang: str):
+        """Remember the language an adult now talks to the bot in"""
+        self._record("set_language", user_id, lang)
+        adult = self.adults.get(user_id)
+        if adult is not None:
+            adult.lang = lang
+    
+    def language_of(self, user_id: int) -> str:
+        """Language for messages sent to a user without an incoming update, e.g. broadcasts"""
+        adult = self.adults.get(user_id)
+        return adult.lang if adult is not None else DEFAULT_LANGUAGE
     
     def get_adult_name(self, user_id: int) -> str:
         """Get adult name by user_id"""
-        return self.adults.get(user_id, {}).get("name", "")
+        adult = self.adults.get(user_id)
+        return adult.name if adult is not None else ""
+    
+    def add_child(self, name: str, guardian_id: int, recommendations: str = "", photo: str = ""):
+        self._record("add_child", name, guardian_id, recommendations, photo)
+        self._roster_changed()
+        self._insert_child(name, guardian_id, recommendations, photo)
+    
+    def _insert_child(self, name: str, guardian_id: int, recommendations: str, photo: str = ""):
+        child = Participant(-len(self.children) - 1, name, recommendations, guardian_id, len(self.roster), photo)
+        self.children.append(child)
+        self.roster.append(child)
+        self.by_name[name] = child
+        self.children_by_guardian.setdefault(guardian_id, []).append(child)
+        if self.name_index is not None:
+            self.name_index.add(child.slot, name)
+    
+    def bulk_add(self, adults: List[Tuple], children: List[Tuple]):
+        """Add many participants at once — one journal record and one cache reset for the whole batch
+
+        Adults are (user_id, name, recommendations[, photo[, lang]]), children (name, guardian_id, recommendations[, photo]).
+        """
+        self._record("bulk_add", adults, children)
+        self._roster_changed()
+        for adult in adults:
+            self._insert_adult(*adult)
+        for child in children:
+            self._insert_child(*child)
+    
+    def get_participant(self, participant_id: int) -> Optional[Participant]:
+        """Find participant record by id"""
+        if participant_id < 0:
+            index = -participant_id - 1
+            return self.children[index] if index < len(self.children) else None
+        return self.adults.get(participant_id)
     
-    def add_child(self, name: str, guardian_id: int, recommendations: str = ""):
-        self.children.append({"name": name, "guardian_id": guardian_id, "recommendations": recommendations})
+    def _roster_changed(self):
+        """Drop everything rendered from the roster
+
+        Missions stay cached: a new participant changes nobody's mission until spliced in.
+        """
+        self.roster_pages.clear()
+    
+    def get_roster_pages(self, language: str = DEFAULT_LANGUAGE) -> List[str]:
+        """/who_are_we text split into pages that fit a Telegram message, cached until the roster changes"""
+        pages = self.roster_pages.get(language)
+        if pages is None:
+            pages = self.roster_pages[language] = self._render_roster_pages(language)
+        return pages
+    
+    def _render_roster_pages(self, language: str) -> List[str]:
+        render = catalog.render
+        
+        def lines():
+            yield render(language, "roster.header")
+            if self.adults:
+                yield render(language, "roster.adults")
+                for i, adult in enumerate(self.adults.values(), 1):
+                    yield render(language, "roster.adult", number=i, name=adult.name)
+                yield "\n"
+            if self.children:
+                yield render(language, "roster.kids")
+                unknown = render(language, "roster.unknown_guardian")
+                for i, child in enumerate(self.children, 1):
+                    guardian = self.adults.get(child.guardian_id)
+                    guardian_name = guardian.name if guardian is not None else unknown
+                    yield render(language, "roster.kid", number=i, name=child.name, guardian=guardian_name)
+            yield render(language, "roster.total", adults=len(self.adults), kids=len(self.children))
+        
+        # Режем по байтам UTF-8: их всегда не меньше, чем UTF-16-символов, которые считает Telegram
+        pages: List[str] = []
+        current: List[str] = []
+        size = 0
+        for line in lines():
+            encoded = line.encode("utf-8")
+            if len(encoded) > ROSTER_PAGE_BYTES:
+                line = encoded[:ROSTER_PAGE_BYTES - 4].decode("utf-8", "ignore") + "…\n"
+                encoded = line.encode("utf-8")
+            if size + len(encoded) > ROSTER_PAGE_BYTES and current:
+                pages.append("".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(encoded)
+        pages.append("".join(current))
+        return pages
+    
+    def get_participant_by_name(self, name: str) -> Optional[Participant]:
+        """Find participant record by name"""
+        return self.by_name.get(name)
+    
+    def _names(self) -> NameIndex:
+        if self.name_index is None:
+            self.name_index = NameIndex()
+            for participant in self.roster:
+                self.name_index.add(participant.slot, participant.name)
+        return self.name_index
+    
+    def name_taken(self, name: str) -> Optional[Participant]:
+        """Participant already registered under this name, ignoring case, accents and punctuation"""
+        slot = self._names().find(name)
+        return self.roster[slot] if slot is not None else None
+    
+    def similar_names(self, name: str, limit: int = 3) -> List[Participant]:
+        """Participants whose names look like this one ('Ana' and 'Anna'), most alike first"""
+        return [self.roster[slot] for _, slot in self._names().similar(name, limit=limit)]
+    
+    def add_exclusion(self, giver_id: int, receiver_id: int):
+        """Forbid giver from drawing receiver"""
+        self._record("add_exclusion", giver_id, receiver_id)
+        self.exclusions.setdefault(giver_id, set()).add(receiver_id)
+    
+    def add_couple(self, first_id: int, second_id: int):
+        """Partners never draw each other"""
+        self.add_exclusion(first_id, second_id)
+        self.add_exclusion(second_id, first_id)
+    
+    def set_previous_pairings(self, pairings: Iterable[Tuple[str, str]]):
+        """Remember last season's (giver_name, receiver_name) pairs so they aren't repeated"""
+        previous_pairings = frozenset(tuple(pair) for pair in pairings)
+        self._record("set_previous_pairings", sorted(previous_pairings))
+        self.previous_pairings = previous_pairings
+    
+    def build_constraints(self) -> Dict[int, Set[int]]:
+        """Collect every rule into participant_id -> forbidden receivers"""
+        blocked = {giver_id: set(receivers) for giver_id, receivers in self.exclusions.items()}
+        # Опекун не дарит своему ребенку
+        for guardian_id, kids in self.children_by_guardian.items():
+            if guardian_id in self.adults:
+                blocked.setdefault(guardian_id, set()).update(child.id for child in kids)
+        for giver_name, receiver_name in self.previous_pairings:
+            giver = self.by_name.get(giver_name)
+            receiver = self.by_name.get(receiver_name)
+            if giver is not None and receiver is not None:
+                blocked.setdefault(giver.id, set()).add(receiver.id)
+        return blocked
     
     def get_all_participants(self) -> List[str]:
         """Возвращает список всех участников (взрослые + дети)"""
-        participants = [adult["name"] for adult in self.adults.values()]
-        participants.extend([child["name"] for child in self.children])
+        participants = [adult.name for adult in self.adults.values()]
+        participants.extend([child.name for child in self.children])
         return participants
     
+    def reset(self):
+        """Clear roster, indexes and assignments"""
+        self._record("reset")
+        self.adults.clear()
+        self.children.clear()
+        self.roster.clear()
+        self.by_name.clear()
+        self.children_by_guardian.clear()
+        self.name_index = None
+        self.exclusions.clear()
+        self.receiver = array("i")
+        self.missions.clear()
+        self._roster_changed()
+        self.assigned = False
+        self.late_join = False
+        self.deadline = None
+        self.exchange_at = None
+        self.reminded = 0
+        self.assigned_at = None
+        # Недоставленное относится к стертому сезону
+        self.outbox.clear()
+        self.outbox_seen.clear()
+    
     def make_assignments(self):
-        """Создает назначения Secret Santa"""
+        """Создает назначения Secret Santa
+
+        Raises AssignmentError when the constraints can't be satisfied.
+        """
         if self.assigned:
             return False
         
-        all_participants = self.get_all_participants()
-        if len(all_participants) < 2:
+        # Сначала взрослые, потом дети
+        givers = [*self.adults.values(), *self.children]
+        if len(givers) < 2:
             return False
         
-        # Создаем циклические назначения
-        shuffled = all_participants.copy()
-        random.shuffle(shuffled)
-        
-        # Создаем пары: каждый дарит следующему в списке
-        for i, giver in enumerate(all_participants):
-            receiver = shuffled[(shuffled.index(giver) + 1) % len(shuffled)]
-            
-            # Находим user_id для взрослого или guardian_id для ребенка
-            giver_user_id = None
-            for uid, adult_data in self.adults.items():
-                if adult_data["name"] == giver:
-                    giver_user_id = uid
-                    break
-            
-            if giver_user_id is None:
-                # Это ребенок, находим его guardian
-                for child in self.children:
-                    if child["name"] == giver:
-                        giver_user_id = child["guardian_id"]
-                        break
-            
-            if giver_user_id:
-                # Определяем тип получателя
-                adult_names = [adult["name"] for adult in self.adults.values()]
-                receiver_type = "adult" if receiver in adult_names else "child"
-                # Инициализируем список назначений, если его еще нет
-                if giver_user_id not in self.assignments:
-                    self.assignments[giver_user_id] = []
-                # Добавляем назначение в список
-                self.assignments[giver_user_id].append({
-                    "gives_to": receiver,
-                    "type": receiver_type,
-                    "giver_name": giver
-                })
+        # Решаем задачу с ограничениями: по возможности один общий цикл
+        receiver_of = solve(
+            [giver.id for giver in givers],
+            self.build_constraints(),
+            names={giver.id: giver.name for giver in givers},
+        )
+        self.apply_assignments(receiver_of.items(), time.time())
+        # Тексты заданий не рендерим: get_mission сделает это при первой отправке, уже вне замка игры
+        return True
+    
+    def apply_assignments(self, pairs: Iterable[Tuple[int, int]], assigned_at: Optional[float] = None):
+        """Install a solved giver -> receiver mapping as a slot -> slot array"""
+        pairs = list(pairs)
+        self._record("apply_assignments", pairs, assigned_at)
+        self.assigned_at = assigned_at
         
+        receiver = array("i", [-1]) * len(self.roster)
+        for giver_id, receiver_id in pairs:
+            receiver[self.get_participant(giver_id).slot] = self.get_participant(receiver_id).slot
+        self.receiver = receiver
+        self.missions.clear()
         self.assigned = True
-        return True
+    
+    def get_receiver(self, giver: Participant) -> Optional[Participant]:
+        """Who the giver draws, or None before assignment"""
+        if giver.slot >= len(self.receiver):
+            return None
+        slot = self.receiver[giver.slot]
+        return self.roster[slot] if slot >= 0 else None
+    
+    def export_records(self) -> List[ExportRecord]:
+        """Snapshot of every participant for roster_io.export_rows, safe to hand to another thread"""
+        records = []
+        for participant in self.roster:
+            guardian = self.adults.get(participant.guardian_id) if participant.guardian_id is not None else None
+            receiver = self.get_receiver(participant)
+            records.append((
+                participant.name,
+                participant.recommendations,
+                participant.id if participant.guardian_id is None else None,
+                participant.guardian_id,
+                guardian.name if guardian is not None else None,
+                receiver.name if receiver is not None else None,
+            ))
+        return records
+    
+    def assignment_pairs(self) -> Iterator[Tuple[int, int]]:
+        """(giver_id, receiver_id) for every assigned participant"""
+        for giver in [*self.adults.values(), *self.children]:
+            receiver = self.get_receiver(giver)
+            if receiver is not None:
+                yield giver.id, receiver.id
+    
+    def season_record(self) -> Dict:
+        """The finished season for the archive: who played, who gave to whom, and when"""
+        return {
+            "participants": [
+                [p.id, p.name, p.type, p.guardian_id, p.recommendations, p.photo] for p in self.roster
+            ],
+            "pairs": [
+                [self.get_participant(giver_id).name, self.get_participant(receiver_id).name]
+                for giver_id, receiver_id in self.assignment_pairs()
+            ],
+            "receiver_of": list(self.assignment_pairs()),
+            "exclusions": [[giver_id, sorted(receivers)] for giver_id, receivers in self.exclusions.items()],
+            "assigned_at": self.assigned_at,
+            "deadline": self.deadline,
+            "exchange_at": self.exchange_at,
+        }
+    
+    def set_late_join(self, enabled: bool):
+        """Open or close registration after assignment"""
+        self._record("set_late_join", enabled)
+        self.late_join = enabled
+    
+    def set_deadline(self, when: Optional[float]):
+        """Schedule (or cancel with None) the automatic draw"""
+        self._record("set_deadline", when)
+        self.deadline = when
+    
+    def set_exchange(self, when: Optional[float]):
+        """Set the gift exchange time; reminder waves start over"""
+        self._record("set_exchange", when)
+        self.exchange_at = when
+        self.reminded = 0
+    
+    def mark_reminded(self, waves: int):
+        """Remember that the first ``waves`` reminder waves are done, so no replica or restart repeats them"""
+        self._record("mark_reminded", waves)
+        self.reminded = waves
+    
+    def queue_outgoing(self, owner: str, kind: str, extra: Any, chat_ids: List[int], now: float) -> int:
+        """Put one ``kind`` message per chat in the outbox as sent by ``owner``; return the batch number"""
+        self._record("queue_outgoing", owner, kind, extra, chat_ids, now)
+        batch = self.outbox_next
+        self.outbox[batch] = [owner, kind, extra, set(chat_ids)]
+        self.outbox_next = batch + 1
+        self.outbox_seen[owner] = now
+        return batch
+    
+    def settle_outgoing(self, owner: str, settled: List[List], now: float):
+        """Drop delivered (or hopelessly failed) [batch, chat_ids]; also tells other replicas ``owner`` is still sending"""
+        self._record("settle_outgoing", owner, settled, now)
+        for batch, chat_ids in settled:
+            entry = self.outbox.get(batch)
+            if entry is None:
+                continue
+            entry[3].difference_update(chat_ids)
+            if not entry[3]:
+                del self.outbox[batch]
+        if self.outbox:
+            self.outbox_seen[owner] = now
+        else:
+            self.outbox_seen.clear()
+    
+    def release_outgoing(self, owner: str):
+        """Leave the owner's unsent messages to whichever process claims them next"""
+        self._record("release_outgoing", owner)
+        for entry in self.outbox.values():
+            if entry[0] == owner:
+                entry[0] = None
+        self.outbox_seen.pop(owner, None)
+    
+    def _orphaned(self, sender: Optional[str], owner: str, now: float, lease: float) -> bool:
+        if sender == owner:
+            return False
+        # Без аренды (один процесс на журнал) любой другой отправитель — это прошлый, уже остановленный процесс
+        return sender is None or not lease or now - self.outbox_seen.get(sender, 0.0) >= lease
+    
+    def claimable(self, owner: str, now: float, lease: float) -> bool:
+        """Whether claim_outgoing would take anything; checked without writing to the journal"""
+        return any(self._orphaned(entry[0], owner, now, lease) for entry in self.outbox.values())
+    
+    def claim_outgoing(self, owner: str, now: float, lease: float) -> List[List]:
+        """Take over released batches and those of senders silent for ``lease`` seconds; [batch, kind, extra, chat_ids]"""
+        self._record("claim_outgoing", owner, now, lease)
+        claimed = []
+        for batch, entry in self.outbox.items():
+            if self._orphaned(entry[0], owner, now, lease):
+                entry[0] = owner
+                claimed.append([batch, entry[1], entry[2], sorted(entry[3])])
+        senders = {entry[0] for entry in self.outbox.values()}
+        self.outbox_seen = {sender: seen for sender, seen in self.outbox_seen.items() if sender in senders}
+        if claimed:
+            self.outbox_seen[owner] = now
+        return claimed
+    
+    def _allowed(self, giver: Participant, receiver: Participant) -> bool:
+        """Same rules as build_constraints, checked for one pair"""
+        if giver is receiver or receiver.guardian_id == giver.id:
+            return False
+        if receiver.id in self.exclusions.get(giver.id, ()):
+            return False
+        return (giver.name, receiver.name) not in self.previous_pairings
+    
+    def _can_splice(self, giver: Participant, newcomer: Participant) -> bool:
+        receiver = self.get_receiver(giver)
+        return receiver is not None and self._allowed(giver, newcomer) and self._allowed(newcomer, receiver)
+    
+    def find_splice_point(self, newcomer: Participant, rng: Optional[random.Random] = None) -> Optional[Participant]:
+        """Pick a giver whose edge giver -> receiver can become giver -> newcomer -> receiver"""
+        rng = rng or random
+        placed = min(len(self.receiver), len(self.roster))
+        if not placed:
+            return None
+        for _ in range(SPLICE_ATTEMPTS):
+            giver = self.roster[rng.randrange(placed)]
+            if self._can_splice(giver, newcomer):
+                return giver
+        # Случайные попытки не помогли — ограничения тесные, перебираем всех
+        for giver in self.roster[:placed]:
+            if self._can_splice(giver, newcomer):
+                return giver
+        return None
+    
+    def splice(self, newcomer_id: int, giver_id: int):
+        """Insert a newcomer into the cycle right after giver; only two missions change"""
+        self._record("splice", newcomer_id, giver_id)
+        newcomer = self.get_participant(newcomer_id)
+        giver = self.get_participant(giver_id)
+        receiver = self.receiver
+        receiver.extend([-1] * (len(self.roster) - len(receiver)))
+        receiver[newcomer.slot] = receiver[giver.slot]
+        receiver[giver.slot] = newcomer.slot
+        for missions in self.missions.values():
+            missions.pop(giver.user_id, None)
+            missions.pop(newcomer.user_id, None)
+    
+    def givers_for(self, user_id: int) -> List[Participant]:
+        """Participants whose mission goes to this Telegram user: themselves, then their kids"""
+        adult = self.adults.get(user_id)
+        givers = [adult] if adult is not None else []
+        givers.extend(self.children_by_guardian.get(user_id, ()))
+        return givers
+    
+    def mission_recipients(self) -> Iterator[int]:
+        """Telegram users who get a mission — every adult, plus guardians who only registered kids"""
+        yield from self.adults
+        for guardian_id in self.children_by_guardian:
+            if guardian_id not in self.adults:
+                yield guardian_id
+    
+    def get_mission(self, user_id: int, language: str = DEFAULT_LANGUAGE) -> Optional[str]:
+        """Mission text for a user, rendered once per language and then served from the cache"""
+        missions = self.missions.get(language)
+        if missions is None:
+            missions = self.missions[language] = {}
+        message = missions.get(user_id)
+        if message is None:
+            if not self.assigned:
+                return None
+            # Опоздавший, которого не удалось встроить в цикл, задания не получает
+            givers = [giver for giver in self.givers_for(user_id) if self.get_receiver(giver) is not None]
+            if not givers:
+                return None
+            message = missions[user_id] = self._render_mission(givers, language).encode()
+        return message.decode()
+    
+    def mission_photos(self, user_id: int) -> List[Participant]:
+        """Receivers in this user's mission who attached a wishlist photo"""
+        if not self.assigned:
+            return []
+        receivers = [self.get_receiver(giver) for giver in self.givers_for(user_id)]
+        return [receiver for receiver in receivers if receiver is not None and receiver.photo]
+    
+    def _render_mission(self, givers: List[Participant], language: str) -> str:
+        render = catalog.render
+        if len(givers) == 1:
+            # Single assignment
+            giver = givers[0]
+            receiver = self.get_receiver(giver)
+            parts = [
+                render(language, "mission.title"),
+                render(language, "mission.gift", giver=giver.name, receiver=receiver.name),
+            ]
+            if receiver.recommendations:
+                parts.append(render(language, "mission.tips", tips=receiver.recommendations))
+            if receiver.type == "child":
+                parts.append(render(language, "mission.kid_note"))
+            return "".join(parts)
+        
+        # Multiple assignments (adult + kid/kids)
+        parts = [render(language, "missions.title")]
+        for giver in givers:
+            receiver = self.get_receiver(giver)
+            key = "missions.adult_gift" if giver.type == "adult" else "missions.kid_gift"
+            parts.append(render(language, key, giver=giver.name, receiver=receiver.name))
+            if receiver.recommendations:
+                parts.append(render(language, "missions.tips", tips=receiver.recommendations))
+            if receiver.type == "child":
+                parts.append(render(language, "missions.kid_note"))
+            parts.append("\n")
+        return "".join(parts)
+
+class _GameJournal:
+    """Tags one game's journal records with its key"""
+    __slots__ = ("journal", "key")
+    
+    def __init__(self, journal, key: str):
+        self.journal = journal
+        self.key = key
+    
+    def append(self, op: str, args):
+        self.journal.append("game", [self.key, op, args])
+    
+    def transaction(self):
+        return self.journal.transaction()
+
+
+class Game:
+    """One independent Secret Santa game with its own admin, roster and lock"""
+    __slots__ = ("key", "admin_id", "data", "_lock", "sending")
+    
+    def __init__(self, key: str, admin_id: int = 0):
+        self.key = key
+        self.admin_id = admin_id
+        self.data = SecretSantaData()
+        self._lock: Optional[asyncio.Lock] = None
+        # Пока идет рассылка заданий — событие, которое ее останавливает (/stop_sending)
+        self.sending: Optional[asyncio.Event] = None
+    
+    @property
+    def lock(self) -> asyncio.Lock:
+        # Создаем лениво: у простаивающей игры замка нет
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+    
+    def is_admin(self, user_id: int) -> bool:
+        """Games without an admin let anyone run admin commands, as before"""
+        return not self.admin_id or user_id == self.admin_id
+    
+    async def mutate(self, change: Callable[[SecretSantaData], T]) -> T:
+        """Run a check-and-change under the lock as one storage transaction
+
+        ``change`` must do its checks and mutations synchronously. With a shared log it runs on state
+        caught up with other replicas, and all of its records are committed together.
+        """
+        async with self.lock:
+            return await self._mutate(change)
+    
+    async def _mutate(self, change: Callable[[SecretSantaData], T]) -> T:
+        """mutate() for a caller that already holds the lock"""
+        journal = self.data.journal
+        for attempt in range(COMMIT_ATTEMPTS):
+            try:
+                async with journal.transaction() if journal is not None else contextlib.nullcontext():
+                    return change(self.data)
+            except Conflict as e:
+                # Conflict бросается до изменения — повторять безопасно
+                if attempt == COMMIT_ATTEMPTS - 1:
+                    raise
+                metrics.increment("commit_conflicts")
+                logger.info(f"Retrying after conflict: {e}")
+
+
+DEFAULT_GAME = "default"
+
+
+def group_game_key(chat_id: int) -> str:
+    return f"chat:{chat_id}"
+
+
+class GameRegistry:
+    """All games in this process, keyed by group chat or invite code"""
+    
+    def __init__(self, default_admin_id: int = 0):
+        self.default_admin_id = default_admin_id
+        self.games: Dict[str, Game] = {}
+        self.current: Dict[int, str] = {}  # user_id -> ключ игры для личных сообщений
+        self._journal = None
+        self.create_game(DEFAULT_GAME, default_admin_id)
+    
+    @property
+    def journal(self):
+        return self._journal
+    
+    @journal.setter
+    def journal(self, journal):
+        self._journal = journal
+        for game in self.games.values():
+            game.data.journal = _GameJournal(journal, game.key) if journal is not None else None
+    
+    def _record(self, op: str, *args):
+        if self._journal is not None:
+            self._journal.append(op, args)
+    
+    def create_game(self, key: str, admin_id: int = 0) -> Game:
+        """Create a game, or return the one already under this key"""
+        game = self.games.get(key)
+        if game is not None:
+            # Ту же группу могла завести другая реплика: ее игру и уже воспроизведенное в нее не трогаем
+            return game
+        self._record("create_game", key, admin_id)
+        game = self.games[key] = Game(key, admin_id)
+        if self._journal is not None:
+            game.data.journal = _GameJournal(self._journal, key)
+        return game
+    
+    def new_invite_game(self, admin_id: int) -> Game:
+        """Create a game joined by invite code instead of a group chat"""
+        while True:
+            code = secrets.token_hex(3).upper()
+            if code not in self.games:
+                return self.create_game(code, admin_id)
+    
+    def join(self, user_id: int, key: str):
+        """Make ``key`` the game this user's private commands act on"""
+        if self.current.get(user_id) == key:
+            return
+        self._record("join", user_id, key)
+        self.current[user_id] = key
+    
+    async def sync(self):
+        """Pull changes other replicas made (no-op for a single process)"""
+        if self._journal is not None:
+            await self._journal.sync()
+    
+    def for_update(self, update: Update) -> Optional[Game]:
+        """Game addressed by this update: the group's game, or the user's current one in private"""
+        chat = update.effective_chat
+        if chat is not None and chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+            return self.games.get(group_game_key(chat.id))
+        key = self.current.get(update.effective_user.id, DEFAULT_GAME)
+        return self.games.get(key) or self.games[DEFAULT_GAME]
+    
+    def replay(self, op: str, args: List):
+        """Apply one journal record"""
+        if op == "game":
+            key, game_op, game_args = args
+            self.games[key].data.replay(game_op, game_args)
+        elif op == "create_game":
+            self.create_game(*args)
+        elif op == "join":
+            self.join(*args)
+        elif op in SecretSantaData.JOURNALED_OPS:
+            # Журнал времен одной игры на процесс
+            self.games[DEFAULT_GAME].data.replay(op, args)
+        else:
+            raise ValueError(f"Unknown journal operation: {op}")
+    
+    def to_dict(self) -> Dict:
+        return {
+            "games": [[game.key, game.admin_id, game.data.to_dict()] for game in self.games.values()],
+            "current": list(self.current.items()),
+        }
+    
+    def load_dict(self, state: Dict):
+        """Restore state written by to_dict, keeping the Game objects that already exist"""
+        self.current.clear()
+        if "games" not in state:
+            # Снапшот времен одной игры на процесс
+            state = {"games": [[DEFAULT_GAME, self.default_admin_id, state]], "current": []}
+        # Объекты Game не пересоздаем: их держат Game.mutate и рассылки, пока реплика перечитывает снимок
+        loaded = set()
+        for key, admin_id, game_state in state["games"]:
+            game = self.create_game(key, admin_id)
+            game.admin_id = admin_id
+            game.data.load_dict(game_state)
+            loaded.add(key)
+        for key, game in self.games.items():
+            if key not in loaded:
+                # Игр из снимка не удаляют — такая появилась позже него и дойдет из журнала
+                game.data.reset()
+        # Админ игры по умолчанию всегда берется из ADMIN_ID
+        self.games[DEFAULT_GAME].admin_id = self.default_admin_id
+        self.current.update((user_id, key) for user_id, key in state["current"])
 
-# Глобальное хранилище (в реальном приложении лучше использовать БД)
-data = SecretSantaData()
 
 # ID администратора (можно установить через переменную окружения)
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
+# Все игры процесса; без групп и кодов приглашения все попадают в игру по умолчанию
+games = GameRegistry(ADMIN_ID)
+
+# Режим вебхука: если задан публичный адрес, бот принимает обновления через встроенный сервер PTB
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Сколько обновлений обрабатывается одновременно; 1 — строго по очереди, как раньше
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Порт для метрик в формате Prometheus; 0 — не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Каталог для журнала и снапшотов; пустое значение отключает сохранение на диск
+DATA_DIR = os.getenv("DATA_DIR", "data")
+# Общая база SQLite для нескольких реплик; если задана, DATA_DIR не используется
+SQLITE_PATH = os.getenv("SQLITE_PATH", "")
+# Архив сыгранных сезонов (/reset, /history); по умолчанию рядом с данными, без хранилища на диске — выключен
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or (
+    os.path.join(os.path.dirname(SQLITE_PATH) or ".", "seasons") if SQLITE_PATH
+    else os.path.join(DATA_DIR, "seasons") if DATA_DIR else ""
+)
+archive = SeasonArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None
+# Состояние перезапуска (смещение обновлений, диалоги) — только у единственного процесса с DATA_DIR, не у реплик
+RESUME_DIR = DATA_DIR if not SQLITE_PATH else ""
+
+# Сколько секунд при остановке даем начатым отправкам; неотправленное дошлет следующий процесс
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "5"))
+# Этот процесс в outbox игр: кто из процессов взялся доставить сообщение
+INSTANCE = secrets.token_hex(4)
+# Реплика, которая столько секунд не отчитывалась о своей рассылке, считается упавшей, и рассылку забирают другие.
+# Журнал в DATA_DIR пишет только один процесс, так что там все чужое осталось от прошлого процесса
+OUTBOX_LEASE = 60.0 if SQLITE_PATH else 0.0
+
+# Сколько секунд ждем следующего ответа в диалоге регистрации; 0 — ждем бесконечно
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "900"))
+# Брошенные сессии старше этого срока удаляет фоновая уборка, даже если тайм-аут выключен
+SESSION_TTL = CONVERSATION_TIMEOUT or 3600
+SWEEP_INTERVAL = 300
+# Больше незавершенных регистраций не держим: самые старые удаляются первыми
+MAX_OPEN_SESSIONS = int(os.getenv("MAX_OPEN_SESSIONS", "10000"))
+
+# Часовой пояс, в котором админ задает /deadline и /exchange
+TIMEZONE = ZoneInfo(os.getenv("TIMEZONE")) if os.getenv("TIMEZONE") else timezone.utc
+
+# Ключ печати назначений в /export; по умолчанию выводится из токена бота
+EXPORT_SECRET = os.getenv("EXPORT_SECRET", "")
+
+# Метрики обработчиков и запросов к Bot API; ошибки, которые обработчики логируют сами, тоже считаются
+metrics = Metrics()
+logger.addHandler(ErrorLogCounter(metrics))
+
+# Профилирование обработчиков по команде /profile; отчеты — в PROFILE_DIR, последние 20
+profiler = Profiler(os.getenv("PROFILE_DIR", "profiles"))
+# Сколько вызовов профилируем, если админ не указал
+PROFILE_CALLS = 5
+
+# Общий для всех рассылок ограничитель скорости
+deliverer = Deliverer(
+    global_rate=float(os.getenv("DELIVERY_RATE", "25")),
+    concurrency=int(os.getenv("DELIVERY_CONCURRENCY", "8")),
+)
+
+# Допуск обновлений к обработчикам: защита от флуда, склейка повторов, сброс нагрузки
+admission = Admission(
+    user_rate=float(os.getenv("USER_RATE", "1")),
+    max_pending=int(os.getenv("MAX_PENDING_UPDATES", "1000")),
+)
+# Какие полученные обновления обработаны до конца: Telegram забывает только их
+updates = UpdateTracker()
+
+# Команды, которые всегда проходят: ими останавливают то, что уже идет
+ALWAYS_ADMITTED = frozenset({"cancel", "stop_sending"})
+# Запросы только на чтение — их первыми сбрасываем под нагрузкой, пользователь просто повторит
+READ_ONLY_COMMANDS = frozenset({"start", "help", "who_are_we", "my_mission", "stats"})
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, but each user's updates strictly in order.
+
+    Conversation state lives per user, so serialising a user's own updates
+    keeps the registration dialogs consistent while different users are
+    handled in parallel. A user waiting for their turn doesn't hold one of
+    the global slots.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks: Dict[int, List] = {}  # user_id -> [lock, сколько обновлений ждет]
+        self.pending = 0  # обновления в работе и в очереди — по этому числу сбрасываем нагрузку
+        self.answered = False  # обработано ли хоть одно обновление с момента старта
+    
+    async def process_update(self, update, coroutine):
+        self.pending += 1
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            self.pending -= 1
+            update_id = getattr(update, "update_id", None)
+            if update_id is not None:
+                updates.finished(update_id)
+            if not self.answered:
+                self.answered = True
+                record_first_reply()
+    
+    async def _process_in_order(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+
+def record_first_reply():
+    """Measure how long the restart took, as the first user sees it"""
+    now = time.time()
+    # metrics создается при загрузке модуля — раньше восстановления состояния и подключения к Telegram
+    metrics.set_gauge("startup_to_first_reply_seconds", now - metrics.started)
+    note = f"First update handled {now - metrics.started:.2f}s after start"
+    if updates.stopped_at is not None:
+        metrics.set_gauge("restart_gap_seconds", now - updates.stopped_at)
+        note += f", {now - updates.stopped_at:.2f}s after the previous process stopped"
+    logger.info(note)
+
+
+def language(update: Update) -> str:
+    """Catalog language for the user behind this update"""
+    user = update.effective_user
+    if user is None:
+        return DEFAULT_LANGUAGE
+    return catalog.language(user.language_code)
+
+
+async def remember_language(update: Update):
+    """Keep the participant record's language in step with the user's Telegram language, for broadcasts"""
+    game = games.for_update(update)
+    user_id = update.effective_user.id
+    adult = game.data.adults.get(user_id) if game is not None else None
+    lang = language(update)
+    if adult is None or adult.lang == lang:
+        return
+    try:
+        await game.mutate(lambda data: data.set_language(user_id, lang))
+    except Exception as e:
+        # Язык не главное: обновление обрабатываем дальше, попробуем в следующий раз
+        logger.warning(f"Could not remember language of user {user_id}: {e}")
+
+
+def say(update: Update, key: str, **fields) -> str:
+    """Render a catalog message in the language of the user behind this update"""
+    return catalog.render(language(update), key, **fields)
+
+
+def mission_message(data: SecretSantaData, user_id: int, lang: str, text: Optional[str] = None) -> OutgoingMessage:
+    """Mission for a user (or ``text`` built around it), followed by the receivers' wishlist photos"""
+    if text is None:
+        text = data.get_mission(user_id, lang)
+    photos = tuple(
+        (receiver.photo, catalog.render(lang, "mission.photo", name=receiver.name))
+        for receiver in data.mission_photos(user_id)
+    )
+    return OutgoingMessage(user_id, text, photos)
+
+
+def missions_to(
+    chat_ids: Iterable[int], key: Optional[str] = None, photos: bool = True, **fields
+) -> Tuple[str, Any, List[int]]:
+    """Outbox batch: everyone's current mission, or the catalog text ``key`` built around it"""
+    return OUTGOING_MISSION, None if key is None else [key, fields, photos], list(chat_ids)
+
+
+def text_to(chat_id: int, key: str, **fields) -> Tuple[str, Any, List[int]]:
+    """Outbox batch: a catalog text, e.g. a note to the admin"""
+    return OUTGOING_TEXT, [key, fields], [chat_id]
+
+
+def render_outgoing(data: SecretSantaData, chat_id: int, kind: str, extra: Any) -> Optional[OutgoingMessage]:
+    """Build a queued message from the game as it is now; None when there is nothing to send anymore"""
+    lang = data.language_of(chat_id)
+    if kind == OUTGOING_TEXT:
+        key, fields = extra
+        return OutgoingMessage(chat_id, catalog.render(lang, key, **fields))
+    mission = data.get_mission(chat_id, lang)
+    if mission is None:
+        return None
+    if extra is None:
+        return mission_message(data, chat_id, lang, mission)
+    key, fields, photos = extra
+    mission = catalog.render(lang, key, mission=mission, **fields)
+    return mission_message(data, chat_id, lang, mission) if photos else OutgoingMessage(chat_id, mission)
+
+
+async def enqueue(game: Game, batches: Iterable[Tuple[str, Any, List[int]]]) -> List[List]:
+    """Record what to send in the game's outbox before sending it, so a restart can finish the job"""
+    chunks = [
+        (kind, extra, chat_ids[start:start + OUTBOX_CHUNK])
+        for kind, extra, chat_ids in batches
+        for start in range(0, len(chat_ids), OUTBOX_CHUNK)
+    ]
+    if not chunks:
+        return []
+    
+    def queue(data: SecretSantaData) -> List[int]:
+        now = time.time()
+        return [data.queue_outgoing(INSTANCE, kind, extra, chat_ids, now) for kind, extra, chat_ids in chunks]
+    
+    numbers = await game.mutate(queue)
+    return [[game, number, kind, extra, chat_ids] for number, (kind, extra, chat_ids) in zip(numbers, chunks)]
+
+
+async def send_queued(
+    bot,
+    queued: List[List],
+    report: Optional[DeliveryReport] = None,
+    cancel: Optional[asyncio.Event] = None,
+) -> DeliveryReport:
+    """Broadcast outbox batches [game, number, kind, extra, chat_ids], checking messages off as they are delivered
+
+    Each message is rendered only when its turn comes. If the process is stopping, the rest is left for
+    the next one; if the admin stopped the broadcast, it is dropped.
+    """
+    report = report if report is not None else DeliveryReport()
+    touched = {game for game, *_ in queued}
+    settled: Dict[Game, Dict[int, List[int]]] = {}
+    
+    def settle(game: Game, number: int, chat_id: int):
+        settled.setdefault(game, {}).setdefault(number, []).append(chat_id)
+    
+    def messages() -> Iterator[OutgoingMessage]:
+        for game, number, kind, extra, chat_ids in queued:
+            for chat_id in chat_ids:
+                try:
+                    message = render_outgoing(game.data, chat_id, kind, extra)
+                except Exception as e:
+                    # Одно сообщение не собралось — считаем его проваленным, остальные рассылаем
+                    logger.error(f"Error rendering message to user {chat_id}: {e}", exc_info=True)
+                    report.failed[chat_id] = str(e)
+                    settle(game, number, chat_id)
+                    continue
+                if message is None:
+                    # Задание пропало (например, игру сбросили) — снимаем с учета, отправлять нечего
+                    settle(game, number, chat_id)
+                    continue
+                message.tag = (game, number)
+                yield message
+    
+    def on_sent(message: OutgoingMessage, error: Optional[str]):
+        game, number = message.tag
+        settle(game, number, message.chat_id)
+    
+    async def checkpoint():
+        for game in touched:
+            batches = settled.pop(game, {})
+            # С арендой пустой отчет тоже нужен: по нему другие реплики видят, что рассылка жива
+            if not batches and not OUTBOX_LEASE:
+                continue
+            done = [[number, chat_ids] for number, chat_ids in batches.items()]
+            try:
+                await game.mutate(lambda data: data.settle_outgoing(INSTANCE, done, time.time()))
+            except Exception as e:
+                logger.error(f"Error checking off delivered messages: {e}", exc_info=True)
+                for number, chat_ids in done:
+                    settled.setdefault(game, {}).setdefault(number, []).extend(chat_ids)
+    
+    finished = asyncio.Event()
+    
+    async def checkpoints():
+        # Не отменяем посреди записи: отметки, вынутые из settled, иначе пропали бы
+        while not finished.is_set():
+            try:
+                await asyncio.wait_for(finished.wait(), CHECKPOINT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await checkpoint()
+    
+    ticker = asyncio.create_task(checkpoints())
+    try:
+        report = await deliverer.broadcast(bot, messages(), report, cancel, on_sent)
+    finally:
+        finished.set()
+        await ticker
+    
+    if report.halted:
+        for game in touched:
+            await game.mutate(lambda data: data.release_outgoing(INSTANCE))
+        remaining = sum(len(chat_ids) for *_, chat_ids in queued) - report.total
+        logger.info(f"Stopping: {remaining} messages left in the outbox for the next process")
+    elif report.cancelled:
+        # Админ остановил рассылку — после рестарта она не должна возобновиться
+        left: Dict[Game, List[List]] = {}
+        for game, number, *_ in queued:
+            entry = game.data.outbox.get(number)
+            if entry is not None:
+                left.setdefault(game, []).append([number, sorted(entry[3])])
+        for game, done in left.items():
+            await game.mutate(lambda data: data.settle_outgoing(INSTANCE, done, time.time()))
+    return report
+
+
+async def deliver(
+    bot,
+    outgoing: Dict[Game, List[Tuple[str, Any, List[int]]]],
+    report: Optional[DeliveryReport] = None,
+    cancel: Optional[asyncio.Event] = None,
+) -> DeliveryReport:
+    """Queue each game's batches (see missions_to, text_to) in its outbox, then send them all as one broadcast"""
+    queued = []
+    for game, batches in outgoing.items():
+        queued.extend(await enqueue(game, batches))
+    return await send_queued(bot, queued, report, cancel)
+
+
+async def _send_resumed(bot, queued: List[List]):
+    report = await send_queued(bot, queued)
+    metrics.increment("outbox_resumed", len(report.delivered))
+    logger.info(f"Resumed outbox: {len(report.delivered)} delivered, {len(report.failed)} failed")
+
+
+async def claim_outbox(application: Application):
+    """Pick up what a stopped or crashed process left undelivered and send it in the background"""
+    now = time.time()
+    claimed: List[List] = []
+    for game in list(games.games.values()):
+        data = game.data
+        if not data.outbox or not data.claimable(INSTANCE, now, OUTBOX_LEASE):
+            continue
+        rows = await game.mutate(lambda data: data.claim_outgoing(INSTANCE, now, OUTBOX_LEASE))
+        claimed.extend([game, *row] for row in rows)
+    if claimed:
+        logger.info(f"Resuming {sum(len(chat_ids) for *_, chat_ids in claimed)} undelivered messages")
+        application.create_task(_send_resumed(application.bot, claimed))
+
+
+async def current_game(update: Update) -> Optional[Game]:
+    """Game this update addresses; tells the user when a group has none yet"""
+    await games.sync()
+    game = games.for_update(update)
+    if game is None:
+        await update.message.reply_text(say(update, "game.none"))
+    return game
+
+
+# Временные данные диалога регистрации в context.user_data
+SESSION_KEYS = ('game', 'last_seen', 'adult_name', 'child_name', 'name_warned', 'recommendations')
+# Диалоги регистрации (заполняется в main): sweep_sessions завершает в них брошенные разговоры
+conversation_handlers: List[ConversationHandler] = []
+
+
+def open_session(context: ContextTypes.DEFAULT_TYPE, game: Game):
+    """Remember which game the user is registering for and when they were last active"""
+    context.user_data['game'] = game.key
+    # Время по часам, а не monotonic: диалог переживает рестарт процесса
+    context.user_data['last_seen'] = time.time()
+
+
+def close_session(context: ContextTypes.DEFAULT_TYPE):
+    """Drop the registration's temporary data"""
+    for key in SESSION_KEYS:
+        context.user_data.pop(key, None)
+
+
+async def conversation_game(context: ContextTypes.DEFAULT_TYPE) -> Optional[Game]:
+    """Game the user's ongoing registration belongs to"""
+    await games.sync()
+    return games.games.get(context.user_data.get('game'))
+
+
+def session_step(callback: Callable) -> Callable:
+    """Conversation step: marks the user active, or ends the dialog if sweep_sessions evicted its session"""
+    @functools.wraps(callback)
+    async def step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if 'game' not in context.user_data:
+            # Диалог завершаем обычным возвратом END — так его состояние обновит и PicklePersistence
+            await update.message.reply_text(say(update, "registration.timed_out"))
+            return ConversationHandler.END
+        context.user_data['last_seen'] = time.time()
+        return await callback(update, context)
+    
+    return step
+
+
+async def admit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop floods, repeated commands and, under overload, read-only requests before any handler runs"""
+    user = update.effective_user
+    if user is None:
+        return
+    message = update.message
+    query = update.callback_query
+    key = command = None
+    if query is not None:
+        key = f"button:{query.data}"
+    elif message is not None and message.text and message.text.startswith("/"):
+        key = message.text.strip()
+        command = key.split()[0][1:].split("@")[0]
+        if command in ALWAYS_ADMITTED:
+            await remember_language(update)
+            return
+    chat = update.effective_chat
+    group_id = chat.id if chat is not None and chat.type in (Chat.GROUP, Chat.SUPERGROUP) else None
+    pending = getattr(context.application.update_processor, "pending", 0)
+    read_only = command in READ_ONLY_COMMANDS or query is not None
+    
+    refusal = admission.check(user.id, group_id, key, read_only, pending)
+    if refusal is None:
+        await remember_language(update)
+        return
+    metrics.increment(f"updates_{refusal}")
+    # О флуде и перегрузке говорим один раз, а не на каждое лишнее сообщение; повтор команды — молча, она уже выполняется
+    if refusal != "coalesced" and admission.warn_once(user.id):
+        notice = say(update, "flood.busy" if refusal == "shed" else "flood.slow_down")
+        try:
+            if query is not None:
+                await query.answer(notice)
+            elif message is not None:
+                await message.reply_text(notice)
+        except Exception as e:
+            logger.warning(f"Could not tell user {user.id} to slow down: {e}")
+    raise ApplicationHandlerStop
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Command /start"""
     try:
         user_id = update.effective_user.id
-        name = update.effective_user.first_name or "there"
-        
-        welcome_text = (
-            f"Hey, {name}! 🎁🎄✨\n\n"
-            "This is MaNYGA (Make New Year Great Again) — Secret Santa for people who love giving gifts... and pretending it's anonymous. 🎅🎁\n\n"
-            "Here's how it works:\n\n"
-            "/im_in – I'm playing 🎄\n"
-            "/add_small_human – Add a kid without Telegram 🎅\n"
-            "/who_are_we – See who's in the game ⛄\n"
-            "/make_it_random – Assign gift pairs (admin only) 🎁\n"
-            "/my_mission – Who you're gifting to 🎀\n"
-            "/help – In case you forgot what's going on 🦌\n\n"
-            "🎁 Budget: up to 150₪\n"
-            "🎄 Goal: no stress, just good surprises ✨\n"
-            "🎅 Rule: give something you'd smile at (or explain later) 🎉"
-        )
+        name = update.effective_user.first_name or say(update, "start.default_name")
+        
+        welcome_text = say(update, "start.welcome", name=name)
         
         await update.message.reply_text(welcome_text)
     except Exception as e:
         logger.error(f"Error in start command: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try again. 🎄")
+            await update.message.reply_text(say(update, "error.generic"))
         except:
             pass
 
 
+def _splice_late_joiner(data: SecretSantaData, newcomer: Participant) -> Optional[List[int]]:
+    """Fit a newcomer into a running game; return the users whose missions changed, or None"""
+    giver = data.find_splice_point(newcomer)
+    if giver is None:
+        logger.warning(f"No place in the cycle for late joiner {newcomer.name}")
+        return None
+    data.splice(newcomer.id, giver.id)
+    metrics.increment("late_joins")
+    logger.info(f"Late joiner {newcomer.name} spliced in after {giver.name}")
+    # Взрослый и ребенок одного опекуна получают одно общее сообщение
+    return list(dict.fromkeys((newcomer.user_id, giver.user_id)))
+
+
+async def _announce_late_join(update: Update, context: ContextTypes.DEFAULT_TYPE, game: Game, changed: Optional[List[int]]):
+    """Send fresh missions to the newcomer and to the one giver who now gifts to them"""
+    if changed is None:
+        await update.message.reply_text(say(update, "late_join.no_spot"))
+        return
+    newcomer_user = update.effective_user.id
+    givers = [uid for uid in changed if uid != newcomer_user]
+    outgoing = [missions_to([uid for uid in changed if uid == newcomer_user])]
+    if givers:
+        outgoing.append(missions_to(givers, "late_join.mission_changed"))
+    report = await deliver(context.bot, {game: outgoing})
+    metrics.increment("missions_delivered", len(report.delivered))
+    metrics.increment("missions_failed", len(report.failed))
+
+
+async def _name_rejected(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str) -> bool:
+    """Reply about a taken or look-alike name; True when the name step should be asked again"""
+    game = await conversation_game(context)
+    if game is None:
+        return False
+    clash = game.data.name_taken(name)
+    if clash is not None:
+        await update.message.reply_text(say(update, "register.name_taken", name=clash.name))
+        return True
+    # Похожее имя — только предупреждение: то же имя второй раз подряд оставляем как есть
+    if context.user_data.get('name_warned') != name:
+        similar = game.data.similar_names(name)
+        if similar:
+            context.user_data['name_warned'] = name
+            names = ", ".join(participant.name for participant in similar)
+            await update.message.reply_text(say(update, "register.name_similar", names=names))
+            return True
+    return False
+
+
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Register adult participant"""
     try:
         user_id = update.effective_user.id
+        game = await current_game(update)
+        if game is None:
+            return ConversationHandler.END
+        data = game.data
         
-        if data.assigned:
-            await update.message.reply_text(
-                "❌ Sorry, registration's closed — names have already been matched. 🎄🎁"
-            )
+        if data.assigned and not data.late_join:
+            await update.message.reply_text(say(update, "register.closed"))
             return ConversationHandler.END
         
         if user_id in data.adults:
-            await update.message.reply_text(
-                f"✅ You're already in — registered as: {data.get_adult_name(user_id)} 🎉"
-            )
+            await update.message.reply_text(say(update, "register.already_in", name=data.get_adult_name(user_id)))
             return ConversationHandler.END
         
-        await update.message.reply_text(
-            "🎄 What name should we use? Nicknames are fine. 🎅✨"
-        )
+        open_session(context, game)
+        await update.message.reply_text(say(update, "register.ask_name"))
         return REGISTERING_ADULT
     except Exception as e:
         logger.error(f"Error in register command: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try again. 🎄")
+            await update.message.reply_text(say(update, "error.generic"))
         except:
             pass
         return ConversationHandler.END
 
 
+@session_step
 async def register_adult_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process adult participant name"""
     try:
@@ -173,88 +1411,139 @@ async def register_adult_name(update: Update, context: ContextTypes.DEFAULT_TYPE
         name = update.message.text.strip()
         
         if len(name) < 2:
-            await update.message.reply_text(
-                "❌ That name's a bit too short. Try again? 🎄"
-            )
+            await update.message.reply_text(say(update, "register.name_too_short"))
+            return REGISTERING_ADULT
+        
+        if await _name_rejected(update, context, name):
             return REGISTERING_ADULT
         
         # Сохраняем имя во временные данные
         context.user_data['adult_name'] = name
         
-        await update.message.reply_text(
-            "🎅 Any recommendations for your Secret Santa? 🎁\n"
-            "(What would you like? Hobbies, interests, favorite things... or just say 'surprise me!') ✨"
-        )
+        await update.message.reply_text(say(update, "register.ask_recommendations"))
         return ASKING_RECOMMENDATIONS
     except Exception as e:
         logger.error(f"Error in register_adult_name: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try /im_in again. 🎄")
+            await update.message.reply_text(say(update, "error.retry_im_in"))
         except:
             pass
         return ConversationHandler.END
 
 
+@session_step
 async def process_recommendations(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process recommendations for Secret Santa"""
+    try:
+        context.user_data['recommendations'] = update.message.text.strip()
+        await update.message.reply_text(say(update, "register.ask_photo"))
+        return ASKING_PHOTO
+    except Exception as e:
+        logger.error(f"Error in process_recommendations: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(say(update, "error.retry_im_in"))
+        except:
+            pass
+        return ConversationHandler.END
+
+
+@session_step
+async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Attach a wishlist photo and finish adult registration"""
+    # Берем самый крупный размер; храним только file_id — файл остается у Telegram
+    return await finish_registration(update, context, update.message.photo[-1].file_id)
+
+
+@session_step
+async def skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Finish adult registration without a photo"""
+    return await finish_registration(update, context, "")
+
+
+async def finish_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, photo: str):
+    """Save the adult with their recommendations and optional photo"""
     try:
         user_id = update.effective_user.id
-        recommendations = update.message.text.strip()
+        recommendations = context.user_data.get('recommendations', '')
         name = context.user_data.get('adult_name', '')
+        game = await conversation_game(context)
         
-        if not name:
-            await update.message.reply_text(
-                "❌ Something went wrong. Please try /im_in again. 🎄"
-            )
+        if not name or game is None:
+            await update.message.reply_text(say(update, "error.retry_im_in"))
             return ConversationHandler.END
+        data = game.data
+        
+        def add(data: SecretSantaData) -> Union[str, Optional[List[int]]]:
+            if data.assigned and not data.late_join:
+                return say(update, "register.closed")
+            if user_id in data.adults:
+                return say(update, "register.already_in", name=data.get_adult_name(user_id))
+            # Пока человек писал пожелания, имя мог занять кто-то другой
+            clash = data.name_taken(name)
+            if clash is not None:
+                return say(update, "register.name_taken", name=clash.name)
+            data.add_adult(user_id, name, recommendations, photo, language(update))
+            # Под тем же замком: между добавлением и вставкой в цикл не вклинятся /make_it_random и /reset
+            return _splice_late_joiner(data, data.adults[user_id]) if data.assigned else []
         
         # Сохраняем взрослого с рекомендациями
-        data.add_adult(user_id, name, recommendations)
+        changed = await game.mutate(add)
+        if isinstance(changed, str):
+            await update.message.reply_text(changed)
+            return ConversationHandler.END
+        games.join(user_id, game.key)
         
         await update.message.reply_text(
-            f"✅ Welcome, {name}! You're in. 🎉🎄\n"
-            f"Current tally: {len(data.adults)} adults 🎅, {len(data.children)} kids 🎁"
+            say(update, "register.welcome", name=name, adults=len(data.adults), kids=len(data.children))
         )
+        await _announce_late_join(update, context, game, changed)
         
         # Очищаем временные данные
-        context.user_data.pop('adult_name', None)
+        close_session(context)
         
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error in process_recommendations: {e}", exc_info=True)
+        logger.error(f"Error in finish_registration: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try /im_in again. 🎄")
+            await update.message.reply_text(say(update, "error.retry_im_in"))
         except:
             pass
         return ConversationHandler.END
 
 
+@session_step
+async def photo_expected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Something other than a photo arrived where a photo was asked for"""
+    await update.message.reply_text(say(update, "photo.expected"))
+
+
 async def add_child_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start adding a child"""
     try:
         user_id = update.effective_user.id
         logger.info(f"User {user_id} started adding a child")
+        game = await current_game(update)
+        if game is None:
+            return ConversationHandler.END
         
-        if data.assigned:
-            await update.message.reply_text(
-                "❌ Too late — the game's already started. 🎄🎁"
-            )
+        if game.data.assigned and not game.data.late_join:
+            await update.message.reply_text(say(update, "child.too_late"))
             return ConversationHandler.END
         
-        await update.message.reply_text(
-            "🎁 What's the kid's name? We'll handle the rest. 🎅✨"
-        )
+        open_session(context, game)
+        await update.message.reply_text(say(update, "child.ask_name"))
         logger.info(f"User {user_id} is now in REGISTERING_CHILD state")
         return REGISTERING_CHILD
     except Exception as e:
         logger.error(f"Error in add_child_start: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try again. 🎄")
+            await update.message.reply_text(say(update, "error.generic"))
         except:
             pass
         return ConversationHandler.END
 
 
+@session_step
 async def register_child_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process child name"""
     try:
@@ -263,332 +1552,328 @@ async def register_child_name(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.info(f"User {user_id} provided child name: {name}")
         
         if len(name) < 2:
-            await update.message.reply_text(
-                "❌ That name's too short. Give it another shot. 🎄"
-            )
+            await update.message.reply_text(say(update, "child.name_too_short"))
+            return REGISTERING_CHILD
+        
+        if await _name_rejected(update, context, name):
             return REGISTERING_CHILD
         
         # Сохраняем имя во временные данные
         context.user_data['child_name'] = name
         
-        await update.message.reply_text(
-            "🎅 Any recommendations for this kid's Secret Santa? 🎁\n"
-            "(What would they like? Toys, books, interests... or just say 'surprise me!') ✨"
-        )
+        await update.message.reply_text(say(update, "child.ask_recommendations"))
         logger.info(f"User {user_id} is now in ASKING_CHILD_RECOMMENDATIONS state")
         return ASKING_CHILD_RECOMMENDATIONS
     except Exception as e:
         logger.error(f"Error in register_child_name: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try /add_small_human again. 🎄")
+            await update.message.reply_text(say(update, "error.retry_add_child"))
         except:
             pass
         return ConversationHandler.END
 
 
+@session_step
 async def process_child_recommendations(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process recommendations for child's Secret Santa"""
     try:
         user_id = update.effective_user.id
-        recommendations = update.message.text.strip()
+        recommendations = context.user_data['recommendations'] = update.message.text.strip()
+        logger.info(f"User {user_id} provided recommendations for child {context.user_data.get('child_name')}: {recommendations}")
+        await update.message.reply_text(say(update, "child.ask_photo"))
+        return ASKING_CHILD_PHOTO
+    except Exception as e:
+        logger.error(f"Error in process_child_recommendations: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(say(update, "error.retry_add_child"))
+        except:
+            pass
+        return ConversationHandler.END
+
+
+@session_step
+async def process_child_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Attach a wishlist photo and finish adding the child"""
+    return await finish_child(update, context, update.message.photo[-1].file_id)
+
+
+@session_step
+async def skip_child_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Finish adding the child without a photo"""
+    return await finish_child(update, context, "")
+
+
+async def finish_child(update: Update, context: ContextTypes.DEFAULT_TYPE, photo: str):
+    """Save the child with recommendations and optional photo"""
+    try:
+        user_id = update.effective_user.id
+        recommendations = context.user_data.get('recommendations', '')
         name = context.user_data.get('child_name', '')
-        logger.info(f"User {user_id} provided recommendations for child {name}: {recommendations}")
+        game = await conversation_game(context)
         
-        if not name:
-            logger.error(f"Child name missing for user {user_id}")
-            await update.message.reply_text(
-                "❌ Something went wrong. Please try /add_small_human again. 🎄"
-            )
+        if not name or game is None:
+            logger.error(f"Child name or game missing for user {user_id}")
+            await update.message.reply_text(say(update, "error.retry_add_child"))
             return ConversationHandler.END
+        data = game.data
+        
+        def add(data: SecretSantaData) -> Union[str, Optional[List[int]]]:
+            if data.assigned and not data.late_join:
+                return say(update, "child.too_late")
+            clash = data.name_taken(name)
+            if clash is not None:
+                return say(update, "register.name_taken", name=clash.name)
+            data.add_child(name, user_id, recommendations, photo)
+            # Под тем же замком: между добавлением и вставкой в цикл не вклинятся /make_it_random и /reset
+            return _splice_late_joiner(data, data.children[-1]) if data.assigned else []
         
         # Автоматически назначаем текущего пользователя как опекуна
-        data.add_child(name, user_id, recommendations)
+        changed = await game.mutate(add)
+        if isinstance(changed, str):
+            await update.message.reply_text(changed)
+            return ConversationHandler.END
+        games.join(user_id, game.key)
         logger.info(f"Child {name} added successfully for guardian {user_id}")
         
         await update.message.reply_text(
-            f"✅ Got it! {name} is in. 🎁🎉\n"
-            f"We'll send you their assignment. 🎅\n\n"
-            f"Current tally: {len(data.adults)} adults 🎄, {len(data.children)} kids 🎁"
+            say(update, "child.added", name=name, adults=len(data.adults), kids=len(data.children))
         )
+        await _announce_late_join(update, context, game, changed)
         
         # Очищаем временные данные
-        context.user_data.pop('child_name', None)
+        close_session(context)
         
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error in process_child_recommendations: {e}", exc_info=True)
+        logger.error(f"Error in finish_child: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try /add_small_human again. 🎄")
+            await update.message.reply_text(say(update, "error.retry_add_child"))
         except:
             pass
         return ConversationHandler.END
 
 
+def _roster_page(data: SecretSantaData, page: int, lang: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Text and navigation buttons for one /who_are_we page"""
+    pages = data.get_roster_pages(lang)
+    page = max(0, min(page, len(pages) - 1))
+    if len(pages) == 1:
+        return pages[0], None
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⏮", callback_data="who:0"))
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"who:{page - 1}"))
+    if page < len(pages) - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"who:{page + 1}"))
+        buttons.append(InlineKeyboardButton("⏭", callback_data=f"who:{len(pages) - 1}"))
+    text = catalog.render(lang, "roster.page", text=pages[page], page=page + 1, pages=len(pages))
+    return text, InlineKeyboardMarkup([buttons])
+
+
 async def list_participants(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show list of all participants"""
     try:
-        if not data.adults and not data.children:
-            await update.message.reply_text("🎄 No one's joined yet. Just us, the silence, and a bot. 🎄✨")
+        game = await current_game(update)
+        if game is None:
             return
+        data = game.data
         
-        text = "🎄 Here's who's playing:\n\n"
-        
-        if data.adults:
-            text += "🎅 Adults:\n"
-            for i, (uid, adult_data) in enumerate(data.adults.items(), 1):
-                text += f"{i}. {adult_data['name']} 🎄\n"
-            text += "\n"
-        
-        if data.children:
-            text += "🎁 Kids:\n"
-            for i, child in enumerate(data.children, 1):
-                guardian_data = data.adults.get(child["guardian_id"], {})
-                guardian_name = guardian_data.get("name", "Unknown") if isinstance(guardian_data, dict) else "Unknown"
-                text += f"{i}. {child['name']} (added by {guardian_name}) 🎅\n"
-        
-        text += f"\nTotal: {len(data.adults)} adults 🎅, {len(data.children)} kids 🎁"
+        if not data.adults and not data.children:
+            await update.message.reply_text(say(update, "roster.empty"))
+            return
         
-        await update.message.reply_text(text)
+        text, keyboard = _roster_page(data, 0, language(update))
+        await update.message.reply_text(text, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error in list_participants: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try again. 🎄")
+            await update.message.reply_text(say(update, "error.generic"))
         except:
             pass
 
 
+async def list_participants_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Flip /who_are_we pages from the inline keyboard"""
+    query = update.callback_query
+    try:
+        await query.answer()
+        game = games.for_update(update)
+        if game is None or (not game.data.adults and not game.data.children):
+            return
+        text, keyboard = _roster_page(game.data, int(query.data.split(":")[1]), language(update))
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # Нажали на ту же страницу — Telegram отвечает "message is not modified"
+        if "not modified" not in str(e):
+            logger.error(f"Error in list_participants_page: {e}", exc_info=True)
+    except Exception as e:
+        logger.error(f"Error in list_participants_page: {e}", exc_info=True)
+
+
+def _duration(seconds: float, lang: str) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return catalog.render(lang, "duration.seconds", seconds=seconds)
+    return catalog.render(lang, "duration.minutes", minutes=seconds // 60, seconds=f"{seconds % 60:02d}")
+
+
+def _progress_text(report: DeliveryReport, total: int, started: float, lang: str, running: bool = True) -> str:
+    """Live status of a mission broadcast for the admin"""
+    done = report.total
+    remaining = total - done
+    elapsed = time.monotonic() - started
+    # Первые сообщения уходят пачкой из запаса корзины, поэтому темп не выше лимита рассылки
+    rate = min(done / elapsed, deliverer.global_bucket.rate) if done and elapsed else 0.0
+    eta = _duration(remaining / rate, lang) if rate and remaining else "…"
+    text = catalog.render(
+        lang, "progress.status",
+        done=done, total=total, sent=len(report.delivered), failed=len(report.failed), remaining=remaining,
+    )
+    if running:
+        text += catalog.render(lang, "progress.eta", eta=eta)
+    return text
+
+
+async def _show_progress(message, report: DeliveryReport, total: int, started: float, lang: str):
+    """Edit the progress message in place until cancelled, only when a spare rate-limit token is free"""
+    shown = message.text
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        text = _progress_text(report, total, started, lang)
+        # Правка тратит тот же лимит Telegram, что и рассылка, поэтому пропускаем ее, если токена нет
+        if text == shown or not deliverer.try_spare(message.chat_id):
+            continue
+        try:
+            await message.edit_text(text)
+            shown = text
+        except Exception as e:
+            logger.warning(f"Could not update broadcast progress: {e}")
+
+
 async def assign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Create Secret Santa assignments (admin only)"""
     user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
+    data = game.data
     
     # Check admin rights
-    if ADMIN_ID and user_id != ADMIN_ID:
-        await update.message.reply_text(
-            "❌ This one's for the admin. You know who you are. 🎅🎄"
-        )
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
         return
     
     if data.assigned:
-        await update.message.reply_text(
-            "⚠️ Assignments are already done. 🎁\n"
-            "Need a reset? Use /reset (admin only). 🎄"
-        )
+        await update.message.reply_text(say(update, "assign.already_done"))
         return
     
     total_participants = len(data.adults) + len(data.children)
     if total_participants < 2:
-        await update.message.reply_text(
-            "❌ Need at least 2 people to make this work. 🎅\n"
-            "Otherwise, it's just... gifting to yourself. 🎁➡️🎁"
-        )
+        await update.message.reply_text(say(update, "assign.too_few"))
         return
     
-    if data.make_assignments():
-        # Send assignments to all participants
-        for uid, assignments_list in data.assignments.items():
-            try:
-                if len(assignments_list) == 1:
-                    # Single assignment
-                    assignment = assignments_list[0]
-                    message = (
-                        f"🎅🎁✨ Your Secret Santa assignment:\n\n"
-                        f"You ({assignment['giver_name']}) are gifting to:\n"
-                        f"👤 {assignment['gives_to']} 🎄"
-                    )
-                    # Добавляем рекомендации, если получатель - взрослый
-                    if assignment['type'] == "adult":
-                        for adult_uid, adult_data in data.adults.items():
-                            if adult_data["name"] == assignment['gives_to']:
-                                recommendations = adult_data.get("recommendations", "")
-                                if recommendations:
-                                    message += f"\n\n💡 Tips: {recommendations}"
-                                break
-                    if assignment['type'] == "child":
-                        # Добавляем рекомендации, если получатель - ребенок
-                        for child in data.children:
-                            if child["name"] == assignment['gives_to']:
-                                recommendations = child.get("recommendations", "")
-                                if recommendations:
-                                    message += f"\n\n💡 Tips: {recommendations}"
-                                break
-                        message += "\n\n📝 Note: This is a kid without Telegram 🎁"
-                else:
-                    # Multiple assignments (adult + kid/kids)
-                    message = "🎅🎁✨ Your Secret Santa assignments:\n\n"
-                    for assignment in assignments_list:
-                        adult_names = [adult["name"] for adult in data.adults.values()]
-                        if assignment['giver_name'] in adult_names:
-                            # This is an adult assignment
-                            message += f"🎅 You ({assignment['giver_name']}) are gifting to:\n"
-                            message += f"   👤 {assignment['gives_to']} 🎄\n"
-                            
-                            # Находим рекомендации получателя
-                            receiver_recommendations = ""
-                            if assignment['type'] == "adult":
-                                for adult_uid, adult_data in data.adults.items():
-                                    if adult_data["name"] == assignment['gives_to']:
-                                        receiver_recommendations = adult_data.get("recommendations", "")
-                                        break
-                            else:
-                                # Получатель - ребенок
-                                for child in data.children:
-                                    if child["name"] == assignment['gives_to']:
-                                        receiver_recommendations = child.get("recommendations", "")
-                                        break
-                            
-                            if receiver_recommendations:
-                                message += f"   💡 Tips: {receiver_recommendations}\n"
-                            if assignment['type'] == "child":
-                                message += "   📝 Note: This is a kid without Telegram 🎁\n"
-                            message += "\n"
-                        else:
-                            # This is a kid assignment
-                            message += f"🎁 {assignment['giver_name']} is gifting to:\n"
-                            message += f"   👤 {assignment['gives_to']} 🎁\n"
-                            
-                            # Добавляем рекомендации получателя
-                            receiver_recommendations = ""
-                            if assignment['type'] == "adult":
-                                for adult_uid, adult_data in data.adults.items():
-                                    if adult_data["name"] == assignment['gives_to']:
-                                        receiver_recommendations = adult_data.get("recommendations", "")
-                                        break
-                            else:
-                                # Получатель - ребенок
-                                for child in data.children:
-                                    if child["name"] == assignment['gives_to']:
-                                        receiver_recommendations = child.get("recommendations", "")
-                                        break
-                            
-                            if receiver_recommendations:
-                                message += f"   💡 Tips: {receiver_recommendations}\n"
-                            if assignment['type'] == "child":
-                                message += "   📝 Note: This is a kid without Telegram 🎁\n"
-                            message += "\n"
-                
-                await context.bot.send_message(chat_id=uid, text=message)
-            except Exception as e:
-                logger.error(f"Error sending message to user {uid}: {e}")
+    try:
+        # Под замком игры, чтобы не разминуться с последними регистрациями; при гонке
+        # с другой репликой решаем заново — или узнаем, что она уже раздала назначения
+        assigned = await game.mutate(lambda data: data.make_assignments())
+    except AssignmentError as e:
+        await update.message.reply_text(say(update, "assign.unsolvable", reason=e))
+        return
+    
+    if assigned:
+        recipients = list(data.mission_recipients())
+        # В outbox кладем только адресатов; тексты рендерятся по ходу рассылки, фото — по file_id
+        outgoing = [missions_to(recipients)]
         
-        await update.message.reply_text(
-            f"✅ Assignments sent out! 🎁🎉\n"
-            f"Let the mysterious generosity begin. 🎅🎄✨\n\n"
-            f"Total participants: {total_participants} 🎁"
-        )
+        lang = language(update)
+        report = DeliveryReport()
+        started = time.monotonic()
+        progress = await update.message.reply_text(_progress_text(report, len(recipients), started, lang))
+        watcher = asyncio.create_task(_show_progress(progress, report, len(recipients), started, lang))
+        game.sending = asyncio.Event()
+        try:
+            await deliver(context.bot, {game: outgoing}, report, game.sending)
+        finally:
+            game.sending = None
+            watcher.cancel()
+        metrics.increment("missions_delivered", len(report.delivered))
+        metrics.increment("missions_failed", len(report.failed))
+        try:
+            await progress.edit_text(_progress_text(report, len(recipients), started, lang, running=False))
+        except Exception as e:
+            logger.warning(f"Could not update broadcast progress: {e}")
+        
+        counts = say(update, "assign.counts", delivered=len(report.delivered), failed=len(report.failed))
+        left = len(recipients) - report.total
+        if report.halted:
+            await update.message.reply_text(say(update, "assign.halted", counts=counts, left=left))
+        elif report.cancelled:
+            metrics.increment("broadcasts_cancelled")
+            await update.message.reply_text(say(update, "assign.cancelled", counts=counts, left=left))
+        elif report.failed:
+            await update.message.reply_text(say(update, "assign.partial", total=total_participants, counts=counts))
+        else:
+            await update.message.reply_text(say(update, "assign.done", total=total_participants, counts=counts))
+        if report.failed:
+            failed_names = [data.get_adult_name(uid) or str(uid) for uid in report.failed]
+            shown = ", ".join(failed_names[:50])
+            if len(failed_names) > 50:
+                shown = say(update, "assign.unreached_more", names=shown, count=len(failed_names) - 50)
+            await update.message.reply_text(say(update, "assign.unreached", names=shown))
+    elif data.assigned:
+        # Другая реплика успела раньше — ее рассылка уже идет
+        await update.message.reply_text(say(update, "assign.already_done"))
     else:
-        await update.message.reply_text(
-            "❌ Something went wrong during assignments. 🎄\n"
-            "Try again? Or try tea first. 🎅"
-        )
+        await update.message.reply_text(say(update, "assign.failed"))
+
+
+async def stop_sending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop a running mission broadcast (admin only)"""
+    user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
+    
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
+        return
+    
+    if game.sending is None:
+        await update.message.reply_text(say(update, "sending.nothing"))
+        return
+    
+    game.sending.set()
+    await update.message.reply_text(say(update, "sending.stopping"))
 
 
 async def my_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's assignment"""
     try:
         user_id = update.effective_user.id
+        game = await current_game(update)
+        if game is None:
+            return
+        data = game.data
         
         if not data.assigned:
-            await update.message.reply_text(
-                "⏳ Assignments aren't ready yet. 🎄\n"
-                "Waiting on the admin to hit the button. 🎅"
-            )
+            await update.message.reply_text(say(update, "my_mission.not_ready"))
             return
         
         # Get all assignments for this user
-        if user_id not in data.assignments or not data.assignments[user_id]:
-            await update.message.reply_text(
-                "❌ You don't seem to be in the game. 🎁\n"
-                "Try /im_in first. ✨"
-            )
+        message = data.get_mission(user_id, language(update))
+        if message is None:
+            await update.message.reply_text(say(update, "my_mission.not_playing"))
             return
         
-        assignments_list = data.assignments[user_id]
-        
-        # Form message
-        if len(assignments_list) == 1:
-            # Single assignment
-            assignment = assignments_list[0]
-            message = (
-                f"🎅🎁✨ Your Secret Santa assignment:\n\n"
-                f"You ({assignment['giver_name']}) are gifting to:\n"
-                f"👤 {assignment['gives_to']} 🎄"
-            )
-            # Добавляем рекомендации, если получатель - взрослый
-            if assignment['type'] == "adult":
-                for adult_uid, adult_data in data.adults.items():
-                    if adult_data["name"] == assignment['gives_to']:
-                        recommendations = adult_data.get("recommendations", "")
-                        if recommendations:
-                            message += f"\n\n💡 Tips: {recommendations}"
-                        break
-            if assignment['type'] == "child":
-                # Добавляем рекомендации, если получатель - ребенок
-                for child in data.children:
-                    if child["name"] == assignment['gives_to']:
-                        recommendations = child.get("recommendations", "")
-                        if recommendations:
-                            message += f"\n\n💡 Tips: {recommendations}"
-                        break
-                message += "\n\n(This is a kid without Telegram) 🎁"
-        else:
-            # Multiple assignments (adult + kid/kids)
-            message = "🎅🎁✨ Your Secret Santa assignments:\n\n"
-            for assignment in assignments_list:
-                adult_names = [adult["name"] for adult in data.adults.values()]
-                if assignment['giver_name'] in adult_names:
-                    # This is an adult assignment
-                    message += f"🎅 You ({assignment['giver_name']}) are gifting to:\n"
-                    message += f"   👤 {assignment['gives_to']} 🎄\n"
-                    
-                    # Находим рекомендации получателя
-                    receiver_recommendations = ""
-                    if assignment['type'] == "adult":
-                        for adult_uid, adult_data in data.adults.items():
-                            if adult_data["name"] == assignment['gives_to']:
-                                receiver_recommendations = adult_data.get("recommendations", "")
-                                break
-                    else:
-                        # Получатель - ребенок
-                        for child in data.children:
-                            if child["name"] == assignment['gives_to']:
-                                receiver_recommendations = child.get("recommendations", "")
-                                break
-                    
-                    if receiver_recommendations:
-                        message += f"   💡 Tips: {receiver_recommendations}\n"
-                    if assignment['type'] == "child":
-                        message += "   📝 Note: This is a kid without Telegram 🎁\n"
-                    message += "\n"
-                else:
-                    # This is a kid assignment
-                    message += f"🎁 {assignment['giver_name']} is gifting to:\n"
-                    message += f"   👤 {assignment['gives_to']} 🎁\n"
-                    
-                    # Добавляем рекомендации получателя
-                    receiver_recommendations = ""
-                    if assignment['type'] == "adult":
-                        for adult_uid, adult_data in data.adults.items():
-                            if adult_data["name"] == assignment['gives_to']:
-                                receiver_recommendations = adult_data.get("recommendations", "")
-                                break
-                    else:
-                        # Получатель - ребенок
-                        for child in data.children:
-                            if child["name"] == assignment['gives_to']:
-                                receiver_recommendations = child.get("recommendations", "")
-                                break
-                    
-                    if receiver_recommendations:
-                        message += f"   💡 Tips: {receiver_recommendations}\n"
-                    if assignment['type'] == "child":
-                        message += "   📝 Note: This is a kid without Telegram 🎁\n"
-                    message += "\n"
-        
         await update.message.reply_text(message)
+        # Фото пожеланий уже лежат у Telegram — отправляем по file_id, ничего не скачивая
+        for receiver in data.mission_photos(user_id):
+            await update.message.reply_photo(receiver.photo, caption=say(update, "mission.photo", name=receiver.name))
     except Exception as e:
         logger.error(f"Error in my_assignment: {e}", exc_info=True)
         try:
-            await update.message.reply_text("❌ Something went wrong. Please try again. 🎄")
+            await update.message.reply_text(say(update, "error.generic"))
         except:
             pass
 
@@ -596,60 +1881,755 @@ async def my_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset all data (admin only)"""
     user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
     
-    if ADMIN_ID and user_id != ADMIN_ID:
-        await update.message.reply_text(
-            "❌ Only admins can do this. Democracy is limited here. 🎅🎄"
-        )
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only_reset"))
         return
     
-    data.adults.clear()
-    data.children.clear()
-    data.assignments.clear()
-    data.assigned = False
+    def wipe(data: SecretSantaData):
+        data.reset()
+        if season is not None:
+            # Следующая жеребьевка не повторит пары этого сезона
+            data.set_previous_pairings(season.pairs)
     
-    await update.message.reply_text(
-        "✅ Everything's been wiped. 🎁\n"
-        "Fresh start, clean slate, empty list. ✨🎄"
-    )
+    season = None
+    # Снимок сезона и сброс — под одним замком игры: регистрация или жеребьевка между ними не пропадет из архива
+    async with game.lock:
+        if archive is not None:
+            # Снимок берем в транзакции, чтобы в нем были и записи других реплик
+            record = await game._mutate(lambda data: data.season_record() if data.assigned else None)
+            if record is not None:
+                try:
+                    # Сначала в архив: если сброс не дойдет до конца, повторный /reset не заведет второй сезон
+                    season = await asyncio.to_thread(archive.append, game.key, record)
+                except Exception as e:
+                    logger.error(f"Error archiving season: {e}", exc_info=True)
+                    await update.message.reply_text(say(update, "reset.archive_failed"))
+                    return
+        await game._mutate(wipe)
+    
+    if season is None:
+        await update.message.reply_text(say(update, "reset.done"))
+    else:
+        await update.message.reply_text(say(update, "reset.archived", number=season.number))
+
+
+def _season_label(season: Season, lang: str) -> str:
+    when = datetime.fromtimestamp(season.exchange_at or season.assigned_at or season.archived_at, TIMEZONE)
+    return catalog.render(lang, "history.season", number=season.number, date=f"{when:%Y-%m-%d}", people=season.participants)
+
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Browse archived seasons of the game (admin only)"""
+    user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
+    
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
+        return
+    
+    if archive is None:
+        await update.message.reply_text(say(update, "history.off"))
+        return
+    
+    try:
+        lang = language(update)
+        seasons = await asyncio.to_thread(archive.history, game.key)
+        if not seasons:
+            await update.message.reply_text(say(update, "history.empty"))
+            return
+        
+        query = " ".join(context.args or []).strip()
+        if not query:
+            lines = [say(update, "history.seasons"), ""]
+            lines.extend(_season_label(season, lang) for season in reversed(seasons))
+            lines += ["", say(update, "history.hint")]
+            text = "\n".join(lines)
+        elif query.isdigit():
+            number = int(query)
+            if not 1 <= number <= len(seasons):
+                await update.message.reply_text(say(update, "history.no_season", count=len(seasons)))
+                return
+            season = seasons[number - 1]
+            # Целиком распаковываем только этот сезон
+            record = await asyncio.to_thread(archive.load, season)
+            wishes = {row[1]: row[4] for row in record["participants"] if row[4]}
+            lines = [say(update, "history.pairs", season=_season_label(season, lang)), ""]
+            for giver, receiver in record["pairs"]:
+                line = f"{giver} → {receiver}"
+                if receiver in wishes:
+                    line += f" ({wishes[receiver]})"
+                lines.append(line)
+            text = "\n".join(lines)
+        else:
+            draws = await asyncio.to_thread(archive.gave_to, game.key, query)
+            if not draws:
+                await update.message.reply_text(say(update, "history.not_found", name=query))
+                return
+            lines = [say(update, "history.gave_to", name=query), ""]
+            lines.extend(
+                catalog.render(lang, "history.draw", year=season.year(TIMEZONE), number=season.number, receiver=receiver)
+                for season, receiver in draws
+            )
+            text = "\n".join(lines)
+        
+        if len(text.encode()) <= ROSTER_PAGE_BYTES:
+            await update.message.reply_text(text)
+        else:
+            await update.message.reply_document(
+                document=text.encode(), filename=f"history-{query or 'seasons'}.txt", caption=say(update, "history.too_long")
+            )
+    except Exception as e:
+        logger.error(f"Error in history command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(say(update, "history.failed"))
+        except:
+            pass
+
+
+def _parse_name_pair(data: SecretSantaData, context: ContextTypes.DEFAULT_TYPE) -> Optional[Tuple[Participant, Participant]]:
+    """Resolve '/command Name1, Name2' arguments to two participant records"""
+    names = [part.strip() for part in " ".join(context.args or []).split(",")]
+    if len(names) != 2:
+        return None
+    first = data.get_participant_by_name(names[0])
+    second = data.get_participant_by_name(names[1])
+    if first is None or second is None or first is second:
+        return None
+    return first, second
+
+
+async def couple(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mark two participants as partners who never draw each other (admin only)"""
+    user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
+    
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
+        return
+    
+    pair = _parse_name_pair(game.data, context)
+    if pair is None:
+        await update.message.reply_text(say(update, "couple.usage"))
+        return
+    
+    first, second = pair
+    await game.mutate(lambda data: data.add_couple(first.id, second.id))
+    await update.message.reply_text(say(update, "couple.done", first=first.name, second=second.name))
+
+
+async def exclude(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Forbid one participant from drawing another (admin only)"""
+    user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
+    
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
+        return
+    
+    pair = _parse_name_pair(game.data, context)
+    if pair is None:
+        await update.message.reply_text(say(update, "exclude.usage"))
+        return
+    
+    giver, receiver = pair
+    await game.mutate(lambda data: data.add_exclusion(giver.id, receiver.id))
+    await update.message.reply_text(say(update, "exclude.done", giver=giver.name, receiver=receiver.name))
+
+
+async def late_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Open or close registration after assignment (admin only)"""
+    user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return
+    
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
+        return
+    
+    choice = (context.args or [""])[0].lower()
+    if choice not in ("on", "off"):
+        await update.message.reply_text(say(update, "late_join.status_on" if game.data.late_join else "late_join.status_off"))
+        return
+    
+    await game.mutate(lambda data: data.set_late_join(choice == "on"))
+    await update.message.reply_text(say(update, f"late_join.{choice}"))
+
+
+def _parse_when(args: List[str]) -> Optional[float]:
+    """'YYYY-MM-DD [HH:MM]' in TIMEZONE as Unix time"""
+    text = " ".join(args)
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt).replace(tzinfo=TIMEZONE).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def _format_when(when: float) -> str:
+    return datetime.fromtimestamp(when, TIMEZONE).strftime("%Y-%m-%d %H:%M %Z")
+
+
+async def _schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str) -> Optional[Tuple[Game, Optional[float]]]:
+    """Common part of /deadline and /exchange: admin check, 'off', date parsing; None if already answered"""
+    user_id = update.effective_user.id
+    game = await current_game(update)
+    if game is None:
+        return None
+    
+    if not game.is_admin(user_id):
+        await update.message.reply_text(say(update, "admin.only"))
+        return None
+    
+    if not context.args:
+        current = game.data.deadline if command == "deadline" else game.data.exchange_at
+        state = _format_when(current) if current is not None else say(update, "schedule.not_set")
+        await update.message.reply_text(say(update, "schedule.status", command=command, state=state, timezone=TIMEZONE))
+        return None
+    
+    if context.args[0].lower() == "off":
+        return game, None
+    when = _parse_when(context.args)
+    if when is None or when <= time.time():
+        await update.message.reply_text(say(update, "schedule.bad_date", command=command, timezone=TIMEZONE))
+        return None
+    return game, when
+
+
+async def deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set when registration closes and names are drawn automatically (admin only)"""
+    parsed = await _schedule_command(update, context, "deadline")
+    if parsed is None:
+        return
+    game, when = parsed
+    
+    if when is not None and game.data.assigned:
+        await update.message.reply_text(say(update, "deadline.already_drawn"))
+        return
+    
+    await game.mutate(lambda data: data.set_deadline(when))
+    if when is None:
+        await update.message.reply_text(say(update, "deadline.removed"))
+    else:
+        await update.message.reply_text(say(update, "deadline.set", when=_format_when(when)))
+
+
+async def exchange(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set the gift exchange date for reminders (admin only)"""
+    parsed = await _schedule_command(update, context, "exchange")
+    if parsed is None:
+        return
+    game, when = parsed
+    
+    await game.mutate(lambda data: data.set_exchange(when))
+    if when is None:
+        await update.message.reply_text(say(update, "exchange.removed"))
+    else:
+        await update.message.reply_text(say(update, "exchange.set", when=_format_when(when)))
+
+
+def _draw_at_deadline(data: SecretSantaData) -> Optional[Tuple[bool, str, Dict[str, str]]]:
+    """Run a due automatic draw; (names drawn, catalog key and fields of the note for the admin), or None if it's not ours to run"""
+    if data.deadline is None or time.time() < data.deadline:
+        return None
+    data.set_deadline(None)
+    if data.assigned:
+        return None
+    if len(data.adults) + len(data.children) < 2:
+        return False, "deadline.too_few", {}
+    try:
+        data.make_assignments()
+    except AssignmentError as e:
+        return False, "deadline.unsolvable", {"reason": str(e)}
+    # Задания уходят прямо сейчас — напоминание, время которого уже наступило, было бы повтором
+    _take_wave(data, time.time())
+    return True, "deadline.drawn", {}
+
+
+def _due_wave(data: SecretSantaData, now: float) -> Optional[int]:
+    """Latest reminder wave that is due and not sent yet"""
+    if data.exchange_at is None:
+        return None
+    due = [i for i, (before, _) in enumerate(REMINDER_WAVES) if now >= data.exchange_at - before]
+    if not due or due[-1] < data.reminded:
+        return None
+    return due[-1]
+
+
+def _take_wave(data: SecretSantaData, now: float) -> Optional[int]:
+    """Claim the due reminder wave; on several replicas only one of them gets it"""
+    wave = _due_wave(data, now)
+    if wave is None:
+        return None
+    # Пропущенные волны не досылаем: после рестарта уходит только самая свежая
+    data.mark_reminded(wave + 1)
+    # Обмен уже прошел — напоминать поздно
+    return wave if now < data.exchange_at else None
+
+
+async def run_schedules(context: ContextTypes.DEFAULT_TYPE):
+    """One tick for every game: due draws and reminders are collected and delivered as one batch"""
+    await games.sync()
+    now = time.time()
+    outgoing: Dict[Game, List[Tuple[str, Any, List[int]]]] = {}
+    for game in list(games.games.values()):
+        data = game.data
+        batch = outgoing.setdefault(game, [])
+        try:
+            if data.deadline is not None and now >= data.deadline:
+                outcome = await game.mutate(_draw_at_deadline)
+                if outcome is not None:
+                    drawn, note, fields = outcome
+                    logger.info(f"Deadline for game {game.key}: {catalog.render(DEFAULT_LANGUAGE, note, **fields)}")
+                    admin_id = game.admin_id or ADMIN_ID
+                    if admin_id:
+                        batch.append(text_to(admin_id, note, **fields))
+                    if drawn:
+                        metrics.increment("scheduled_draws")
+                        batch.append(missions_to(data.mission_recipients()))
+            if data.assigned and _due_wave(data, now) is not None:
+                wave = await game.mutate(lambda data: _take_wave(data, now))
+                if wave is not None:
+                    key = REMINDER_WAVES[wave][1]
+                    date = _format_when(data.exchange_at)
+                    batch.append(missions_to(data.mission_recipients(), key, photos=False, date=date))
+                    metrics.increment("reminder_waves")
+        except Exception as e:
+            logger.error(f"Error in scheduled jobs for game {game.key}: {e}", exc_info=True)
+        if not batch:
+            del outgoing[game]
+    # Заодно забираем то, что недоставил прошлый процесс (или упавшая реплика)
+    await claim_outbox(context.application)
+    if not outgoing:
+        return
+    
+    queued = []
+    for game, batches in outgoing.items():
+        queued.extend(await enqueue(game, batches))
+    # Рассылка идет в фоне: пока она длится, тики не пропускаются и другие игры получают свои дедлайны вовремя
+    context.application.create_task(_send_scheduled(context.bot, queued))
+
+
+async def _send_scheduled(bot, queued: List[List]):
+    report = await send_queued(bot, queued)
+    metrics.increment("scheduled_delivered", len(report.delivered))
+    metrics.increment("scheduled_failed", len(report.failed))
+    logger.info(f"Scheduled batch: {len(report.delivered)} delivered, {len(report.failed)} failed")
+
+
+async def import_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Explain how to import a roster (admin only)"""
+    await update.message.reply_text(say(update, "import.usage"))
+
+
+async def import_roster(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Bulk-register participants from an uploaded CSV/JSON file (admin only)"""
+    path = None
+    try:
+        user_id = update.effective_user.id
+        game = await current_game(update)
+        if game is None:
+            return
+        
+        if not game.is_admin(user_id):
+            await update.message.reply_text(say(update, "admin.only"))
+            return
+        
+        document = update.message.document
+        filename = document.file_name or ""
+        if not filename.lower().endswith((".csv", ".json", ".jsonl")):
+            await update.message.reply_text(say(update, "import.bad_type") + "\n\n" + say(update, "import.usage"))
+            return
+        if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+            await update.message.reply_text(say(update, "import.too_big"))
+            return
+        
+        data = game.data
+        if data.assigned:
+            await update.message.reply_text(say(update, "import.too_late"))
+            return
+        
+        # Файл качаем на диск, а не в память: разбор читает его строка за строкой
+        with tempfile.NamedTemporaryFile(prefix="santa-import-", delete=False) as f:
+            path = f.name
+        await (await document.get_file()).download_to_drive(path)
+        # Разбор идет в потоке по снимку имен, чтобы не держать цикл событий и блокировку игры
+        registered = set(data.by_name)
+        adult_ids = {adult.name: adult.id for adult in data.adults.values()}
+        result = await asyncio.to_thread(parse_roster, path, filename, registered, adult_ids)
+        
+        def insert(data: SecretSantaData) -> Optional[Tuple[List, List]]:
+            if data.assigned:
+                return None
+            # Пока файл разбирался, кто-то мог зарегистрироваться сам; имена сверяем по тому же индексу, что и регистрация
+            adults = [row for row in result.adults if data.name_taken(row[1]) is None and row[0] not in data.adults]
+            guardian_ids = data.adults.keys() | {row[0] for row in adults}
+            children = [row for row in result.children if data.name_taken(row[0]) is None and row[1] in guardian_ids]
+            data.bulk_add(adults, children)
+            return adults, children
+        
+        inserted = await game.mutate(insert)
+        if inserted is None:
+            await update.message.reply_text(say(update, "import.too_late"))
+            return
+        adults, children = inserted
+        taken = len(result.adults) + len(result.children) - len(adults) - len(children)
+        for adult_id, _, _ in adults:
+            games.join(adult_id, game.key)
+        
+        logger.info(f"Imported {len(adults)} adults and {len(children)} children into {game.key}")
+        lines = [say(update, "import.done", adults=len(adults), kids=len(children))]
+        if taken:
+            lines.append(say(update, "import.taken", count=taken))
+        if result.rejected:
+            lines += ["", say(update, "import.rejected", count=len(result.rejected))]
+            lines += [
+                say(update, "import.row", number=number, reason=say(update, f"import.reason.{reason}", **fields))
+                for number, reason, fields in result.rejected[:IMPORT_REJECTS_SHOWN]
+            ]
+            if len(result.rejected) > IMPORT_REJECTS_SHOWN:
+                lines.append(say(update, "import.more", count=len(result.rejected) - IMPORT_REJECTS_SHOWN))
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Error in import_roster: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(say(update, "import.failed"))
+        except:
+            pass
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+
+async def export_roster(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the roster and assignments as a CSV/JSONL document (admin only)"""
+    path = None
+    try:
+        user_id = update.effective_user.id
+        game = await current_game(update)
+        if game is None:
+            return
+        
+        if not game.is_admin(user_id):
+            await update.message.reply_text(say(update, "admin.only"))
+            return
+        
+        options = {arg.lower() for arg in context.args or []}
+        fmt = "jsonl" if "jsonl" in options or "json" in options else "csv"
+        # Снимок под замком игры: поток пишет файл, пока /reset, опоздавшие и жеребьевка меняют живые записи
+        async with game.lock:
+            records = game.data.export_records()
+            assigned = game.data.assigned
+        if not records:
+            await update.message.reply_text(say(update, "export.empty"))
+            return
+        
+        # Пары по умолчанию запечатаны: админ тоже играет и не должен видеть, кто кому дарит
+        seal = None
+        if "open" not in options:
+            secret = EXPORT_SECRET.encode() if EXPORT_SECRET else derive_seal_key(context.bot.token)
+            seal = make_seal(secret)
+        with tempfile.NamedTemporaryFile(prefix="santa-export-", suffix=f".{fmt}", delete=False) as f:
+            path = f.name
+        await asyncio.to_thread(write_export, path, export_rows(records, seal), fmt)
+        
+        caption_key = "export.caption"
+        if assigned:
+            caption_key = "export.caption_sealed" if seal else "export.caption_open"
+        caption = say(update, caption_key, count=len(records))
+        filename = f"secret-santa-{game.key.replace(':', '-')}.{fmt}"
+        # Файл уходит админу в личку, чтобы не светить его в общем чате
+        with open(path, "rb") as document:
+            await context.bot.send_document(chat_id=user_id, document=document, filename=filename, caption=caption)
+        if update.effective_chat.type != Chat.PRIVATE:
+            await update.message.reply_text(say(update, "export.sent_private"))
+    except Exception as e:
+        logger.error(f"Error in export_roster: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(say(update, "export.failed"))
+        except:
+            pass
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+
+async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start a separate game: tied to the group, or joinable by invite code in private"""
+    user_id = update.effective_user.id
+    chat = update.effective_chat
+    
+    if chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        key = group_game_key(chat.id)
+        await games.sync()
+        if key in games.games:
+            await update.message.reply_text(say(update, "new_game.chat_has_game"))
+            return
+        games.create_game(key, user_id)
+        await update.message.reply_text(say(update, "new_game.chat_created"))
+        return
+    
+    game = games.new_invite_game(user_id)
+    games.join(user_id, game.key)
+    await update.message.reply_text(say(update, "new_game.invite_created", code=game.key))
+
+
+async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Switch to the game behind an invite code"""
+    user_id = update.effective_user.id
+    code = (context.args[0] if context.args else "").strip().upper()
+    
+    if code not in games.games or code.startswith("chat:"):
+        await update.message.reply_text(say(update, "join.unknown"))
+        return
+    
+    games.join(user_id, code)
+    await update.message.reply_text(say(update, "join.joined", code=code))
+
+
+async def refuse_non_operator(update: Update) -> bool:
+    """Process-wide commands belong to ADMIN_ID alone; True (after replying) when the caller isn't them"""
+    if not ADMIN_ID:
+        # Без ADMIN_ID админом игры по умолчанию считается кто угодно — метрики и профилировщик так не раздаем
+        await update.message.reply_text(say(update, "admin.no_operator"))
+        return True
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text(say(update, "admin.only"))
+        return True
+    return False
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show handler and delivery metrics (admin only)"""
+    if await refuse_non_operator(update):
+        return
+    
+    await update.message.reply_text(metrics.render_text())
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Profile the next calls of chosen handlers and send the report (admin only)"""
+    if await refuse_non_operator(update):
+        return
+    
+    try:
+        chat_id = update.effective_chat.id
+        
+        async def send_report(path: Optional[str]):
+            if path is None:
+                await context.bot.send_message(chat_id, say(update, "profile.nothing"))
+                return
+            with open(path, "rb") as document:
+                await context.bot.send_document(
+                    chat_id, document=document, filename=os.path.basename(path), caption=say(update, "profile.ready")
+                )
+        
+        args = context.args or []
+        if args == ["off"]:
+            if not profiler.active:
+                await update.message.reply_text(say(update, "profile.already_off"))
+                return
+            await send_report(profiler.stop())
+            return
+        
+        names = [arg for arg in args if not arg.isdigit() and arg not in MODES]
+        if not names:
+            available = sorted({handler_name(handler) for handler in iter_handlers(context.application)})
+            await update.message.reply_text(say(update, "profile.usage", calls=PROFILE_CALLS, handlers=", ".join(available)))
+            return
+        calls = next((int(arg) for arg in args if arg.isdigit()), PROFILE_CALLS)
+        mode = next((arg for arg in args if arg in MODES), "cpu")
+        if calls < 1:
+            await update.message.reply_text(say(update, "profile.bad_calls"))
+            return
+        
+        if profiler.active:
+            # Новый запрос заменяет старый; то, что уже снято, не пропадает
+            await send_report(profiler.stop())
+        missing = profiler.start(context.application, names, calls, mode, send_report)
+        if missing:
+            await update.message.reply_text(say(update, "profile.unknown", names=", ".join(missing)))
+            return
+        await update.message.reply_text(say(update, "profile.started", mode=mode, calls=calls, names=", ".join(names)))
+    except Exception as e:
+        logger.error(f"Error in profile command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text(say(update, "profile.failed"))
+        except:
+            pass
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel current operation"""
-    await update.message.reply_text("❌ Got it. Canceled. 🎄\nSometimes giving up is also a choice. 🎅")
+    close_session(context)
+    await update.message.reply_text(say(update, "cancel"))
     return ConversationHandler.END
 
 
+async def registration_timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """End a registration the user walked away from"""
+    close_session(context)
+    metrics.increment("conversations_timed_out")
+    try:
+        await update.effective_message.reply_text(say(update, "registration.timed_out"))
+    except Exception as e:
+        logger.warning(f"Could not tell user about timed out registration: {e}")
+
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Evict abandoned registrations, session and dialog state alike, so per-user state stays bounded"""
+    application = context.application
+    now = time.time()
+    evicted: Set[int] = set()
+    open_sessions = []
+    for user_id, user_data in list(application.user_data.items()):
+        if not user_data:
+            # Пустой словарь остается после завершенной регистрации — это не сессия
+            application.drop_user_data(user_id)
+            continue
+        last_seen = user_data.get('last_seen')
+        if last_seen is None or now - last_seen > SESSION_TTL:
+            evicted.add(user_id)
+        else:
+            open_sessions.append((last_seen, user_id))
+    if len(open_sessions) > MAX_OPEN_SESSIONS:
+        open_sessions.sort()
+        overflow = open_sessions[:len(open_sessions) - MAX_OPEN_SESSIONS]
+        evicted.update(user_id for _, user_id in overflow)
+        metrics.increment("sessions_evicted_over_limit", len(overflow))
+    for user_id in evicted:
+        application.drop_user_data(user_id)
+    _end_conversations(application)
+    if evicted:
+        metrics.increment("sessions_evicted", len(evicted))
+        logger.info(f"Evicted {len(evicted)} abandoned registrations, {len(open_sessions)} still open")
+
+
+def _end_conversations(application: Application):
+    """End dialogs whose session is gone: in the handlers, their timeout jobs and conversations.pickle"""
+    for handler in conversation_handlers:
+        for key, state in list(handler._conversations.items()):
+            # Ключ диалога — (chat_id, user_id); сессия жива, пока в user_data есть игра
+            if state is not None and 'game' in application.user_data.get(key[-1], {}):
+                continue
+            job = handler.timeout_jobs.pop(key, None)
+            if job is not None:
+                job.schedule_removal()
+            # Как если бы шаг вернул END: ключ уходит из памяти, а при сохранении — из conversations.pickle
+            handler._update_state(ConversationHandler.END, key)
+    # Завершенные диалоги PicklePersistence хранит как None — такие записи больше не нужны
+    stored = getattr(application.persistence, "conversations", None) or {}
+    for states in stored.values():
+        for key in [key for key, state in states.items() if state is None]:
+            del states[key]
+
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Help command"""
-    help_text = (
-        "📖 Commands overview:\n\n"
-        "/start – Start the bot 🎄\n"
-        "/im_in – Join the game 🎅\n"
-        "/add_small_human – Add a child (no Telegram needed) 🎁\n"
-        "/who_are_we – View all participants ⛄\n"
-        "/make_it_random – Assign gift pairs (admin only) 🎀\n"
-        "/my_mission – See who you're buying for 🦌\n"
-        "/reset – Reset everything (admin only) 🎄\n"
-        "/help – You're here 🎅\n\n"
-        "💡 Note: Kids without Telegram can still play — just register them, and their assignment will go to the adult who added them. 🎁➡️🎅"
-    )
+    help_text = say(update, "help")
     await update.message.reply_text(help_text)
 
 
-def main():
-    """Start the bot"""
-    # Try to get token from environment variables
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    
-    if not token:
-        logger.error("TELEGRAM_BOT_TOKEN is not set in environment variables!")
-        logger.error("For local run: create .env file with TELEGRAM_BOT_TOKEN=your_token")
-        logger.error("For Railway: add TELEGRAM_BOT_TOKEN variable in project settings")
-        return
+async def prune_admission(context: ContextTypes.DEFAULT_TYPE):
+    """Forget flood-control state of users and chats that went quiet"""
+    dropped = admission.prune()
+    if dropped:
+        logger.info(f"Pruned admission state of {dropped} idle users and chats")
+
+
+async def save_offset(context: ContextTypes.DEFAULT_TYPE):
+    """Write down which polled updates are processed, if anything changed"""
+    if updates.changed:
+        await asyncio.to_thread(save_checkpoint, os.path.join(RESUME_DIR, UPDATES_FILE), updates.checkpoint())
+
+
+class DrainingApplication(Application):
+    """Application whose stop lets broadcasts wind down instead of waiting for them to finish
+
+    PTB stops taking updates first and then waits for everything in flight; a broadcast to thousands
+    of people would hold the restart for minutes. Sends already started get DRAIN_TIMEOUT seconds,
+    the rest stays in the outbox for the next process.
+    """
     
-    # Create application
-    application = Application.builder().token(token).build()
+    async def stop(self):
+        await deliverer.drain(DRAIN_TIMEOUT)
+        await super().stop()
+
+
+async def post_init(application: Application):
+    """Start background services once the event loop is running"""
+    if games.journal is not None:
+        games.journal.start()
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(sweep_sessions, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL)
+        application.job_queue.run_repeating(prune_admission, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL)
+        # Просроченное за время простоя и недоставленное прошлым процессом — на первом же тике
+        application.job_queue.run_repeating(run_schedules, interval=SCHEDULE_TICK, first=1)
+        if RESUME_DIR:
+            application.job_queue.run_repeating(save_offset, interval=CHECKPOINT_INTERVAL, first=CHECKPOINT_INTERVAL)
+    else:
+        logger.warning("JobQueue is not available: abandoned registrations won't time out or be evicted, schedules won't run")
+    if METRICS_PORT:
+        application.bot_data["metrics_server"] = await serve_prometheus(metrics, METRICS_PORT)
+
+
+async def post_shutdown(application: Application):
+    """Flush pending state to disk"""
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server is not None:
+        metrics_server.close()
+    # Профилирование не переживает рестарт: то, что успели снять, оставляем на диске
+    profiler.stop()
+    if RESUME_DIR:
+        # Все полученные обновления к этому моменту обработаны: следующий процесс начнет ровно после них
+        save_checkpoint(os.path.join(RESUME_DIR, UPDATES_FILE), updates.checkpoint(stopped=True))
+    if games.journal is not None:
+        # В снапшот попадает и outbox — то, что рассылка не успела
+        await games.journal.close()
+
+
+def build_application(token: str, base_url: Optional[str] = None) -> Application:
+    """Create the application with every handler registered
+
+    ``base_url`` points the bot at another Bot API server (the load-test harness uses a local fake).
+    """
+    bot = ResumableBot(
+        updates,
+        token=token,
+        request=InstrumentedRequest(metrics, connection_pool_size=256),
+        get_updates_request=HTTPXRequest(),
+        **({"base_url": base_url} if base_url else {}),
+    )
+    builder = (
+        Application.builder()
+        .application_class(DrainingApplication)
+        .bot(bot)
+        # При одном обновлении за раз обработчик тот же: он отмечает обработанные обновления
+        .concurrent_updates(PerUserUpdateProcessor(max(CONCURRENT_UPDATES, 1)))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    persistence = None
+    if RESUME_DIR:
+        # Незаконченные регистрации переживают рестарт: шаг диалога и то, что уже введено
+        persistence = PicklePersistence(
+            os.path.join(RESUME_DIR, CONVERSATIONS_FILE),
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=CONVERSATIONS_FLUSH,
+        )
+        builder = builder.persistence(persistence)
+    application = builder.build()
     
     # Register adult participant
     register_handler = ConversationHandler(
@@ -661,8 +2641,20 @@ def main():
             ASKING_RECOMMENDATIONS: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_recommendations)
             ],
+            ASKING_PHOTO: [
+                MessageHandler(filters.PHOTO, process_photo),
+                CommandHandler("skip", skip_photo),
+                # Текст, стикер, документ, голосовое — все, кроме фото и команд: напоминаем, чего ждем
+                MessageHandler(~filters.COMMAND, photo_expected),
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, registration_timed_out)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT or None,
+        name="register",
+        persistent=persistence is not None,
+        # Кого уборка выселила из диалога, начинает заново той же командой
+        allow_reentry=True,
     )
     
     # Add child
@@ -677,23 +2669,103 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_child_recommendations),
                 CommandHandler("cancel", cancel)
             ],
+            ASKING_CHILD_PHOTO: [
+                MessageHandler(filters.PHOTO, process_child_photo),
+                CommandHandler("skip", skip_child_photo),
+                MessageHandler(~filters.COMMAND, photo_expected),
+                CommandHandler("cancel", cancel)
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, registration_timed_out)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT or None,
+        name="add_child",
+        persistent=persistence is not None,
+        # Кого уборка выселила из диалога, начинает заново той же командой
+        allow_reentry=True,
     )
     
+    # Допуск обновлений — отдельная группа раньше всех обработчиков; отказ останавливает обработку
+    application.add_handler(TypeHandler(Update, admit), group=-1)
+    
     # Register handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(register_handler)
     application.add_handler(add_child_handler)
+    conversation_handlers[:] = [register_handler, add_child_handler]
     application.add_handler(CommandHandler("who_are_we", list_participants))
-    application.add_handler(CommandHandler("make_it_random", assign))
+    application.add_handler(CallbackQueryHandler(list_participants_page, pattern=r"^who:\d+$"))
+    # Рассылка идет в фоне, чтобы не задерживать обновления других игр
+    application.add_handler(CommandHandler("make_it_random", assign, block=False))
+    application.add_handler(CommandHandler("stop_sending", stop_sending))
     application.add_handler(CommandHandler("my_mission", my_assignment))
+    application.add_handler(CommandHandler("new_game", new_game))
+    application.add_handler(CommandHandler("join", join))
+    application.add_handler(CommandHandler("couple", couple))
+    application.add_handler(CommandHandler("exclude", exclude))
+    # Импорт большого файла идет в фоне, остальные обновления не ждут
+    application.add_handler(
+        MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_roster, block=False)
+    )
+    application.add_handler(CommandHandler("import", import_usage))
+    application.add_handler(CommandHandler("export", export_roster, block=False))
+    application.add_handler(CommandHandler("late_join", late_join))
+    application.add_handler(CommandHandler("deadline", deadline))
+    application.add_handler(CommandHandler("exchange", exchange))
     application.add_handler(CommandHandler("reset", reset))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("profile", profile))
     application.add_handler(CommandHandler("help", help_command))
     
+    # Оборачиваем все обработчики, включая шаги диалогов, в сбор метрик
+    metrics.instrument_application(application)
+    return application
+
+
+def main():
+    """Start the bot"""
+    # Try to get token from environment variables
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    
+    if not token:
+        logger.error("TELEGRAM_BOT_TOKEN is not set in environment variables!")
+        logger.error("For local run: create .env file with TELEGRAM_BOT_TOKEN=your_token")
+        logger.error("For Railway: add TELEGRAM_BOT_TOKEN variable in project settings")
+        return
+    
+    # Сначала все, что не зависит от состояния: пока старый процесс дорабатывает, новый уже готов
+    application = build_application(token, os.getenv("TELEGRAM_API_URL"))
+    
+    # Восстанавливаем состояние после рестарта
+    if SQLITE_PATH:
+        backend = SQLiteBackend(SQLITE_PATH)
+    elif DATA_DIR:
+        backend = Journal(DATA_DIR)
+        # Журнал пишет только один процесс: ждем, пока старый отпустит каталог
+        backend.lock()
+        updates.load(os.path.join(DATA_DIR, UPDATES_FILE))
+    else:
+        backend = MemoryBackend()
+    backend.load(games)
+    
     # Start the bot
-    logger.info("Bot started!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Секрет по умолчанию выводим из токена, чтобы он совпадал у всех реплик и не менялся при рестарте
+        secret_token = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(token.encode()).hexdigest()
+        port = int(os.getenv("PORT", "8443"))
+        logger.info(f"Bot started in webhook mode on port {port}!")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info("Bot started!")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
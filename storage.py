@@ -0,0 +1,363 @@
+"""Storage backends for game state.
+
+Состояние всегда живет в памяти процесса (SecretSantaData), а бэкенд
+решает, куда уходят изменения и откуда приходят чужие. Каждое изменение —
+это запись журнала (op, args), та же, что воспроизводится при старте.
+
+    MemoryBackend   — ничего не покидает процесс (как было изначально)
+    persistence.Journal — то же, плюс журнал и снапшоты на диске
+    SQLiteBackend   — общий журнал событий в SQLite (WAL), с которым могут
+                      работать несколько реплик бота одновременно
+
+В SQLiteBackend изменение игры — это транзакция: реплика берет
+блокировку записи (BEGIN IMMEDIATE), догоняет чужие записи, выполняет
+проверки и изменения на свежем состоянии и одним коммитом пишет все их
+записи. Поэтому изменение из нескольких записей (снять дедлайн и
+раздать назначения) не может попасть в журнал наполовину, а
+/make_it_random на двух репликах не раздаст назначения дважды. Если
+транзакция не закоммитилась, а память уже изменена, состояние
+перечитывается из журнала. Вся
+работа с базой идет в отдельном потоке, цикл событий ее не ждет.
+
+Раз в snapshot_every записей одна из реплик кладет в таблицу snapshots
+состояние целиком и удаляет записи старше предыдущего снимка. Старт
+начинается с последнего снимка, а реплика, отставшая больше чем на
+снимок, перечитывает его вместо удаленных записей.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncContextManager, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать, пока другая реплика держит блокировку записи, в секундах
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    stream TEXT NOT NULL,
+    version INTEGER,
+    op TEXT NOT NULL,
+    args TEXT NOT NULL,
+    UNIQUE (stream, version)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    seq INTEGER PRIMARY KEY,
+    versions TEXT NOT NULL,
+    state TEXT NOT NULL
+);
+"""
+
+
+class Conflict(Exception):
+    """The change could not start (another replica holds the write lock too long); nothing was applied, retry"""
+
+
+class StorageBackend:
+    """Where state changes go and where other processes' changes come from.
+
+    ``load(state)`` restores ``state`` and attaches the backend as ``state.journal``;
+    the state then calls ``append(op, args)`` before applying each change.
+    Changes made inside ``transaction()`` are written together or not at all; entering it may
+    raise Conflict, in which case nothing ran. ``sync()`` pulls changes made elsewhere;
+    ``sync()``, ``transaction()``, ``start()`` and ``close()`` run inside the event loop.
+    """
+
+    def load(self, state: Any):
+        state.journal = self
+
+    def append(self, op: str, args: Any):
+        pass
+
+    async def sync(self):
+        pass
+    
+    def transaction(self) -> AsyncContextManager:
+        return contextlib.nullcontext()
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StorageBackend):
+    """Keeps state in this process only; everything is lost on restart"""
+
+    def load(self, state: Any):
+        # Журналировать некуда — состояние работает без записи изменений
+        state.journal = None
+
+
+class SQLiteBackend(StorageBackend):
+    """Shared event log in SQLite, safe for several bot processes on one host or volume"""
+
+    def __init__(self, path: str, flush_interval: float = 0.05, snapshot_every: int = 5000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        # Транзакциями управляем сами: BEGIN IMMEDIATE берет блокировку записи сразу.
+        # Соединение живет в одном потоке executor, но открывается здесь — отсюда check_same_thread
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL так теряются максимум последние коммиты при сбое питания, но не целостность
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.seq = 0
+        self.since_snapshot = 0
+        self.versions: Dict[str, int] = defaultdict(int)
+        self._state = None
+        self._replaying = False
+        # Записи открытой транзакции; None — транзакции нет
+        self._pending: Optional[List[Tuple[str, Any]]] = None
+        # Записи вне транзакций (реестр: create_game, join) — уходят пачкой в фоне
+        self._loose: List[Tuple[str, Any]] = []
+        self._dirty = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._lock: Optional[asyncio.Lock] = None
+
+    def load(self, state: Any):
+        started = time.perf_counter()
+        self._state = state
+        # Пустое состояние: с него перечитывается журнал без снимков, если память ушла вперед базы
+        self._blank = json.dumps(state.to_dict(), ensure_ascii=False)
+        # Цикл событий еще не запущен — читаем прямо здесь
+        snapshot, rows = self._read(from_snapshot=True)
+        self._apply(snapshot, rows)
+        state.journal = self
+        logger.info(
+            f"Loaded shared state at seq {self.seq} ({len(rows)} events after the snapshot) "
+            f"in {(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+
+    async def _run_db(self, func, *args):
+        """Run a blocking database call on the connection's own thread"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # Одно соединение на процесс: транзакции и догоняющие чтения идут по очереди
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _read(self, from_snapshot: bool = False) -> Tuple[Optional[Tuple[int, str, str]], List[Tuple]]:
+        """Events after ``self.seq``; also the latest snapshot if asked or if the events we need are compacted away"""
+        query = "SELECT seq, stream, version, op, args FROM events WHERE seq > ? ORDER BY seq"
+        rows = self.conn.execute(query, (self.seq,)).fetchall()
+        # seq идут подряд (AUTOINCREMENT, откаченные вставки номер не тратят): дыра — значит, записи удалены
+        if not from_snapshot and (not rows or rows[0][0] == self.seq + 1):
+            return None, rows
+        snapshot = self.conn.execute("SELECT seq, versions, state FROM snapshots ORDER BY seq DESC LIMIT 1").fetchone()
+        if snapshot is None:
+            return None, rows
+        return snapshot, self.conn.execute(query, (snapshot[0],)).fetchall()
+
+    def _apply(self, snapshot: Optional[Tuple[int, str, str]], rows: List[Tuple]) -> Set[str]:
+        """Apply events written by other replicas; return the games they touched"""
+        moved = set()
+        # Воспроизведение вызывает те же методы состояния — их записи в журнал не нужны
+        self._replaying = True
+        try:
+            if snapshot is not None:
+                seq, versions, state = snapshot
+                if self.seq:
+                    logger.warning(f"Fell behind compaction at seq {self.seq}; reloading the snapshot at seq {seq}")
+                self._state.load_dict(json.loads(state))
+                self.seq = seq
+                self.versions = defaultdict(int, json.loads(versions))
+                self.since_snapshot = 0
+            for seq, stream, version, op, args in rows:
+                self._state.replay(op, json.loads(args))
+                self.seq = seq
+                self.since_snapshot += 1
+                if stream:
+                    self.versions[stream] = version
+                    moved.add(stream)
+        finally:
+            self._replaying = False
+        return moved
+
+    async def _reload(self, unwritten: List[Tuple[str, Any]]):
+        """Rebuild the state from the log after memory ran ahead of it (a change that was not committed)"""
+        logger.warning(f"Reloading shared state at seq {self.seq}: an uncommitted change reached memory")
+        self.seq = 0
+        snapshot, rows = await self._run_db(self._read, True)
+        self._apply(snapshot or (0, "{}", self._blank), rows)
+        # Записи реестра (create_game, join) память держит и до записи: flush допишет их позже
+        self._replaying = True
+        try:
+            for op, args in unwritten + self._loose:
+                if op != "game":
+                    self._state.replay(op, args)
+        finally:
+            self._replaying = False
+
+    async def sync(self):
+        if self._state is None:
+            return
+        async with self.lock:
+            self._apply(*await self._run_db(self._read))
+
+    def _begin(self) -> Tuple[Optional[Tuple[int, str, str]], List[Tuple]]:
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            # База занята дольше BUSY_TIMEOUT: ничего не начато, можно повторить
+            raise Conflict(f"Shared log is busy: {e}") from e
+        try:
+            return self._read()
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _commit(self, records: List[Tuple[str, int, str, str]]) -> int:
+        try:
+            cursor = self.conn.executemany(
+                "INSERT INTO events (stream, version, op, args) VALUES (?, ?, ?, ?)", records
+            )
+            seq = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0] if cursor.rowcount else 0
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return seq
+
+    def _rollback(self):
+        self.conn.execute("ROLLBACK")
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        """Hold the write lock while the caller checks and changes caught-up state, then commit its records at once"""
+        async with self.lock:
+            snapshot, rows = await self._run_db(self._begin)
+            caught_up = False
+            # Изменение внутри синхронное: пока оно идет, чужие записи сюда не попадут
+            self._pending = []
+            try:
+                self._apply(snapshot, rows)
+                caught_up = True
+                yield
+            except BaseException:
+                # Отпускаем блокировку записи; если память уже изменена, возвращаем ее к журналу
+                pending, self._pending = self._pending, None
+                await self._run_db(self._rollback)
+                if not caught_up or pending:
+                    await self._reload(pending)
+                raise
+            pending, self._pending = self._pending, None
+            records = []
+            for op, args in pending:
+                # Изменения игры версионируются; реестр (create_game, join) — последняя запись побеждает
+                stream = args[0] if op == "game" else ""
+                version = None
+                if stream:
+                    version = self.versions[stream] = self.versions[stream] + 1
+                records.append((stream, version, op, json.dumps(args, ensure_ascii=False)))
+            try:
+                seq = await self._run_db(self._commit, records)
+            except BaseException:
+                # _commit уже откатил транзакцию, а изменения в памяти остались — перечитываем журнал
+                if records:
+                    await self._reload(pending)
+                raise
+            if seq:
+                self.seq = seq
+                self.since_snapshot += len(records)
+                if self.since_snapshot >= self.snapshot_every:
+                    self._dirty.set()
+
+    def append(self, op: str, args: Any):
+        if self._replaying:
+            return
+        if self._pending is not None:
+            self._pending.append((op, args))
+            return
+        self._loose.append((op, args))
+        self._dirty.set()
+
+    async def flush(self):
+        """Write records made outside transactions"""
+        if not self._loose:
+            return
+        loose, self._loose = self._loose, []
+        try:
+            async with self.transaction():
+                self._pending.extend(loose)
+        except Exception:
+            # Возвращаем записи в очередь, чтобы попробовать еще раз
+            self._loose[:0] = loose
+            raise
+
+    def _latest_snapshot(self) -> int:
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM snapshots").fetchone()[0]
+
+    def _write_snapshot(self, seq: int, versions: str, payload: str):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous = self._latest_snapshot()
+            self.conn.execute("INSERT INTO snapshots (seq, versions, state) VALUES (?, ?, ?)", (seq, versions, payload))
+            # Записи между прошлым и этим снимком оставляем: отставшей реплике хватит их, чтобы догнать
+            self.conn.execute("DELETE FROM events WHERE seq <= ?", (previous,))
+            self.conn.execute("DELETE FROM snapshots WHERE seq < ?", (previous,))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    async def snapshot(self):
+        """Store the whole state and compact the log, unless another replica did it recently"""
+        if self._state is None:
+            return
+        async with self.lock:
+            self._apply(*await self._run_db(self._read))
+            if self.seq - await self._run_db(self._latest_snapshot) < self.snapshot_every:
+                # Снимок уже сделала другая реплика
+                self.since_snapshot = 0
+                return
+            # Состояние снимаем в цикле событий, чтобы оно не менялось на ходу; to_dict отдает свежие списки
+            seq, state, versions = self.seq, self._state.to_dict(), json.dumps(self.versions)
+            self.since_snapshot = 0
+        payload = await asyncio.to_thread(json.dumps, state, ensure_ascii=False)
+        async with self.lock:
+            await self._run_db(self._write_snapshot, seq, versions, payload)
+        logger.info(f"Shared log compacted at seq {seq}")
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
+            try:
+                await self.flush()
+                if self.since_snapshot >= self.snapshot_every:
+                    await self.snapshot()
+            except Exception as e:
+                logger.error(f"Error writing shared log: {e}", exc_info=True)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        finally:
+            await self._run_db(self.conn.close)
+            self._executor.shutdown()